@@ -0,0 +1,207 @@
+## api_server.py
+
+import base64
+import json
+import logging
+import os
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 20 * 2 ** 20  # Query text plus one base64-encoded image
+
+
+def format_hit(hit):
+    payload = hit.payload or {}
+    return {"id": hit.id, "score": round(hit.score, 4), "image_path": payload.get("image_path"),
+            "caption": payload.get("caption")}
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    # POST /query and /retrieve take {"query", "image" (base64, optional), "top_k", "filters"}; GET /health
+    protocol_version = "HTTP/1.1"  # Keep-alive, so load tests and proxies reuse connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _parse_request(body):
+        # Returns (query, image, top_k, filters); raises ValueError for anything the pipeline should never see
+        from src.image_utils import QueryImage
+
+        request = json.loads(body or b"{}")
+        if not isinstance(request, dict):
+            raise ValueError("Request body must be a JSON object")
+        query = request.get("query")
+        if not query or not isinstance(query, str):
+            raise ValueError("query is required and must be a string")
+        image = None
+        if request.get("image"):
+            image = QueryImage.from_any(base64.b64decode(request["image"], validate=True))
+            if not isinstance(image, QueryImage):
+                raise ValueError("image is not a readable image")
+        top_k = min(max(int(request.get("top_k", 3)), 1), Config.API_MAX_TOP_K)
+        filters = request.get("filters")
+        if filters is not None and not isinstance(filters, dict):
+            raise ValueError("filters must be a JSON object")
+        for field, values in (filters or {}).items():
+            if not (values is None or isinstance(values, str)
+                    or isinstance(values, list) and all(isinstance(value, str) for value in values)):
+                raise ValueError(f"filters.{field} must be a string or a list of strings")
+        return query, image, top_k, filters
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send_json(200, {"status": "ok", "pid": os.getpid()})
+
+    def do_POST(self):
+        if self.path not in ("/query", "/retrieve"):
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.close_connection = True
+            self._send_json(400, {"error": "Invalid Content-Length header"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json(413, {"error": f"Request body larger than {MAX_BODY_BYTES} bytes"})
+            return
+        try:
+            query, image, top_k, filters = self._parse_request(self.rfile.read(length))
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        system = self.server.system
+        try:
+            if self.path == "/retrieve":
+                results, _ = system.retrieve(query, image, top_k=top_k, filters=filters)
+                self._send_json(200, {"results": [format_hit(hit) for hit in results]})
+            else:
+                self._send_json(200, {"response": system.process_query(query, image, top_k=top_k, filters=filters)})
+        except ValueError as e:
+            # e.g. an unknown filter field
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.error("Error serving %s: %s", self.path, e)
+            self._send_json(500, {"error": str(e)})
+
+
+def open_shared_system(warmup=True):
+    from src.create_data_embeddings import open_index
+    from src.multimodal_rag_system import MultimodalRAGSystem, COLLECTION_NAME
+
+    client = open_index(COLLECTION_NAME)
+    if client is None:
+        raise RuntimeError(f"No persisted index found for collection {COLLECTION_NAME}. Run `ingest` first.")
+    return MultimodalRAGSystem(qdrant_client=client, warmup=warmup)
+
+
+def build_server(system, host=None, port=None):
+    server = ThreadingHTTPServer((host or Config.API_HOST, port or Config.API_PORT), _QueryHandler)
+    server.daemon_threads = True
+    server.system = system
+    return server
+
+
+def _reopen_connections(system):
+    # Sockets, SQLite handles and thread pools do not survive a fork: every worker opens its own Qdrant and Groq
+    # connections and retrieval threads. A memory-mapped snapshot is already safe to share.
+    from concurrent.futures import ThreadPoolExecutor
+    from src.create_data_embeddings import get_qdrant_client
+    from src.groq_utils import GroqClient
+
+    if Config.QDRANT_URL and not Config.SNAPSHOT_PATH:
+        system.qdrant_client = get_qdrant_client()
+    system.groq_client = GroqClient()
+    system.retrieval_pool = ThreadPoolExecutor(max_workers=Config.RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+
+def _run_worker(server):
+    # The parent stops the workers with SIGTERM; Ctrl+C in the terminal is handled by the parent alone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        _reopen_connections(server.system)
+        server.serve_forever()
+    except Exception as e:
+        logger.error("Worker %s stopped: %s", os.getpid(), e)
+    finally:
+        os._exit(0)
+
+
+def serve_api(host=None, port=None, workers=None):
+    """Serve the JSON API. With workers > 1 the embedding models, the index and the lexical index are loaded once
+    and the listening socket is bound before forking, so every worker starts warm and shares them copy-on-write;
+    the vector index itself is a Qdrant server or a memory-mapped snapshot that all workers open together."""
+    workers = workers or Config.API_WORKERS
+    if workers > 1:
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Multi-worker serving needs os.fork (Linux or macOS); use one worker")
+        if not (Config.QDRANT_URL or Config.SNAPSHOT_PATH):
+            raise RuntimeError("Multi-worker serving needs a shared index: set QDRANT_URL or SNAPSHOT_PATH "
+                               "(a local on-disk Qdrant index can only be opened by one process)")
+        # ONNX Runtime thread pools do not survive a fork, single-threaded sessions do; N single-threaded workers
+        # also keep more cores busy than one multi-threaded process
+        Config.EMBEDDING_THREADS = Config.API_WORKER_THREADS
+
+    system = open_shared_system()
+    server = build_server(system, host, port)
+    logger.info("Serving the API on http://%s:%s with %s worker(s)", *server.server_address[:2], workers)
+    if workers == 1:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(server)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.warning("Worker %s exited with status %s, starting a new one", pid, status)
+            spawn()
+    server.server_close()
+    logger.info("API server stopped")
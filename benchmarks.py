@@ -0,0 +1,438 @@
+## benchmarks.py
+
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from config import Config
+
+SPLIT_FOLDERS = {"train": "train_images", "test": "test_images", "valid": "valid_images"}
+
+# Vocabulary for synthetic ROCO-style captions: modality, region and finding vary independently
+CAPTION_MODALITIES = ["Chest X-ray", "Axial CT scan", "Contrast-enhanced CT", "T2-weighted MRI", "Ultrasound",
+                      "PET-CT", "Coronal MRI", "Plain radiograph", "Doppler ultrasound", "Digital angiography"]
+CAPTION_REGIONS = ["of the chest", "of the abdomen", "of the brain", "of the pelvis", "of the left knee",
+                   "of the lumbar spine", "of the neck", "of the right kidney", "of the liver", "of the heart"]
+CAPTION_FINDINGS = ["showing a well-defined mass", "demonstrating pleural effusion", "with no acute abnormality",
+                    "revealing a displaced fracture", "showing multiple hypodense lesions",
+                    "demonstrating consolidation", "with an enhancing lesion (arrow)", "showing free fluid",
+                    "revealing calcified nodules", "demonstrating vessel occlusion"]
+
+
+def synthetic_caption(rng):
+    return f"{rng.choice(CAPTION_MODALITIES)} {rng.choice(CAPTION_REGIONS)} {rng.choice(CAPTION_FINDINGS)}."
+
+
+def synthetic_image(rng, size):
+    # Grayscale gradient with noise and a few bright blobs, roughly the statistics of a radiology image
+    noise = np.random.default_rng(rng.getrandbits(32))
+    gradient = np.linspace(0, rng.uniform(60, 160), size, dtype=np.float32)
+    pixels = gradient[None, :] + gradient[:, None] * rng.uniform(0.2, 0.8)
+    pixels += noise.normal(0, 12, (size, size))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(1, 4)):
+        x, y, radius = rng.randrange(size), rng.randrange(size), rng.randint(size // 20, size // 6)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=rng.randint(170, 255))
+    return image.convert("RGB")
+
+
+def generate_corpus(root, images_per_split=100, image_size=256, seed=0, query_count=20):
+    # Writes the ROCOv2 layout create_embeddings expects: <root>/<split>_images/<split>/<id>.jpg plus
+    # <root>/<split>_captions.csv with ID/Caption columns. Same seed, same corpus.
+    rng = random.Random(seed)
+    samples = []
+    for split, folder in SPLIT_FOLDERS.items():
+        images_dir = os.path.join(root, folder, split)
+        os.makedirs(images_dir, exist_ok=True)
+        rows = []
+        for i in range(images_per_split):
+            image_id = f"ROCOv2_2023_{split}_{i:06d}"
+            caption = synthetic_caption(rng)
+            image_path = os.path.join(images_dir, f"{image_id}.jpg")
+            synthetic_image(rng, image_size).save(image_path, quality=90)
+            rows.append((image_id, caption))
+            samples.append((caption, image_path))
+        with open(os.path.join(root, f"{split}_captions.csv"), "w", newline="", encoding="utf-8") as caption_file:
+            writer = csv.writer(caption_file)
+            writer.writerow(["ID", "Caption"])
+            writer.writerows(rows)
+
+    queries = rng.sample(samples, min(query_count, len(samples)))
+    return {
+        "root": root,
+        "images": len(samples),
+        "queries": [caption for caption, _ in queries],
+        "query_images": [image_path for _, image_path in queries],
+    }
+
+
+class _StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(body or b"{}")
+        settings = self.server.settings
+        model = request.get("model", "stub")
+        self.server.requests.append(model)
+        time.sleep(settings["latency"])
+        # Injected errors for this model, answered in order before it succeeds
+        failures = settings["failures"].get(model)
+        if failures:
+            self._send_failure(failures.pop(0), settings["retry_after"])
+            return
+        words = ["token"] * settings["tokens"]
+        base = {"id": "chatcmpl-benchmark", "created": int(time.time()), "model": model}
+
+        if not request.get("stream"):
+            payload = json.dumps(dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop",
+            }], usage={"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)})).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        # Server-sent events without a length, so the connection ends the stream
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, word in enumerate(words):
+            chunk = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None,
+            }])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if settings["token_interval"]:
+                time.sleep(settings["token_interval"])
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_failure(self, status, retry_after):
+        payload = json.dumps({"error": {"message": f"Injected error {status}", "type": "stub_error"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubLLMServer:
+    """Local OpenAI-compatible chat completions endpoint with a fixed latency, used in place of the Groq API.
+    failures maps a model name to the HTTP statuses its first requests fail with, e.g. {"primary": [429, 503]};
+    failed responses carry a Retry-After header when retry_after is set. The models of all requests received are
+    recorded in `requests`, in order."""
+
+    def __init__(self, latency=0.2, tokens=64, token_interval=0.0, failures=None, retry_after=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubLLMHandler)
+        self.server.daemon_threads = True
+        self.server.settings = {"latency": latency, "tokens": tokens, "token_interval": token_interval,
+                                "failures": {model: list(statuses) for model, statuses in (failures or {}).items()},
+                                "retry_after": retry_after}
+        self.server.requests = []
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def requests(self):
+        return list(self.server.requests)
+
+
+@contextlib.contextmanager
+def override_attributes(target, **values):
+    # Temporarily set attributes on Config or a module; the previous values are restored afterwards
+    previous = {name: getattr(target, name) for name in values}
+    for name, value in values.items():
+        setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(target, name, value)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(latencies_ms):
+    return {
+        "count": len(latencies_ms),
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else None,
+        "p50_ms": round(percentile(latencies_ms, 0.50), 3) if latencies_ms else None,
+        "p95_ms": round(percentile(latencies_ms, 0.95), 3) if latencies_ms else None,
+        "p99_ms": round(percentile(latencies_ms, 0.99), 3) if latencies_ms else None,
+        "max_ms": round(max(latencies_ms), 3) if latencies_ms else None,
+    }
+
+
+def measure_latency(function, arguments, repeat):
+    # One untimed warm-up call, then `repeat` passes over the argument list; returns milliseconds per call
+    if arguments:
+        function(*arguments[0])
+    latencies = []
+    for _ in range(repeat):
+        for args in arguments:
+            start_time = time.perf_counter()
+            function(*args)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+    return latencies
+
+
+def run_ingest_benchmark(collection_name):
+    from src.create_data_embeddings import create_embeddings
+    from src.embeddings_utils import warmup_models
+
+    # Model loading is reported separately so the stage throughputs only measure steady-state work
+    load_start = time.perf_counter()
+    warmup_models()
+    model_load_seconds = time.perf_counter() - load_start
+
+    stats = {}
+    start_time = time.perf_counter()
+    client = create_embeddings(collection_name, rebuild=True, stats=stats)
+    wall_seconds = time.perf_counter() - start_time
+
+    uploaded = stats.get("uploaded", 0)
+    stage_counts = {"read_captions": stats.get("documents", 0), "scan_images": stats.get("documents", 0),
+                    "join": stats.get("documents", 0), "fingerprint": stats.get("documents", 0)}
+    stages = {}
+    for stage, seconds in stats.get("stage_seconds", {}).items():
+        count = stage_counts.get(stage, uploaded)
+        stages[stage] = {"seconds": round(seconds, 4),
+                         "images_per_second": round(count / seconds, 2) if seconds > 0 else None}
+    report = {
+        "images": uploaded,
+        "failed_batches": stats.get("failed_batches", 0),
+        "wall_seconds": round(wall_seconds, 4),
+        "images_per_second": round(uploaded / wall_seconds, 2) if wall_seconds > 0 else None,
+        "model_load_seconds": round(model_load_seconds, 4),
+        "batch_size": stats.get("batch_size"),
+        "workers": stats.get("workers"),
+        "stages": stages,
+    }
+    return client, report
+
+
+def run_search_benchmark(client, collection_name, queries, query_images, repeat=10, top_k=3):
+    from src.embeddings_utils import search_similar_text, search_similar_image
+
+    # A search that fails is logged and returns [], which would otherwise be timed as a very fast search
+    if not search_similar_text(collection_name, client, queries[0], limit=top_k) or \
+            not search_similar_image(collection_name, client, query_images[0], limit=top_k):
+        raise RuntimeError("Vector search returned no results; see the log for the search error")
+    text_latencies = measure_latency(
+        lambda query: search_similar_text(collection_name, client, query, limit=top_k),
+        [(query,) for query in queries], repeat)
+    image_latencies = measure_latency(
+        lambda image_path: search_similar_image(collection_name, client, image_path, limit=top_k),
+        [(image_path,) for image_path in query_images], repeat)
+    # Payload-filtered search should cost about the same as unfiltered search
+    filtered_latencies = measure_latency(
+        lambda query: search_similar_text(collection_name, client, query, limit=top_k, filters={"modality": "CT"}),
+        [(query,) for query in queries], repeat)
+    return {"search_similar_text": latency_summary(text_latencies),
+            "search_similar_image": latency_summary(image_latencies),
+            "search_similar_text_filtered": latency_summary(filtered_latencies)}
+
+
+def run_query_benchmark(system, queries, query_images, repeat=3, top_k=3):
+    text_latencies = measure_latency(lambda query: system.process_query(query, top_k=top_k),
+                                     [(query,) for query in queries], repeat)
+    image_latencies = measure_latency(lambda query, image_path: system.process_query(query, image_path, top_k=top_k),
+                                      list(zip(queries, query_images)), repeat)
+    return {"process_query": latency_summary(text_latencies),
+            "process_query_with_image": latency_summary(image_latencies)}
+
+
+def run_prompt_benchmark(iterations=2000, reference_count=8, caption_words=60, seed=0):
+    # Prompt assembly in isolation: no models, index or network
+    from src.prompt_builder import PromptBuilder
+
+    rng = random.Random(seed)
+    contexts = [
+        SimpleNamespace(payload={
+            "caption": " ".join(synthetic_caption(rng) for _ in range(max(1, caption_words // 8))),
+            "image_path": f"/data/train_images/train/ROCOv2_2023_train_{i:06d}.jpg",
+        })
+        for i in range(reference_count)
+    ]
+    prompt = "Is there any fracture visible in this image, and what might explain the swelling around it?"
+    builder = PromptBuilder()
+    latencies = measure_latency(lambda: builder.build(prompt, contexts, "data:image/jpeg;base64,AAAA"), [()],
+                                iterations)
+    prompt_build = builder.build(prompt, contexts, "data:image/jpeg;base64,AAAA")
+    return {
+        "tokenizer": "tiktoken" if builder.counter.encoding is not None else "heuristic",
+        "input_token_budget": builder.input_token_budget,
+        "input_tokens": prompt_build.input_tokens,
+        "references_used": prompt_build.references_used,
+        "references_truncated": prompt_build.references_truncated,
+        "references_dropped": prompt_build.references_dropped,
+        "build": latency_summary(latencies),
+    }
+
+
+def run_rerank_benchmark(iterations=500, candidates=100, top_k=3, seed=0):
+    # Reranking arithmetic in isolation (the stored vectors are fetched by one Qdrant call, measured in the
+    # "rerank_fetch" stage of the end-to-end run): two candidate lists of `candidates` random unit vectors
+    from src.reranking import rerank_results
+    from src.storage_profiles import VECTOR_SIZE
+
+    noise = np.random.default_rng(seed)
+    point_ids = list(range(2 * candidates))
+    text_vectors = noise.standard_normal((len(point_ids), VECTOR_SIZE)).astype(np.float32)
+    image_vectors = noise.standard_normal((len(point_ids), VECTOR_SIZE)).astype(np.float32)
+    result_lists = [[SimpleNamespace(id=point_id, score=0.0) for point_id in point_ids[:candidates]],
+                    [SimpleNamespace(id=point_id, score=0.0) for point_id in point_ids[candidates:]]]
+    text_embedding = noise.standard_normal(VECTOR_SIZE).astype(np.float32)
+    image_embedding = noise.standard_normal(VECTOR_SIZE).astype(np.float32)
+    latencies = measure_latency(
+        lambda: rerank_results(result_lists, point_ids, text_vectors, image_vectors, text_embedding,
+                               image_embedding, top_k), [()], iterations)
+    return {"candidates": candidates, "top_k": top_k, "rerank": latency_summary(latencies)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmarks(images_per_split=100, image_size=256, repeat=10, query_repeat=3, top_k=3, llm_latency=0.2,
+                   llm_tokens=64, seed=0, workdir=None, keep=False):
+    # End-to-end run on a fresh synthetic corpus and index: prompt assembly, ingest, then vector search, then
+    # process_query against a local stub LLM. The index lives in the work directory, so the real one is never touched.
+    # Returns a JSON-serializable dict.
+    import src.create_data_embeddings as create_data_embeddings
+    from src.multimodal_rag_system import MultimodalRAGSystem, COLLECTION_NAME
+    from src.embeddings_utils import query_embedding_cache
+    from src import telemetry
+
+    owns_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="rag-benchmark-")
+    data_path = os.path.join(workdir, "data")
+    index_path = os.path.join(workdir, "index")
+    temp_path = os.path.join(workdir, "temp")
+    os.makedirs(temp_path, exist_ok=True)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "images_per_split": images_per_split, "image_size": image_size, "repeat": repeat,
+            "query_repeat": query_repeat, "top_k": top_k, "llm_latency": llm_latency, "llm_tokens": llm_tokens,
+            "seed": seed, "storage_profile": Config.STORAGE_PROFILE, "ingest_batch_size": Config.INGEST_BATCH_SIZE,
+            "ingest_workers": Config.INGEST_WORKERS, "fusion_method": Config.FUSION_METHOD,
+            "rerank_enabled": Config.RERANK_ENABLED, "rerank_candidates": Config.RERANK_CANDIDATES,
+        },
+    }
+    try:
+        results["prompt"] = run_prompt_benchmark(seed=seed)
+        results["rerank"] = run_rerank_benchmark(candidates=Config.RERANK_CANDIDATES, top_k=top_k, seed=seed)
+        corpus_start = time.perf_counter()
+        corpus = generate_corpus(data_path, images_per_split, image_size, seed)
+        results["corpus"] = {"images": corpus["images"], "seconds": round(time.perf_counter() - corpus_start, 4)}
+
+        with StubLLMServer(latency=llm_latency, tokens=llm_tokens) as llm, \
+                override_attributes(Config, DATA_PATH=data_path, QDRANT_URL=None, QDRANT_PATH=index_path,
+                                    TEMP_DIR=temp_path, INDEX_MANIFEST_PATH=None, INGEST_SHARD=None,
+                                    GROQ_BASE_URL=llm.base_url, GROQ_API_KEY="benchmark", GROQ_FALLBACK_MODELS=[],
+                                    GROQ_REQUESTS_PER_MINUTE=None, GROQ_TOKENS_PER_MINUTE=None,
+                                    RESPONSE_CACHE_ENABLED=False), \
+                override_attributes(create_data_embeddings, DATA_PATH=data_path, SAMPLE_RATE=1.0):
+            telemetry.registry.reset()
+            client, results["ingest"] = run_ingest_benchmark(COLLECTION_NAME)
+            # The search numbers include the CLIP forward pass on every call, as they did before query embeddings
+            # were cached; "search_cached" repeats them with the cache on, so only the first pass embeds
+            with override_attributes(query_embedding_cache, max_entries=0):
+                results["search"] = run_search_benchmark(client, COLLECTION_NAME, corpus["queries"],
+                                                         corpus["query_images"], repeat, top_k)
+            query_embedding_cache.clear()
+            results["search_cached"] = run_search_benchmark(client, COLLECTION_NAME, corpus["queries"],
+                                                            corpus["query_images"], repeat, top_k)
+            results["search_cached"]["query_embedding_cache"] = query_embedding_cache.stats()
+            query_embedding_cache.clear()
+
+            system = MultimodalRAGSystem(qdrant_client=client, warmup=False)
+            try:
+                results["generation"] = run_query_benchmark(system, corpus["queries"], corpus["query_images"],
+                                                            query_repeat, top_k)
+            finally:
+                system.retrieval_pool.shutdown(wait=False)
+            results["generation"]["query_embedding_cache"] = query_embedding_cache.stats()
+            # Where the time went, per traced stage across all of the runs above
+            results["stages"] = telemetry.registry.snapshot()["histograms"]
+            client.close()
+    finally:
+        if owns_workdir and not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare_results(baseline, current, tolerance=0.10):
+    # Lists metrics that got worse by more than `tolerance`: latencies and seconds going up, throughput going down
+    regressions = []
+
+    def walk(base, value, path):
+        if isinstance(base, dict) and isinstance(value, dict):
+            for key in base.keys() & value.keys():
+                walk(base[key], value[key], f"{path}.{key}" if path else key)
+            return
+        if not isinstance(base, (int, float)) or not isinstance(value, (int, float)) or not base:
+            return
+        if path.endswith("_ms") or path.endswith("seconds"):
+            change = value / base - 1
+        elif path.endswith("per_second"):
+            change = base / value - 1 if value else float("inf")
+        else:
+            return
+        if change > tolerance:
+            regressions.append(f"{path}: {base} -> {value} ({change:+.0%})")
+
+    for section in ("prompt", "rerank", "ingest", "search", "search_cached", "generation"):
+        walk(baseline.get(section, {}), current.get(section, {}), section)
+    return sorted(regressions)
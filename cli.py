@@ -0,0 +1,318 @@
+## cli.py
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from config import Config
+
+# Subcommands import what they need inside their handler: `status` only touches the index and manifest,
+# `query` adds the embedding models and the LLM client, and only `serve` pulls in Gradio.
+
+# Same as create_data_embeddings.SAMPLING_STRATEGIES, repeated so parsing the command line imports nothing
+SAMPLING_STRATEGIES = ("uniform", "stratified")
+# Same as multimodal_rag_system.COLLECTION_NAME, repeated so `status` does not import the retrieval stack
+COLLECTION_NAME = "medical_images_text"
+
+
+def cmd_ingest(args):
+    from src.create_data_embeddings import create_embeddings, merge_shards
+    from src.multimodal_rag_system import COLLECTION_NAME
+
+    start_time = time.time()
+    if args.merge:
+        merge_shards(COLLECTION_NAME, args.merge)
+    else:
+        create_embeddings(COLLECTION_NAME, rebuild=args.rebuild, refresh=True, shard=args.shard, seed=args.seed,
+                          strategy=args.strategy)
+    print(f"Ingest finished in {time.time() - start_time:.2f} seconds")
+    return 0
+
+
+def open_system(warmup=False):
+    # Query-side commands only ever open an existing index; building one is the job of `ingest`
+    from src.create_data_embeddings import open_index
+    from src.multimodal_rag_system import MultimodalRAGSystem, COLLECTION_NAME
+
+    client = open_index(COLLECTION_NAME)
+    if client is None:
+        print(f"ERROR: No persisted index found for collection {COLLECTION_NAME}. Run `ingest` first.")
+        return None
+    return MultimodalRAGSystem(qdrant_client=client, warmup=warmup)
+
+
+def cmd_query(args):
+    from src.api_server import format_hit
+
+    system = open_system()
+    if system is None:
+        return 1
+
+    filters = {"split": args.split, "modality": args.modality, "body_region": args.body_region}
+    if args.retrieve_only:
+        results, _ = system.retrieve(args.text, args.image, top_k=args.top_k, filters=filters)
+        print(json.dumps([format_hit(hit) for hit in results], indent=2))
+        return 0
+
+    if args.stream:
+        for kind, text in system.process_query_stream(args.text, args.image, top_k=args.top_k, filters=filters):
+            if kind == "token":
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                print(text, file=sys.stderr)
+        print()
+    else:
+        print(system.process_query(args.text, args.image, top_k=args.top_k, filters=filters))
+
+    if args.trace:
+        from src import telemetry
+
+        print(json.dumps(telemetry.snapshot(trace_count=1)["recent_traces"], indent=2), file=sys.stderr)
+    return 0
+
+
+def cmd_serve(args):
+    from src.main import launch
+
+    if args.metrics_port:
+        Config.METRICS_PORT = args.metrics_port
+    launch(server_name=args.host, server_port=args.port, concurrency=args.concurrency)
+    return 0
+
+
+def cmd_serve_api(args):
+    from src.api_server import serve_api
+
+    serve_api(host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def cmd_loadtest(args):
+    # Starts the API server once per worker count against the configured shared index; answers come from a stub LLM
+    from src.load_test import run_load_test
+
+    worker_counts = [int(count) for count in args.workers.split(",")]
+    results = run_load_test(worker_counts=worker_counts, clients=args.clients, duration=args.duration,
+                            mode=args.mode, top_k=args.top_k, port=args.port, llm_latency=args.llm_latency,
+                            seed=args.seed)
+    for run in results["runs"]:
+        print(f"{run['workers']:>3} worker(s): {run['qps']:>9.2f} QPS  x{run['speedup']:<5}  "
+              f"p50 {run['latency']['p50_ms']} ms  p95 {run['latency']['p95_ms']} ms  errors {run['errors']}",
+              file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+        print(f"Load test results written to {args.output}")
+    else:
+        print(output)
+    return 0
+
+
+def cmd_bench(args):
+    # Synthetic corpus, fresh index and a local stub LLM; the configured index and the Groq API are not touched.
+    # `bench storage` is the exception: it measures every storage profile on temporary copies of the index.
+    from src.benchmarks import run_benchmarks, run_prompt_benchmark, compare_results
+
+    if args.suite == "storage":
+        from src.create_data_embeddings import open_index
+        from src.storage_report import recall_memory_report
+
+        client = open_index(COLLECTION_NAME)
+        if client is None:
+            print(f"ERROR: No persisted index found for collection {COLLECTION_NAME}. Run `ingest` first.")
+            return 1
+        results = recall_memory_report(client, COLLECTION_NAME, sample_size=args.sample_size, limit=args.recall_k,
+                                       max_points=args.max_points)
+    elif args.prompt_only:
+        results = {"prompt": run_prompt_benchmark(iterations=args.repeat * 200, seed=args.seed)}
+    else:
+        results = run_benchmarks(images_per_split=args.scale, image_size=args.image_size, repeat=args.repeat,
+                                 query_repeat=args.query_repeat, top_k=args.top_k, llm_latency=args.llm_latency,
+                                 seed=args.seed, workdir=args.workdir, keep=args.keep)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+        print(f"Benchmark results written to {args.output}")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            regressions = compare_results(json.load(baseline_file), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+def cmd_status(args):
+    from src.index_files import is_persistent_index, load_manifest, count_local_points
+
+    status = {"collection": COLLECTION_NAME, "storage_profile": Config.STORAGE_PROFILE,
+              "index": Config.QDRANT_URL or Config.QDRANT_PATH or "in-memory"}
+    if Config.SNAPSHOT_PATH:
+        from src.snapshot import load_snapshot_manifest
+
+        snapshot_manifest = load_snapshot_manifest(Config.SNAPSHOT_PATH)
+        status["snapshot"] = {key: snapshot_manifest[key] for key in ("collection_name", "count", "dtype", "models")}
+        status["snapshot"]["path"] = Config.SNAPSHOT_PATH
+    if not is_persistent_index():
+        status["error"] = "No persistent index configured (set QDRANT_URL or QDRANT_PATH)"
+        print(json.dumps(status, indent=2))
+        return 1
+
+    manifest = load_manifest(COLLECTION_NAME)
+    if manifest is not None:
+        status["manifest"] = {
+            "complete": manifest.get("complete", False),
+            "images": len(manifest.get("images", {})),
+            "models": manifest.get("models"),
+            "sampling": manifest.get("sampling"),
+            "created_at": manifest.get("created_at"),
+        }
+    # Reports on whatever is on disk, even an incomplete build, and never embeds anything. A local index is read
+    # from its files, so qdrant_client (and with it fastembed and ONNX Runtime) is only imported for a server.
+    if Config.QDRANT_URL:
+        from src.create_data_embeddings import get_qdrant_client
+
+        client = get_qdrant_client()
+        if client.collection_exists(COLLECTION_NAME):
+            status["points"] = client.count(COLLECTION_NAME).count
+            status["collection_status"] = str(client.get_collection(COLLECTION_NAME).status)
+        else:
+            status["points"] = None
+    else:
+        status["points"] = count_local_points(Config.QDRANT_PATH, COLLECTION_NAME)
+    print(json.dumps(status, indent=2, default=str))
+    return 0
+
+
+def cmd_snapshot(args):
+    from src.create_data_embeddings import open_index, import_snapshot
+    from src.multimodal_rag_system import COLLECTION_NAME
+    from src.snapshot import SnapshotIndex, export_snapshot, recall_against_snapshot
+
+    if args.action == "import":
+        client = import_snapshot(COLLECTION_NAME, args.path)
+        print(f"Imported {client.count(COLLECTION_NAME).count} points from {args.path}")
+        return 0
+
+    if args.action == "verify":
+        # Compare the vector database with the snapshot, never the snapshot with itself
+        Config.SNAPSHOT_PATH = None
+    client = open_index(COLLECTION_NAME)
+    if client is None:
+        print(f"ERROR: No persisted index found for collection {COLLECTION_NAME}. Run `ingest` first.")
+        return 1
+    if args.action == "export":
+        manifest = export_snapshot(client, COLLECTION_NAME, args.path, dtype=args.dtype)
+        print(f"Exported {manifest['count']} points ({manifest['dtype']}) to {args.path}")
+        return 0
+    recall = recall_against_snapshot(client, COLLECTION_NAME, SnapshotIndex(args.path, COLLECTION_NAME),
+                                     sample_size=args.sample, limit=args.limit)
+    print(json.dumps({"profile": Config.STORAGE_PROFILE, f"recall@{args.limit}": recall}, indent=2))
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Multimodal medical assistant")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="Build or refresh the vector index")
+    ingest.add_argument("--shard", help="Ingest only shard i of N, given as i/N")
+    ingest.add_argument("--seed", type=int, help="Sampling seed (default: Config.SAMPLE_SEED)")
+    ingest.add_argument("--strategy", choices=SAMPLING_STRATEGIES, help="Sampling strategy")
+    ingest.add_argument("--rebuild", action="store_true", help="Drop the index and re-embed everything")
+    ingest.add_argument("--merge", type=int, metavar="N", help="Merge the output of N shard runs")
+    ingest.set_defaults(handler=cmd_ingest)
+
+    query = subparsers.add_parser("query", help="Answer one question against the persisted index")
+    query.add_argument("text", help="Question to ask")
+    query.add_argument("--image", help="Optional query image path")
+    query.add_argument("--top-k", type=int, default=3, help="Results per retrieval channel")
+    query.add_argument("--stream", action="store_true", help="Print the answer as it is generated")
+    query.add_argument("--retrieve-only", action="store_true", help="Print the retrieved references as JSON")
+    query.add_argument("--split", action="append", help="Only use references from this split (repeatable)")
+    query.add_argument("--modality", action="append", help="Only use references of this modality, e.g. CT (repeatable)")
+    query.add_argument("--body-region", action="append", help="Only use references of this body region (repeatable)")
+    query.add_argument("--trace", action="store_true", help="Print the per-stage timings of the query to stderr")
+    query.set_defaults(handler=cmd_query)
+
+    serve = subparsers.add_parser("serve", help="Start the Gradio app with a warm index")
+    serve.add_argument("--host", help="Interface to bind (default: Gradio's)")
+    serve.add_argument("--port", type=int, help="Port to listen on (default: Gradio's)")
+    serve.add_argument("--concurrency", type=int, help="Concurrent requests (default: Config.GRADIO_CONCURRENCY)")
+    serve.add_argument("--metrics-port", type=int, help="Serve /metrics and /metrics.json on this port")
+    serve.set_defaults(handler=cmd_serve)
+
+    serve_api = subparsers.add_parser("serve-api", help="Serve a JSON API from N workers sharing one index")
+    serve_api.add_argument("--host", help="Interface to bind (default: Config.API_HOST)")
+    serve_api.add_argument("--port", type=int, help="Port to listen on (default: Config.API_PORT)")
+    serve_api.add_argument("--workers", type=int, help="Worker processes (default: Config.API_WORKERS)")
+    serve_api.set_defaults(handler=cmd_serve_api)
+
+    loadtest = subparsers.add_parser("loadtest", help="Measure API throughput for several worker counts")
+    loadtest.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to compare")
+    loadtest.add_argument("--clients", type=int, default=16, help="Concurrent keep-alive clients")
+    loadtest.add_argument("--duration", type=float, default=15, help="Seconds of load per worker count")
+    loadtest.add_argument("--mode", choices=("retrieve", "query"), default="retrieve",
+                          help="retrieve only, or full answers from a stub LLM")
+    loadtest.add_argument("--top-k", type=int, default=3, help="Results per retrieval channel")
+    loadtest.add_argument("--port", type=int, default=8765, help="Port for the API server under test")
+    loadtest.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the stub LLM takes to answer")
+    loadtest.add_argument("--seed", type=int, default=0, help="Seed for the synthetic questions")
+    loadtest.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    loadtest.set_defaults(handler=cmd_loadtest)
+
+    bench = subparsers.add_parser("bench", help="Benchmark ingest, search and generation on a synthetic corpus")
+    bench.add_argument("suite", nargs="?", choices=("pipeline", "storage"), default="pipeline",
+                       help="pipeline: the synthetic benchmarks; storage: recall and memory of every storage profile "
+                            "on the configured index")
+    bench.add_argument("--scale", type=int, default=100, help="Synthetic images per split")
+    bench.add_argument("--image-size", type=int, default=256, help="Side of the synthetic images in pixels")
+    bench.add_argument("--repeat", type=int, default=10, help="Passes over the queries for the search benchmarks")
+    bench.add_argument("--query-repeat", type=int, default=3, help="Passes over the queries for process_query")
+    bench.add_argument("--top-k", type=int, default=3, help="Results per retrieval channel")
+    bench.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the stub LLM takes to answer")
+    bench.add_argument("--seed", type=int, default=0, help="Seed for the synthetic corpus")
+    bench.add_argument("--workdir", help="Directory for the corpus and index (default: a temporary directory)")
+    bench.add_argument("--keep", action="store_true", help="Keep the temporary corpus and index")
+    bench.add_argument("--prompt-only", action="store_true", help="Only benchmark prompt assembly (no models)")
+    bench.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    bench.add_argument("--compare", metavar="BASELINE", help="Fail if results regress against a saved JSON run")
+    bench.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression for --compare")
+    bench.add_argument("--sample-size", type=int, default=50, help="storage: stored vectors used as queries")
+    bench.add_argument("--recall-k", type=int, default=10, help="storage: k of the measured recall@k")
+    bench.add_argument("--max-points", type=int, help="storage: copy only this many points per profile")
+    bench.set_defaults(handler=cmd_bench)
+
+    snapshot = subparsers.add_parser("snapshot", help="Export, import or check a memory-mapped embedding snapshot")
+    snapshot.add_argument("action", choices=("export", "import", "verify"),
+                          help="export the index, import a snapshot into it, or measure the index's recall against it")
+    snapshot.add_argument("path", help="Snapshot directory")
+    snapshot.add_argument("--dtype", choices=("float32", "float16"),
+                          help="Vector dtype for export (default: Config.SNAPSHOT_DTYPE)")
+    snapshot.add_argument("--sample", type=int, default=50, help="Query vectors sampled by verify")
+    snapshot.add_argument("--limit", type=int, default=10, help="Results per query compared by verify")
+    snapshot.set_defaults(handler=cmd_snapshot)
+
+    status = subparsers.add_parser("status", help="Show index, manifest and collection status")
+    status.set_defaults(handler=cmd_status)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # serve keeps the Gradio app's own logging setup (console plus app.log)
+    if args.command != "serve":
+        logging.basicConfig(level=Config.LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
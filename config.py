@@ -1,27 +1,126 @@
-## config.py
-
-class Config:
-    # API keys
-    GROQ_API_KEY = "YOUR API KEY"
-
-    # # Optional: Keep OpenAI API key as fallback or for comparison
-    # OPENAI_API_KEY = "your-openai-api-key-here"
-
-    # API endpoints
-    GROQ_API_ENDPOINT = "https://api.groq.com/openai/v1/chat/completions"
-
-    # Model settings - Make sure to use the same model name throughout the codebase
-    # GROQ_MODEL = "llama3-70b-8192-vision"  # Updated to match groq_utils.py
-    GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"  # or another available model
-
-    # Response settings
-    MAX_TOKENS = 600
-    TEMPERATURE = 0.7  # Optional: Controls randomness in responses
-
-    # Application settings
-    DEBUG = True  # Enable/disable debug mode
-    TIMEOUT = 60  # Increased API request timeout in seconds
-
-    # Paths
-    DATA_PATH = 'D:/project/data/rocov2/'  # Make sure this path exists
-    TEMP_DIR = 'D:/project/temp/'  # Make sure this path exists
+## config.py
+
+class Config:
+    # API keys
+    GROQ_API_KEY = "YOUR API KEY"
+
+    # # Optional: Keep OpenAI API key as fallback or for comparison
+    # OPENAI_API_KEY = "your-openai-api-key-here"
+
+    # API endpoints
+    GROQ_API_ENDPOINT = "https://api.groq.com/openai/v1/chat/completions"
+    GROQ_BASE_URL = None  # Override the Groq API base URL (e.g. "http://127.0.0.1:8000" for a local fake server)
+
+    # Model settings - Make sure to use the same model name throughout the codebase
+    # GROQ_MODEL = "llama3-70b-8192-vision"  # Updated to match groq_utils.py
+    GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"  # or another available model
+    GROQ_FALLBACK_MODELS = []  # Models to fail over to, in order, when GROQ_MODEL keeps failing
+
+    # Groq client connection, concurrency and retry settings
+    GROQ_MAX_CONNECTIONS = 20  # Pooled keep-alive HTTP connections
+    GROQ_KEEPALIVE_EXPIRY = 30  # Seconds an idle connection is kept open
+    GROQ_MAX_CONCURRENCY = 8  # Requests in flight at once (streams hold their slot until finished)
+    GROQ_REQUESTS_PER_MINUTE = 30  # Pacing for the requests/min limit, charged per HTTP attempt (None = unlimited)
+    GROQ_TOKENS_PER_MINUTE = None  # Pacing for the tokens/min limit (None = unlimited)
+    GROQ_IMAGE_TOKEN_ESTIMATE = 1500  # Tokens assumed per image when estimating request size
+    GROQ_MAX_RETRIES = 4  # Retries per model for 429, 5xx, timeouts and connection errors
+    GROQ_RETRY_BASE_DELAY = 0.5  # Seconds; doubled on every retry, with full jitter
+    GROQ_RETRY_MAX_DELAY = 20  # Longest wait before failing over to the next model instead
+
+    # Response settings
+    MAX_TOKENS = 600
+    TEMPERATURE = 0.7  # Optional: Controls randomness in responses
+    STREAM_RESPONSES = True  # Stream tokens to the UI as they are generated
+
+    # Prompt assembly (input side; MAX_TOKENS above only bounds the output)
+    PROMPT_INPUT_TOKEN_BUDGET = 3000  # Instructions, question, image and references; references are cut to fit
+    PROMPT_REFERENCE_MAX_TOKENS = 200  # Longer reference captions are truncated
+    PROMPT_USE_SYSTEM_MESSAGE = True  # Fixed instructions as a system message (False = prefix of the user message)
+    TOKENIZER_ENCODING = "cl100k_base"  # tiktoken encoding for local token counts (~4 chars/token without tiktoken)
+
+    # User image payload sent to the LLM (the CLIP embedding always uses the full decoded image)
+    LLM_IMAGE_MAX_SIDE = 1024  # Longest side in pixels after downscaling
+    LLM_IMAGE_QUALITY = 85  # Starting JPEG quality
+    LLM_IMAGE_MAX_BYTES = 512 * 1024  # Quality is lowered until the JPEG fits
+
+    # Application settings
+    DEBUG = True  # Enable/disable debug mode
+    TIMEOUT = 60  # Increased API request timeout in seconds
+    GRADIO_CONCURRENCY = 16  # Requests the Gradio queue processes at the same time
+
+    # JSON API server (`cli.py serve-api`): stateless worker processes forked after the models and index are loaded
+    API_HOST = "127.0.0.1"
+    API_PORT = 8000
+    API_WORKERS = 1  # Worker processes sharing one listening socket; more than one needs QDRANT_URL or SNAPSHOT_PATH
+    API_WORKER_THREADS = 1  # ONNX threads per model in each worker when API_WORKERS > 1 (workers x threads ~ cores)
+    API_MAX_TOP_K = 20  # Upper bound for top_k in API requests (results per retrieval channel)
+
+    # Logging, tracing and metrics
+    LOG_LEVEL = "INFO"  # "DEBUG" adds per-request details and one JSON line per traced span
+    TELEMETRY_ENABLED = True  # Per-stage spans, counters and histograms (False = instrumentation is a no-op)
+    TELEMETRY_TRACE_BUFFER = 100  # Recent request traces kept for the Diagnostics tab and /metrics.json
+    METRICS_PORT = None  # Serve /metrics (Prometheus text) and /metrics.json on this port (None = off)
+    METRICS_HOST = "127.0.0.1"
+
+    # Embedding settings
+    EMBEDDING_THREADS = None  # ONNX intra-op threads per model (None = fastembed default)
+    WARMUP_MODELS = True  # Load and warm up embedding models at startup
+    QUERY_EMBEDDING_CACHE_SIZE = 2048  # Cached query embeddings, keyed on normalized text or image pixels (0 = off)
+    PRELOAD_QUERIES = []  # Frequent queries embedded at startup, so their first use is already a cache hit
+    PRELOAD_QUERIES_PATH = None  # Text file with one frequent query per line, added to PRELOAD_QUERIES
+
+    # Retrieval settings
+    RETRIEVAL_WORKERS = 8  # Threads shared by the concurrent text/image search branches
+    RETRIEVAL_TIMEOUT = 10  # Seconds to wait for all search branches of a query; branches still running are left out
+    LLM_CONCURRENCY = 4  # Concurrent LLM calls for batched queries (process_queries)
+
+    # Result fusion settings (text and image hits are deduplicated and fused before prompting)
+    FUSION_METHOD = "rrf"  # "rrf" (reciprocal-rank fusion) or "weighted" (normalized score sum)
+    RRF_K = 60  # Rank offset for reciprocal-rank fusion
+    FUSION_TEXT_WEIGHT = 1.0
+    FUSION_IMAGE_WEIGHT = 1.0
+    FUSION_LEXICAL_WEIGHT = 1.0
+    FUSION_MIN_SCORE = 0.2  # Minimum cosine similarity for a hit to be considered (None = keep all)
+    FUSION_MAX_RESULTS = 4  # References passed to the LLM
+
+    # Cross-modal reranking of over-fetched candidates (stored vectors only, no extra model inference)
+    RERANK_ENABLED = True
+    RERANK_CANDIDATES = 100  # Candidates fetched per vector search before reranking down to top_k
+    RERANK_CROSS_WEIGHT = 0.5  # Share of the cross-modal similarity in the rerank score (0 = same modality only)
+
+    # Lexical (BM25) caption search, fused with the dense text and image searches
+    LEXICAL_SEARCH_ENABLED = True
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    # LLM response cache settings
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_SIZE = 1024  # Maximum cached responses (least recently used are evicted)
+    RESPONSE_CACHE_TTL = 3600  # Seconds a cached response stays valid
+    RESPONSE_CACHE_SEMANTIC_THRESHOLD = None  # e.g. 0.97 to reuse answers for near-identical queries
+    RESPONSE_CACHE_PATH = None  # SQLite file to persist the cache across restarts (None = memory only)
+
+    # Sampling and sharding settings (the sample rate itself is SAMPLE_RATE in create_data_embeddings.py)
+    SAMPLE_SEED = 42  # Same seed, same data -> same sample on every machine
+    SAMPLING_STRATEGY = "uniform"  # "uniform" or "stratified" (per split and inferred modality)
+    INGEST_SHARD = None  # "i/N" to ingest one hash partition of the sample on this machine
+
+    # Ingest pipeline settings
+    INGEST_BATCH_SIZE = 50  # Documents per embedding/upsert batch
+    INGEST_WORKERS = None  # Image loader processes (None = number of CPU cores)
+    INGEST_QUEUE_SIZE = 4  # Batches allowed in flight between pipeline stages
+    INGEST_PRELOAD_SIZE = 224  # Shrink images to the CLIP input size while loading (None = keep full size)
+
+    # Paths
+    DATA_PATH = 'D:/project/data/rocov2/'  # Make sure this path exists
+    TEMP_DIR = 'D:/project/temp/'  # Make sure this path exists
+
+    # Vector index settings
+    # QDRANT_URL takes precedence, then QDRANT_PATH (local on-disk index); if both are None the
+    # index is rebuilt in memory on every start
+    QDRANT_URL = None  # e.g. "http://localhost:6333"
+    QDRANT_PATH = 'D:/project/index/'
+    INDEX_MANIFEST_PATH = None  # Defaults to <QDRANT_PATH>/<collection>_manifest.json
+    SNAPSHOT_PATH = None  # Serve retrieval from an exported embedding snapshot (exact NumPy search) instead of Qdrant
+    SNAPSHOT_DTYPE = "float32"  # Vector dtype of exported snapshots: "float32" or "float16" (half the size)
+    STORAGE_PROFILE = "default"  # "default" (float32 in RAM), "compact" (int8 + on-disk originals), "minimal" (binary)
@@ -1,191 +1,795 @@
-## create_data_embeddings.py
-
-import os
-import uuid
-import pandas as pd
-import random
-from fastembed import TextEmbedding, ImageEmbedding
-from qdrant_client import QdrantClient, models
-from src.embeddings_utils import convert_text_to_embeddings, convert_image_to_embeddings, TEXT_MODEL_NAME, \
-    IMAGE_MODEL_NAME
-from config import Config
-
-# Get base data path from config
-DATA_PATH = Config.DATA_PATH
-
-# Set sampling rate
-SAMPLE_RATE = 0.5  # Use 10% of the data
-
-
-def create_uuid_from_image_id(image_id):
-    NAMESPACE_UUID = uuid.UUID('12345678-1234-5678-1234-567812345678')
-    return str(uuid.uuid5(NAMESPACE_UUID, image_id))
-
-
-def create_embeddings(collection_name):
-    print(f"Creating/loading embeddings for collection: {collection_name}")
-    print(f"Using data path: {DATA_PATH}")
-
-    # Check if data path exists
-    if not os.path.exists(DATA_PATH):
-        print(f"ERROR: Data path does not exist: {DATA_PATH}")
-        return QdrantClient(":memory:")  # Return empty client
-
-    # Initialize list to store all image documents from different splits
-    all_image_docs = []
-
-    # Process each data split: test, train, validation
-    for split in ['test', 'train', 'valid']:
-        # Define paths for images and captions
-        images_folder = 'test_images' if split == 'test' else ('train_images' if split == 'train' else 'valid_images')
-        images_path = os.path.join(DATA_PATH, images_folder, split)
-        caption_file = os.path.join(DATA_PATH, f"{split}_captions.csv")  # Assuming naming convention
-
-        # Skip if path doesn't exist
-        if not os.path.exists(caption_file):
-            print(f"Skipping {split} - caption file not found: {caption_file}")
-            continue
-
-        if not os.path.exists(images_path):
-            print(f"Skipping {split} - images directory not found: {images_path}")
-            continue
-
-        # Read captions
-        try:
-            # First try with column names 'ID' and 'Caption' as mentioned in your feedback
-            caption_df = pd.read_csv(caption_file)
-            print(f"Read caption file: {caption_file}, shape: {caption_df.shape}")
-            # Check if we have the expected columns and rename if needed
-            if 'ID' in caption_df.columns and 'Caption' in caption_df.columns:
-                # Rename to match our expected column names
-                caption_df = caption_df.rename(columns={'ID': 'image_id', 'Caption': 'caption'})
-                print("Renamed columns 'ID' to 'image_id' and 'Caption' to 'caption'")
-            elif 'image_id' not in caption_df.columns or 'caption' not in caption_df.columns:
-                print(f"CSV file {caption_file} does not have expected columns. Adjusting...")
-                # Try to infer column names based on the first few rows
-                caption_df = pd.read_csv(caption_file, header=None)
-                if len(caption_df.columns) >= 2:
-                    caption_df.columns = ['image_id', 'caption'] + [f'col_{i}' for i in
-                                                                    range(2, len(caption_df.columns))]
-                    print(f"Inferred column names from header-less CSV: {caption_df.columns}")
-                else:
-                    print(f"Cannot process {caption_file} - not enough columns")
-                    continue
-        except Exception as e:
-            print(f"Error reading captions from {caption_file}: {e}")
-            continue
-
-        # Get list of available images
-        try:
-            image_files = os.listdir(images_path)
-            print(f"Found {len(image_files)} images in {images_path}")
-            # Randomly sample images
-            sampled_image_files = random.sample(image_files, max(1, int(len(image_files) * SAMPLE_RATE)))
-            print(f"Sampled {len(sampled_image_files)} out of {len(image_files)} images for {split}")
-        except Exception as e:
-            print(f"Error listing or sampling images in {images_path}: {e}")
-            continue
-
-        # Match images with captions
-        image_docs_for_split = []
-        for image_file in sampled_image_files:
-            # Extract image_id from filename (assuming format like "image_id.jpg")
-            image_id = image_file.split('.')[0]
-
-            # Check if this image_id has a caption
-            if image_id in caption_df['image_id'].values:
-                caption = caption_df[caption_df['image_id'] == image_id]['caption'].values[0]
-                image_path = os.path.join(images_path, image_file)
-
-                # Check if image file exists
-                if not os.path.exists(image_path):
-                    print(f"WARNING: Image file does not exist: {image_path}")
-                    continue
-
-                # Add to our documents
-                image_docs_for_split.append({
-                    'image_id': image_id,
-                    'caption': caption,
-                    'image_path': image_path,
-                    'split': split
-                })
-
-        print(f"Found {len(image_docs_for_split)} matching sampled images in {split}")
-        all_image_docs.extend(image_docs_for_split)
-
-    print(f"Total sampled images found across all splits: {len(all_image_docs)}")
-
-    # If no images found, return empty client
-    if len(all_image_docs) == 0:
-        print("WARNING: No images found. Check your data paths and file structure.")
-        return QdrantClient(":memory:")
-
-    # Process in batches to avoid memory issues
-    batch_size = 50  # Reduce batch size to avoid memory issues
-
-    # Initialize client
-    client = QdrantClient(":memory:")
-    print("Initialized Qdrant client in memory")
-
-    # Define vector dimensions for CLIP models (we know these dimensions)
-    # CLIP ViT-B-32 has 512-dimensional embeddings for both text and images
-    text_embeddings_size = 512
-    image_embeddings_size = 512
-
-    # Create collection if it doesn't exist
-    if not client.collection_exists(collection_name):
-        print(f"Creating new collection: {collection_name}")
-        client.create_collection(
-            collection_name=collection_name,
-            vectors_config={
-                "image": models.VectorParams(size=image_embeddings_size, distance=models.Distance.COSINE),
-                "text": models.VectorParams(size=text_embeddings_size, distance=models.Distance.COSINE),
-            }
-        )
-    else:
-        print(f"Collection {collection_name} already exists")
-
-    # Process in batches
-    for i in range(0, len(all_image_docs), batch_size):
-        batch = all_image_docs[i:i + batch_size]
-        print(f"Processing batch {i // batch_size + 1} of {(len(all_image_docs) + batch_size - 1) // batch_size}")
-
-        # Extract captions and image paths
-        captions = [doc['caption'] for doc in batch]
-        image_paths = [doc['image_path'] for doc in batch]
-
-        try:
-            # Generate embeddings
-            caption_embeddings = convert_text_to_embeddings(captions)
-            image_embeddings = convert_image_to_embeddings(image_paths)
-
-            # Create points for upload
-            points = []
-            for j, doc in enumerate(batch):
-                points.append(
-                    models.PointStruct(
-                        id=create_uuid_from_image_id(doc['image_id']),
-                        vector={
-                            "text": caption_embeddings[j],
-                            "image": image_embeddings[j],
-                        },
-                        payload={
-                            "image_id": doc['image_id'],
-                            "caption": doc['caption'],
-                            "image_path": doc['image_path'],
-                            "split": doc['split']
-                        }
-                    )
-                )
-
-            # Upload batch
-            client.upload_points(collection_name=collection_name, points=points)
-            print(f"Successfully uploaded batch {i // batch_size + 1}")
-        except Exception as e:
-            print(f"ERROR processing batch {i // batch_size + 1}: {str(e)}")
-            continue
-
-    # Check final collection size
-    count = client.count(collection_name).count
-    print(f"Final collection size: {count} points")
-    return client
\ No newline at end of file
+## create_data_embeddings.py
+
+import os
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+from qdrant_client import QdrantClient, models
+from src.embeddings_utils import convert_text_to_embeddings, convert_image_to_embeddings, TEXT_MODEL_NAME, \
+    IMAGE_MODEL_NAME
+from src.storage_profiles import get_storage_profile, build_vectors_config, build_vectors_config_diff
+from src.lexical_index import get_lexical_index, save_lexical_index, reset_lexical_index, ensure_lexical_index, \
+    rebuild_lexical_index
+from src.snapshot import SnapshotIndex
+from src.index_files import is_persistent_index, get_manifest_path, load_manifest
+from src.facets import infer_modality, caption_facets, FACET_FIELDS, FACETS_VERSION
+from src import telemetry
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Get base data path from config
+DATA_PATH = Config.DATA_PATH
+
+# Set sampling rate
+SAMPLE_RATE = 0.5  # Use 10% of the data
+SAMPLING_STRATEGIES = ("uniform", "stratified")
+
+
+def create_uuid_from_image_id(image_id):
+    NAMESPACE_UUID = uuid.UUID('12345678-1234-5678-1234-567812345678')
+    return str(uuid.uuid5(NAMESPACE_UUID, image_id))
+
+
+def sample_key(image_id, seed):
+    # Deterministic pseudo-random rank of an image for a given seed, identical on every machine and run
+    digest = hashlib.sha1(f"{seed}:{image_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def sample_image_ids(image_ids, caption_index, seed=None, strategy=None, sample_rate=None):
+    # "uniform": the SAMPLE_RATE fraction of the split with the lowest sample keys.
+    # "stratified": the same fraction taken separately from each modality inferred from the captions, so rare
+    # modalities keep their share of the sample.
+    seed = Config.SAMPLE_SEED if seed is None else seed
+    strategy = strategy or Config.SAMPLING_STRATEGY
+    sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    if strategy not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Unknown sampling strategy: {strategy}. Available: {', '.join(SAMPLING_STRATEGIES)}")
+
+    if strategy == "uniform":
+        strata = {"all": list(image_ids)}
+    else:
+        strata = {}
+        for image_id in image_ids:
+            strata.setdefault(infer_modality(caption_index.get(image_id, "")), []).append(image_id)
+
+    sampled = []
+    for stratum_ids in strata.values():
+        stratum_ids.sort(key=lambda image_id: sample_key(image_id, seed))
+        sampled.extend(stratum_ids[:max(1, int(len(stratum_ids) * sample_rate))])
+    return sampled
+
+
+def parse_shard(shard):
+    # "i/N" (or an (i, N) tuple) -> (i, N); None means the whole corpus in one process
+    if shard is None or isinstance(shard, tuple):
+        return shard
+    index, count = (int(part) for part in str(shard).split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard spec {shard}: expected i/N with 0 <= i < N")
+    return index, count
+
+
+def in_shard(image_id, shard):
+    # Shard membership by a seed-independent hash of the image_id, so shards never overlap
+    if shard is None:
+        return True
+    index, count = shard
+    return int.from_bytes(hashlib.sha1(image_id.encode("utf-8")).digest()[:8], "big") % count == index
+
+
+def get_shard_path(shard):
+    # With a local on-disk index every shard writes its own partial index, merged later by merge_shards
+    index, count = shard
+    return os.path.join(Config.QDRANT_PATH, "shards", f"{index}-of-{count}")
+
+
+def get_qdrant_client(shard=None):
+    if Config.QDRANT_URL:
+        # Shards upsert into the same server collection in parallel; point IDs are deterministic
+        logger.info("Connecting to Qdrant server at %s", Config.QDRANT_URL)
+        return QdrantClient(url=Config.QDRANT_URL, timeout=Config.TIMEOUT)
+    if Config.QDRANT_PATH:
+        index_path = get_shard_path(shard) if shard else Config.QDRANT_PATH
+        os.makedirs(index_path, exist_ok=True)
+        logger.info("Opening local Qdrant index at %s", index_path)
+        return QdrantClient(path=index_path)
+    return QdrantClient(":memory:")
+
+
+def save_manifest(collection_name, manifest):
+    shard = manifest.get("shard")
+    manifest_path = get_manifest_path(collection_name, tuple(shard) if shard else None)
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    manifest["updated_at"] = time.time()
+    # Write to a temporary file first so an interrupted write never leaves a truncated manifest
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, manifest_path)
+
+
+def sampling_settings(seed=None, strategy=None):
+    return {"seed": Config.SAMPLE_SEED if seed is None else seed, "strategy": strategy or Config.SAMPLING_STRATEGY,
+            "rate": SAMPLE_RATE}
+
+
+def new_manifest(collection_name, shard=None, seed=None, strategy=None):
+    return {
+        "collection_name": collection_name,
+        "shard": list(shard) if shard else None,
+        "sampling": sampling_settings(seed, strategy),
+        "models": {"text": TEXT_MODEL_NAME, "image": IMAGE_MODEL_NAME},
+        "storage_profile": Config.STORAGE_PROFILE,
+        "facets": FACETS_VERSION,
+        "created_at": time.time(),
+        "images": {},
+    }
+
+
+def compute_fingerprint(image_path, caption):
+    # Content hash of the image bytes and caption; unchanged fingerprints are never re-embedded
+    hasher = hashlib.sha1()
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b""):
+            hasher.update(chunk)
+    hasher.update(b"\0")
+    hasher.update(str(caption).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def compute_caption_hash(caption):
+    return hashlib.sha1(str(caption).encode("utf-8")).hexdigest()
+
+
+def manifest_matches_models(manifest):
+    return manifest is not None and manifest.get("models") == {"text": TEXT_MODEL_NAME, "image": IMAGE_MODEL_NAME}
+
+
+def open_index(collection_name):
+    """Open a persisted collection built with the current models, or return None. Never embeds."""
+    if Config.SNAPSHOT_PATH:
+        # A memory-mapped snapshot export replaces the vector database; searches over it are exact
+        snapshot = SnapshotIndex(Config.SNAPSHOT_PATH, collection_name)
+        if not snapshot.models_match():
+            logger.warning("Snapshot %s was built with other embedding models", Config.SNAPSHOT_PATH)
+            return None
+        logger.info("Opened embedding snapshot %s (%s points)", Config.SNAPSHOT_PATH, len(snapshot))
+        return snapshot
+    if not is_persistent_index():
+        return None
+    manifest = load_manifest(collection_name)
+    if not manifest_matches_models(manifest) or not manifest.get("complete"):
+        return None
+    client = get_qdrant_client()
+    if not client.collection_exists(collection_name):
+        logger.warning("Manifest found but collection %s is missing from the index", collection_name)
+        return None
+    if manifest.get("storage_profile", "default") != Config.STORAGE_PROFILE:
+        apply_storage_profile(client, collection_name)
+        manifest["storage_profile"] = Config.STORAGE_PROFILE
+        save_manifest(collection_name, manifest)
+    if manifest.get("facets") != FACETS_VERSION:
+        backfill_facets(client, collection_name)
+        manifest["facets"] = FACETS_VERSION
+        save_manifest(collection_name, manifest)
+        save_lexical_index(collection_name)
+    return client
+
+
+def apply_storage_profile(client, collection_name):
+    # Switch an existing collection to the configured profile in place; Qdrant re-quantizes and rebuilds the
+    # HNSW graph from the stored vectors, so nothing is re-embedded
+    profile = get_storage_profile()
+    logger.info("Applying storage profile '%s' to collection %s", Config.STORAGE_PROFILE, collection_name)
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config=build_vectors_config_diff(profile),
+        collection_params=models.CollectionParamsDiff(on_disk_payload=profile["payload_on_disk"]),
+    )
+
+
+def create_collection(client, collection_name):
+    profile = get_storage_profile()
+    logger.info("Creating new collection: %s (storage profile '%s')", collection_name, Config.STORAGE_PROFILE)
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config=build_vectors_config(profile),
+        on_disk_payload=profile["payload_on_disk"],
+    )
+    create_payload_indexes(client, collection_name)
+
+
+def create_payload_indexes(client, collection_name):
+    # Keyword indexes on the facet fields, so a Qdrant server (QDRANT_URL) resolves filtered searches inside the
+    # HNSW traversal. Note: the local mode (QDRANT_PATH) ignores payload indexes and answers a filtered search with
+    # an exact scan, several times slower than an unfiltered one.
+    for field_name in FACET_FIELDS:
+        client.create_payload_index(collection_name=collection_name, field_name=field_name,
+                                    field_schema=models.PayloadSchemaType.KEYWORD)
+
+
+def backfill_facets(client, collection_name, batch_size=1000):
+    # Collections built before modality and body region were stored: derive them from the stored captions and
+    # write them with one set_payload call per facet combination (no re-embedding)
+    logger.info("Adding facet payloads to collection %s", collection_name)
+    create_payload_indexes(client, collection_name)
+    groups = {}
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset,
+                                       with_payload=['caption'], with_vectors=False)
+        for point in points:
+            facets = caption_facets((point.payload or {}).get('caption', ''))
+            groups.setdefault((facets["modality"], facets["body_region"]), []).append(point.id)
+        if offset is None:
+            break
+    for (modality, body_region), point_ids in groups.items():
+        client.set_payload(collection_name=collection_name, payload={"modality": modality, "body_region": body_region},
+                           points=point_ids)
+    # The lexical index filters on the same fields, so it is refilled from the updated payloads
+    rebuild_lexical_index(collection_name, client)
+
+
+def load_caption_index(caption_file):
+    # Returns a dict of image_id -> caption, or None if the file cannot be used
+    import pandas as pd  # Only ingest reads the CSV files; keep pandas out of query/status start-up
+
+    try:
+        # First try with column names 'ID' and 'Caption' as mentioned in your feedback
+        caption_df = pd.read_csv(caption_file)
+        logger.info("Read caption file: %s, shape: %s", caption_file, caption_df.shape)
+        # Check if we have the expected columns and rename if needed
+        if 'ID' in caption_df.columns and 'Caption' in caption_df.columns:
+            # Rename to match our expected column names
+            caption_df = caption_df.rename(columns={'ID': 'image_id', 'Caption': 'caption'})
+            logger.info("Renamed columns 'ID' to 'image_id' and 'Caption' to 'caption'")
+        elif 'image_id' not in caption_df.columns or 'caption' not in caption_df.columns:
+            logger.info("CSV file %s does not have expected columns. Adjusting...", caption_file)
+            # Try to infer column names based on the first few rows
+            caption_df = pd.read_csv(caption_file, header=None)
+            if len(caption_df.columns) >= 2:
+                caption_df.columns = ['image_id', 'caption'] + [f'col_{i}' for i in
+                                                                range(2, len(caption_df.columns))]
+                logger.info("Inferred column names from header-less CSV: %s", caption_df.columns)
+            else:
+                logger.warning("Cannot process %s - not enough columns", caption_file)
+                return None
+    except Exception as e:
+        logger.error("Error reading captions from %s: %s", caption_file, e)
+        return None
+
+    # Keep the first caption for duplicated ids, as the previous per-image lookup did
+    caption_df = caption_df.drop_duplicates(subset='image_id', keep='first')
+    return dict(zip(caption_df['image_id'].astype(str), caption_df['caption']))
+
+
+def scan_image_dir(images_path):
+    # One os.scandir pass; entries are known to exist, so no per-file os.path.exists calls
+    image_index = {}
+    with os.scandir(images_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                # Extract image_id from filename (assuming format like "image_id.jpg")
+                image_index[entry.name.split('.')[0]] = entry.path
+    return image_index
+
+
+def _stat_unchanged(doc, entry):
+    # Same file size and modification time and the same caption: the stored fingerprint still holds, so the image
+    # is not read again. Manifests written before these fields existed are fingerprinted once.
+    return (entry is not None and entry.get("size") == doc['size'] and entry.get("mtime_ns") == doc['mtime_ns']
+            and entry.get("caption_hash") == doc['caption_hash'])
+
+
+def _fingerprint_doc(doc):
+    # Runs in the loader processes; returns None when the image cannot be read
+    try:
+        return compute_fingerprint(doc['image_path'], doc['caption'])
+    except OSError as e:
+        logger.warning("Could not read image %s: %s", doc['image_path'], e)
+        return None
+
+
+def _load_images(image_paths, preload_size):
+    # Runs in the loader processes: decode, convert and shrink images so the embedder only does inference.
+    # The shortest side is reduced to the CLIP input size with the same resampling the CLIP preprocessor uses.
+    # Returns (images, seconds spent loading) so the parent can account for the stage.
+    start_time = time.perf_counter()
+    images = []
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            image = image.convert("RGB")
+        if preload_size:
+            scale = preload_size / min(image.size)
+            if scale < 1:
+                new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                image = image.resize(new_size, Image.BICUBIC)
+        images.append(image)
+    return images, time.perf_counter() - start_time
+
+
+def _add_stage_time(stage_seconds, stage, seconds):
+    # Each stage is only ever timed from one thread at a time
+    stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+    telemetry.observe("ingest_stage_seconds", seconds, stage=stage)
+
+
+def _timed(stage_seconds, stage, function, *args):
+    start_time = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        _add_stage_time(stage_seconds, stage, time.perf_counter() - start_time)
+
+
+def _build_points(batch, caption_embeddings, image_embeddings):
+    points = []
+    for j, doc in enumerate(batch):
+        points.append(
+            models.PointStruct(
+                id=create_uuid_from_image_id(doc['image_id']),
+                vector={
+                    "text": caption_embeddings[j],
+                    "image": image_embeddings[j],
+                },
+                payload={
+                    "image_id": doc['image_id'],
+                    "caption": doc['caption'],
+                    "image_path": doc['image_path'],
+                    "split": doc['split'],
+                    "modality": doc['modality'],
+                    "body_region": doc['body_region'],
+                    "fingerprint": doc['fingerprint']
+                }
+            )
+        )
+    return points
+
+
+def _upload_worker(client, collection_name, upload_queue, manifest, stats):
+    # Single consumer of the upload queue; it is also the only writer of the manifest and the lexical index
+    lexical_index = get_lexical_index(collection_name)
+    while True:
+        item = upload_queue.get()
+        if item is None:
+            return
+        batch_number, batch, points = item
+        if points is None:
+            # The batch failed before upload; counted here so the stats have a single writer
+            stats["failed_batches"] += 1
+            telemetry.inc("ingest_failed_batches_total")
+            continue
+        try:
+            _timed(stats["stage_seconds"], "upload", client.upload_points, collection_name, points)
+            for doc in batch:
+                lexical_index.add(create_uuid_from_image_id(doc['image_id']), doc['caption'],
+                                  {"image_path": doc['image_path'], "caption": doc['caption'], "split": doc['split'],
+                                   "modality": doc['modality'], "body_region": doc['body_region']})
+                manifest["images"][doc['image_id']] = {
+                    "split": doc['split'],
+                    "fingerprint": doc['fingerprint'],
+                    "size": doc['size'],
+                    "mtime_ns": doc['mtime_ns'],
+                    "caption_hash": doc['caption_hash'],
+                    "text_model": TEXT_MODEL_NAME,
+                    "image_model": IMAGE_MODEL_NAME,
+                }
+            # Checkpoint after every batch so an interrupted run resumes from here
+            if is_persistent_index():
+                save_manifest(collection_name, manifest)
+            stats["uploaded"] += len(batch)
+            telemetry.inc("ingest_images_total", len(batch))
+            logger.debug("Successfully uploaded batch %s", batch_number)
+        except Exception as e:
+            # Failed documents stay out of the manifest and are retried on the next run
+            logger.error("Error uploading batch %s: %s", batch_number, e)
+            stats["failed_batches"] += 1
+            telemetry.inc("ingest_failed_batches_total")
+
+
+def run_ingest_pipeline(client, collection_name, docs, manifest, batch_size=None, workers=None, stats=None):
+    # Staged ingest: a process pool decodes images ahead of the embedder, text and image embedding run
+    # concurrently, and a background thread upserts finished batches. Queues are bounded so memory stays flat.
+    # Returns the number of failed batches. A caller-provided stats dict receives the counts and the busy seconds
+    # of every stage; stages overlap, so their sum exceeds the wall time once the pipeline is saturated.
+    batch_size = batch_size or Config.INGEST_BATCH_SIZE
+    workers = workers or Config.INGEST_WORKERS or os.cpu_count() or 1
+    max_in_flight = max(1, Config.INGEST_QUEUE_SIZE)
+    start_time = time.perf_counter()
+    stats = {} if stats is None else stats
+    stats.update(uploaded=0, failed_batches=0, workers=workers, batch_size=batch_size)
+    stage_seconds = stats.setdefault("stage_seconds", {})
+
+    with ProcessPoolExecutor(max_workers=workers) as loader_pool, ThreadPoolExecutor(max_workers=2) as embed_pool:
+        # Only embed documents that are new or whose image/caption changed since they were indexed. Only images whose
+        # size, modification time or caption changed are read and hashed, so a no-op refresh costs one stat per image.
+        fingerprint_start = time.perf_counter()
+        pending_docs = []
+        stat_changed_docs = []
+        for doc in docs:
+            try:
+                image_stat = os.stat(doc['image_path'])
+            except OSError as e:
+                logger.warning("Could not read image %s: %s", doc['image_path'], e)
+                continue
+            doc.update(size=image_stat.st_size, mtime_ns=image_stat.st_mtime_ns,
+                       caption_hash=compute_caption_hash(doc['caption']))
+            entry = manifest["images"].get(doc['image_id'])
+            if _stat_unchanged(doc, entry):
+                doc['fingerprint'] = entry["fingerprint"]
+            else:
+                stat_changed_docs.append(doc)
+        for doc, fingerprint in zip(stat_changed_docs,
+                                    loader_pool.map(_fingerprint_doc, stat_changed_docs, chunksize=64)):
+            if fingerprint is None:
+                continue
+            doc['fingerprint'] = fingerprint
+            entry = manifest["images"].get(doc['image_id'])
+            if entry is None or entry.get("fingerprint") != fingerprint:
+                pending_docs.append(doc)
+            else:
+                # Touched but identical: remember the new stat so the next run skips the hash
+                entry.update(size=doc['size'], mtime_ns=doc['mtime_ns'], caption_hash=doc['caption_hash'])
+        _add_stage_time(stage_seconds, "fingerprint", time.perf_counter() - fingerprint_start)
+        stats.update(documents=len(docs), hashed=len(stat_changed_docs), pending=len(pending_docs))
+        logger.info("%s of %s sampled images are new or changed", len(pending_docs), len(docs))
+
+        total_batches = (len(pending_docs) + batch_size - 1) // batch_size
+        upload_queue = queue.Queue(maxsize=max_in_flight)
+        uploader = threading.Thread(target=_upload_worker,
+                                    args=(client, collection_name, upload_queue, manifest, stats), daemon=True)
+        uploader.start()
+
+        def embed_batch(batch_number, batch, images_future):
+            logger.debug("Processing batch %s of %s", batch_number, total_batches)
+            try:
+                images, load_seconds = images_future.result()
+                _add_stage_time(stage_seconds, "load_images", load_seconds)
+                # Generate text and image embeddings concurrently; ONNX inference releases the GIL
+                caption_future = embed_pool.submit(_timed, stage_seconds, "embed_text", convert_text_to_embeddings,
+                                                   [doc['caption'] for doc in batch])
+                image_future = embed_pool.submit(_timed, stage_seconds, "embed_image", convert_image_to_embeddings,
+                                                 images)
+                points = _build_points(batch, caption_future.result(), image_future.result())
+            except Exception as e:
+                logger.error("Error processing batch %s: %s", batch_number, e)
+                points = None  # Counted as failed by the uploader
+            # Blocks when the uploader falls behind
+            upload_queue.put((batch_number, batch, points))
+
+        # Keep a bounded number of batches decoding ahead of the embedder
+        in_flight = deque()
+        try:
+            for i in range(0, len(pending_docs), batch_size):
+                batch = pending_docs[i:i + batch_size]
+                images_future = loader_pool.submit(_load_images, [doc['image_path'] for doc in batch],
+                                                   Config.INGEST_PRELOAD_SIZE)
+                in_flight.append((i // batch_size + 1, batch, images_future))
+                if len(in_flight) >= max_in_flight:
+                    embed_batch(*in_flight.popleft())
+            while in_flight:
+                embed_batch(*in_flight.popleft())
+        finally:
+            upload_queue.put(None)
+            uploader.join()
+
+    elapsed_time = time.perf_counter() - start_time
+    stats["elapsed_seconds"] = elapsed_time
+    logger.info("Ingested %s images in %.2f seconds (%.1f images/sec, %s loader workers)", stats['uploaded'],
+                elapsed_time, stats['uploaded'] / max(elapsed_time, 1e-9), workers)
+    return stats["failed_batches"]
+
+
+def create_embeddings(collection_name, rebuild=False, refresh=False, shard=None, seed=None, strategy=None,
+                      stats=None):
+    # rebuild: drop the persisted collection and re-embed everything
+    # refresh: sync a persisted collection with the data directory, embedding only new or changed images
+    # shard: "i/N" to ingest only the i-th of N hash partitions of the sample (see merge_shards)
+    # seed/strategy: sampling seed and strategy, defaulting to Config.SAMPLE_SEED / Config.SAMPLING_STRATEGY
+    # stats: optional dict filled with per-stage timings and counts (see run_ingest_pipeline)
+    stats = {} if stats is None else stats
+    stage_seconds = stats.setdefault("stage_seconds", {})
+    logger.info("Creating/loading embeddings for collection: %s", collection_name)
+    shard = parse_shard(shard if shard is not None else Config.INGEST_SHARD)
+
+    # Reuse a complete persisted collection if it was built with the same embedding models
+    if not rebuild and not refresh and shard is None:
+        client = open_index(collection_name)
+        if client is not None:
+            logger.info("Opened persisted collection %s (%s points)", collection_name,
+                        client.count(collection_name).count)
+            return client
+
+    logger.info("Using data path: %s", DATA_PATH)
+
+    # Check if data path exists
+    if not os.path.exists(DATA_PATH):
+        logger.error("Data path does not exist: %s", DATA_PATH)
+        return QdrantClient(":memory:")  # Return empty client
+
+    # Initialize list to store all image documents from different splits
+    all_image_docs = []
+    # Image ids in the current sample (with both an image file and a caption), per scanned split
+    sampled_ids = {}
+
+    # Process each data split: test, train, validation
+    for split in ['test', 'train', 'valid']:
+        # Define paths for images and captions
+        images_folder = 'test_images' if split == 'test' else ('train_images' if split == 'train' else 'valid_images')
+        images_path = os.path.join(DATA_PATH, images_folder, split)
+        caption_file = os.path.join(DATA_PATH, f"{split}_captions.csv")  # Assuming naming convention
+
+        # Skip if path doesn't exist
+        if not os.path.exists(caption_file):
+            logger.info("Skipping %s - caption file not found: %s", split, caption_file)
+            continue
+
+        if not os.path.exists(images_path):
+            logger.info("Skipping %s - images directory not found: %s", split, images_path)
+            continue
+
+        # Read captions into a hashed index: image_id -> caption
+        read_start = time.perf_counter()
+        caption_index = load_caption_index(caption_file)
+        if caption_index is None:
+            continue
+        read_time = time.perf_counter() - read_start
+
+        # Get available images in a single directory pass: image_id -> image path
+        try:
+            scan_start = time.perf_counter()
+            image_index = scan_image_dir(images_path)
+            scan_time = time.perf_counter() - scan_start
+            logger.info("Found %s images in %s", len(image_index), images_path)
+            # Deterministically sample images, then keep this shard's part of the sample
+            sampled_image_ids = sample_image_ids(image_index, caption_index, seed, strategy)
+            logger.info("Sampled %s out of %s images for %s", len(sampled_image_ids), len(image_index), split)
+            if shard is not None:
+                sampled_image_ids = [image_id for image_id in sampled_image_ids if in_shard(image_id, shard)]
+                logger.info("Shard %s/%s keeps %s sampled images for %s", shard[0], shard[1],
+                            len(sampled_image_ids), split)
+        except Exception as e:
+            logger.error("Error listing or sampling images in %s: %s", images_path, e)
+            continue
+
+        # Match images with captions through dict lookups instead of scanning the caption table per image
+        match_start = time.perf_counter()
+        image_docs_for_split = [
+            {
+                'image_id': image_id,
+                'caption': caption_index[image_id],
+                'image_path': image_index[image_id],
+                'split': split,
+                **caption_facets(caption_index[image_id]),
+            }
+            for image_id in sampled_image_ids if image_id in caption_index
+        ]
+        sampled_ids[split] = {doc['image_id'] for doc in image_docs_for_split}
+        match_time = time.perf_counter() - match_start
+
+        logger.info("Found %s matching sampled images in %s", len(image_docs_for_split), split)
+        logger.info("Matching timings for %s: read captions %.3fs, scan images %.3fs, join %.3fs", split,
+                    read_time, scan_time, match_time)
+        for stage, seconds in (("read_captions", read_time), ("scan_images", scan_time), ("join", match_time)):
+            _add_stage_time(stage_seconds, stage, seconds)
+        all_image_docs.extend(image_docs_for_split)
+
+    logger.info("Total sampled images found across all splits: %s", len(all_image_docs))
+
+    # If no images found, return empty client
+    if len(all_image_docs) == 0:
+        logger.warning("No images found. Check your data paths and file structure.")
+        return QdrantClient(":memory:")
+
+    # Initialize client
+    client = get_qdrant_client(shard)
+
+    # Continue from the previous (possibly interrupted) run unless the models changed or a rebuild was asked for
+    manifest = load_manifest(collection_name, shard) if is_persistent_index() else None
+    if rebuild or not manifest_matches_models(manifest) or not client.collection_exists(collection_name):
+        # Shards sharing a server collection must never drop the points written by the other shards
+        shared_collection = shard is not None and Config.QDRANT_URL
+        if client.collection_exists(collection_name) and is_persistent_index() and not shared_collection:
+            logger.info("Dropping stale collection: %s", collection_name)
+            client.delete_collection(collection_name)
+        manifest = new_manifest(collection_name, shard, seed, strategy)
+        reset_lexical_index(collection_name)
+    manifest["complete"] = False
+
+    # Create collection if it doesn't exist
+    if not client.collection_exists(collection_name):
+        try:
+            create_collection(client, collection_name)
+        except Exception as e:
+            # Another shard may have created the shared collection in the meantime
+            if not client.collection_exists(collection_name):
+                raise
+            logger.info("Collection %s was created concurrently: %s", collection_name, e)
+    else:
+        logger.info("Collection %s already exists", collection_name)
+        if manifest.get("storage_profile", "default") != Config.STORAGE_PROFILE:
+            apply_storage_profile(client, collection_name)
+            manifest["storage_profile"] = Config.STORAGE_PROFILE
+        if manifest.get("facets") != FACETS_VERSION:
+            backfill_facets(client, collection_name)
+            manifest["facets"] = FACETS_VERSION
+
+    # Remove points that are no longer in the sample of a scanned split: their image file or caption disappeared,
+    # or the sampling seed, strategy or rate changed since they were indexed
+    sampling = sampling_settings(seed, strategy)
+    if manifest.get("sampling") != sampling:
+        logger.info("Sampling changed from %s to %s", manifest.get("sampling"), sampling)
+        manifest["sampling"] = sampling
+    stale_ids = [image_id for image_id, entry in manifest["images"].items()
+                 if entry["split"] in sampled_ids and image_id not in sampled_ids[entry["split"]]]
+    if stale_ids:
+        client.delete(
+            collection_name=collection_name,
+            points_selector=models.PointIdsList(points=[create_uuid_from_image_id(i) for i in stale_ids]),
+        )
+        lexical_index = get_lexical_index(collection_name)
+        for image_id in stale_ids:
+            del manifest["images"][image_id]
+            lexical_index.remove(create_uuid_from_image_id(image_id))
+        logger.info("Deleted %s points that left the sample", len(stale_ids))
+
+    # Embed and upload new or changed documents
+    failed_batches = run_ingest_pipeline(client, collection_name, all_image_docs, manifest, stats=stats)
+
+    # Check final collection size
+    count = client.count(collection_name).count
+    logger.info("Final collection size: %s points", count)
+
+    if is_persistent_index():
+        manifest["complete"] = failed_batches == 0
+        save_manifest(collection_name, manifest)
+        # Shards only hold part of the corpus; the lexical index is rebuilt once the shards are merged
+        if shard is None:
+            save_lexical_index(collection_name)
+        logger.info("Saved index manifest to %s", get_manifest_path(collection_name, shard))
+    return client
+
+
+def find_unlisted_points(client, collection_name, image_ids, batch_size=256):
+    # IDs of the points whose image_id is not in `image_ids`
+    if not client.collection_exists(collection_name):
+        return []
+    unlisted = []
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset,
+                                       with_payload=['image_id'], with_vectors=False)
+        unlisted.extend(point.id for point in points if (point.payload or {}).get('image_id') not in image_ids)
+        if offset is None:
+            break
+    return unlisted
+
+
+def merge_shards(collection_name, shard_count, batch_size=256):
+    # Combine the output of N shard runs into the main index: partial local indexes are copied point by point
+    # (vectors and payloads, no re-embedding); with a Qdrant server the shards already upserted into the same
+    # collection and only the manifests are merged.
+    client = get_qdrant_client()
+    manifest = new_manifest(collection_name)
+    manifest["complete"] = True
+    for index in range(shard_count):
+        shard = (index, shard_count)
+        shard_manifest = load_manifest(collection_name, shard)
+        if shard_manifest is None or not manifest_matches_models(shard_manifest):
+            raise RuntimeError(f"Shard {index}/{shard_count} has no usable manifest; run it before merging")
+        manifest["images"].update(shard_manifest["images"])
+        manifest["sampling"] = shard_manifest.get("sampling", manifest["sampling"])
+        manifest["complete"] = manifest["complete"] and shard_manifest.get("complete", False)
+        if shard_manifest.get("facets") != FACETS_VERSION:
+            manifest["facets"] = None  # Backfilled the next time the index is opened
+
+        if Config.QDRANT_URL or not Config.QDRANT_PATH:
+            continue
+        if not client.collection_exists(collection_name):
+            create_collection(client, collection_name)
+        shard_client = QdrantClient(path=get_shard_path(shard))
+        try:
+            offset = None
+            copied = 0
+            while True:
+                points, offset = shard_client.scroll(collection_name=collection_name, limit=batch_size,
+                                                     offset=offset, with_payload=True, with_vectors=True)
+                if points:
+                    client.upsert(collection_name=collection_name, points=[
+                        models.PointStruct(id=point.id, vector=point.vector, payload=point.payload)
+                        for point in points
+                    ])
+                    copied += len(points)
+                if offset is None:
+                    break
+            logger.info("Merged %s points from shard %s/%s", copied, index, shard_count)
+        finally:
+            shard_client.close()
+
+    # Points of images that are in none of the shard manifests (deleted files, a changed sample, an earlier run
+    # with more shards) would otherwise stay searchable forever
+    stale_ids = find_unlisted_points(client, collection_name, manifest["images"], batch_size)
+    if stale_ids:
+        client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=stale_ids))
+        lexical_index = get_lexical_index(collection_name)
+        for point_id in stale_ids:
+            lexical_index.remove(point_id)
+        save_lexical_index(collection_name)
+        logger.info("Deleted %s points missing from the merged manifests", len(stale_ids))
+
+    save_manifest(collection_name, manifest)
+    ensure_lexical_index(collection_name, client)
+    logger.info("Merged %s shards: %s points, %s images in manifest", shard_count,
+                client.count(collection_name).count, len(manifest['images']))
+    return client
+
+
+def import_snapshot(collection_name, path, batch_size=256):
+    # Load an exported snapshot into the configured index (replacing the collection) without re-embedding, and
+    # write the manifest so the imported index opens like one built by create_embeddings
+    snapshot = SnapshotIndex(path, collection_name)
+    if not snapshot.models_match():
+        raise RuntimeError(f"Snapshot {path} was built with other embedding models: {snapshot.manifest['models']}")
+    client = get_qdrant_client()
+    if client.collection_exists(collection_name):
+        logger.info("Dropping collection %s before the import", collection_name)
+        client.delete_collection(collection_name)
+    create_collection(client, collection_name)
+
+    manifest = new_manifest(collection_name)
+    offset = None
+    while True:
+        records, offset = snapshot.scroll(collection_name, limit=batch_size, offset=offset, with_payload=True,
+                                          with_vectors=True)
+        client.upload_points(collection_name, [
+            models.PointStruct(id=record.id, vector=record.vector, payload=record.payload) for record in records
+        ])
+        for record in records:
+            payload = record.payload
+            if 'image_id' in payload:
+                manifest["images"][payload['image_id']] = {
+                    "split": payload.get('split'),
+                    "fingerprint": payload.get('fingerprint'),
+                    "text_model": TEXT_MODEL_NAME,
+                    "image_model": IMAGE_MODEL_NAME,
+                }
+        if offset is None:
+            break
+    manifest["complete"] = True
+    if is_persistent_index():
+        save_manifest(collection_name, manifest)
+    rebuild_lexical_index(collection_name, client)
+    if is_persistent_index():
+        save_lexical_index(collection_name)
+    logger.info("Imported %s points from snapshot %s into %s", client.count(collection_name).count, path,
+                collection_name)
+    return client
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.multimodal_rag_system import COLLECTION_NAME
+
+    parser = argparse.ArgumentParser(description="Build or refresh the vector index")
+    parser.add_argument("--shard", help="Ingest only shard i of N, given as i/N")
+    parser.add_argument("--seed", type=int, help="Sampling seed (default: Config.SAMPLE_SEED)")
+    parser.add_argument("--strategy", choices=SAMPLING_STRATEGIES, help="Sampling strategy")
+    parser.add_argument("--rebuild", action="store_true", help="Drop the index and re-embed everything")
+    parser.add_argument("--merge", type=int, metavar="N", help="Merge the output of N shard runs")
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_shards(COLLECTION_NAME, args.merge)
+    else:
+        create_embeddings(COLLECTION_NAME, rebuild=args.rebuild, refresh=True, shard=args.shard, seed=args.seed,
+                          strategy=args.strategy)
\ No newline at end of file
@@ -0,0 +1,74 @@
+## embedding_cache.py
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+EDGE_PUNCTUATION = " \t\n.,;:!?\"'()[]"
+
+
+def normalize_query(text):
+    # Case, Unicode form, spacing and surrounding punctuation do not change what CLIP sees in any useful way
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    return WHITESPACE_PATTERN.sub(" ", text).strip(EDGE_PUNCTUATION)
+
+
+def text_key(model_name, text):
+    return "text", model_name, normalize_query(text)
+
+
+def image_key(model_name, content_hash):
+    # Keyed on the decoded pixels (QueryImage.content_hash), never on the upload path
+    return "image", model_name, content_hash
+
+
+class EmbeddingCache:
+    """Bounded, thread-safe LRU cache of query embeddings."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> embedding, least recently used first
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "preloaded": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Membership checks (e.g. when preloading) do not count as lookups
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return embedding
+
+    def put(self, key, embedding, preloaded=False):
+        # Entries are shared between requests, so they are stored read-only
+        if hasattr(embedding, "setflags"):
+            embedding.setflags(write=False)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            if preloaded:
+                self._stats["preloaded"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats, entries=len(self._entries),
+                        hit_rate=round(self._stats["hits"] / lookups, 4) if lookups else None)
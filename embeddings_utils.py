@@ -1,85 +1,366 @@
-## embeddings_utils.py
-
-from typing import List
-from fastembed import TextEmbedding, ImageEmbedding
-import os
-
-TEXT_MODEL_NAME = "Qdrant/clip-ViT-B-32-text"
-IMAGE_MODEL_NAME = "Qdrant/clip-ViT-B-32-vision"
-
-
-def convert_text_to_embeddings(documents: List[str], embedding_model: str = TEXT_MODEL_NAME) -> List:
-    print(f"Converting {len(documents)} text documents to embeddings")
-    text_embedding_model = TextEmbedding(model_name=embedding_model)
-    text_embeddings = list(text_embedding_model.embed(documents))  # Returns a generator of embeddings
-    print(f"Text embedding conversion complete. Shape: {len(text_embeddings)}")
-    return text_embeddings
-
-
-def convert_image_to_embeddings(images: List[str], embedding_model: str = IMAGE_MODEL_NAME) -> List:
-    print(f"Converting {len(images)} images to embeddings")
-    # Check if all image paths exist
-    for img_path in images:
-        if not os.path.exists(img_path):
-            print(f"WARNING: Image path does not exist: {img_path}")
-
-    image_model = ImageEmbedding(model_name=embedding_model)
-    try:
-        images_embedded = list(image_model.embed(images))
-        print(f"Image embedding conversion complete. Shape: {len(images_embedded)}")
-        return images_embedded
-    except Exception as e:
-        print(f"Error during image embedding: {str(e)}")
-        raise
-
-
-# Search for similar text and get corresponding images as well
-def search_similar_text(collection_name, client, query, limit=3):
-    print(f"Searching for text similar to: '{query}'")
-    text_model = TextEmbedding(model_name=TEXT_MODEL_NAME)
-    search_query = text_model.embed([query])
-    search_results = client.search(
-        collection_name=collection_name,
-        query_vector=('text', list(search_query)[0]),
-        with_payload=['image_path', 'caption'],
-        limit=limit,
-    )
-    print(f"Found {len(search_results)} text matches")
-    return search_results
-
-
-# Search for similar images and get corresponding text as well
-def search_similar_image(collection_name, client, query_image_path, limit=3):
-    print(f"Searching for images similar to: {query_image_path}")
-    if not os.path.exists(query_image_path):
-        print(f"ERROR: Query image path does not exist: {query_image_path}")
-        return []
-
-    # Convert the query image into an embedding using the same model used for image embeddings
-    image_embedding_model = ImageEmbedding(model_name=IMAGE_MODEL_NAME)
-
-    try:
-        # Embed the provided query image (assumed to be a file path)
-        print(f"Generating embedding for query image")
-        query_image_embedding = list(image_embedding_model.embed([query_image_path]))[
-            0]  # Embedding for the query image
-
-        # Perform the similarity search in the Qdrant collection for image embeddings
-        search_results = client.search(
-            collection_name=collection_name,
-            query_vector=('image', query_image_embedding),
-            with_payload=['image_path', 'caption'],  # Fetch image paths and captions as metadata
-            limit=limit,
-        )
-        print(f"Found {len(search_results)} image matches")
-        return search_results
-    except Exception as e:
-        print(f"Error during image search: {str(e)}")
-        return []
-
-
-def merge_results(text_results, image_results):
-    # Combine based on some metadata, or simply concatenate
-    combined_results = text_results + image_results
-    print(f"Merged results: {len(text_results)} text + {len(image_results)} image = {len(combined_results)} total")
+## embeddings_utils.py
+
+from typing import List
+from qdrant_client import models
+import copy
+import logging
+import os
+import threading
+import time
+from PIL import Image
+from config import Config
+from src import telemetry
+from src.facets import build_query_filter
+from src.embedding_cache import EmbeddingCache, normalize_query, text_key, image_key
+from src.image_utils import QueryImage
+from src.storage_profiles import get_search_params
+
+logger = logging.getLogger(__name__)
+
+TEXT_MODEL_NAME = "Qdrant/clip-ViT-B-32-text"
+IMAGE_MODEL_NAME = "Qdrant/clip-ViT-B-32-vision"
+
+# Default of arguments that fall back to a Config setting, where an explicit None means "off"
+CONFIGURED = object()
+
+# Process-wide model registry. Loading a fastembed model means building an ONNX session,
+# so each (class, model name, options) combination is created once and shared by all callers.
+_model_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _registry_key(model_class, model_name, options):
+    return model_class.__name__, model_name, tuple(sorted(options.items()))
+
+
+def _get_model(model_class, model_name, **options):
+    # Execution options from the config apply unless the caller overrides them
+    if Config.EMBEDDING_THREADS is not None:
+        options.setdefault('threads', Config.EMBEDDING_THREADS)
+    key = _registry_key(model_class, model_name, options)
+    model = _model_registry.get(key)
+    if model is not None:
+        return model
+    with _registry_lock:
+        # Another thread may have loaded the model while we were waiting for the lock
+        model = _model_registry.get(key)
+        if model is None:
+            logger.info("Loading %s model: %s %s", model_class.__name__, model_name, options or '')
+            model = model_class(model_name=model_name, **options)
+            _model_registry[key] = model
+    return model
+
+
+# fastembed (and onnxruntime with it) is imported on first model use, so index-only commands start fast
+def get_text_model(model_name: str = TEXT_MODEL_NAME, **options):
+    from fastembed import TextEmbedding
+    return _get_model(TextEmbedding, model_name, **options)
+
+
+def get_image_model(model_name: str = IMAGE_MODEL_NAME, **options):
+    from fastembed import ImageEmbedding
+    return _get_model(ImageEmbedding, model_name, **options)
+
+
+def warmup_models(text_model_name: str = TEXT_MODEL_NAME, image_model_name: str = IMAGE_MODEL_NAME, **options):
+    # Load both models and run one tiny inference so the first user query only pays inference time
+    start_time = time.time()
+    list(get_text_model(text_model_name, **options).embed(["warmup"]))
+    list(get_image_model(image_model_name, **options).embed([Image.new("RGB", (224, 224))]))
+    logger.info("Embedding models warmed up in %.2f seconds", time.time() - start_time)
+
+
+def clear_model_registry():
+    with _registry_lock:
+        _model_registry.clear()
+
+
+def convert_text_to_embeddings(documents: List[str], embedding_model: str = TEXT_MODEL_NAME) -> List:
+    logger.debug("Converting %s text documents to embeddings", len(documents))
+    text_embedding_model = get_text_model(embedding_model)
+    text_embeddings = list(text_embedding_model.embed(documents))  # Returns a generator of embeddings
+    logger.debug("Text embedding conversion complete. Shape: %s", len(text_embeddings))
+    return text_embeddings
+
+
+def convert_image_to_embeddings(images: List[str], embedding_model: str = IMAGE_MODEL_NAME) -> List:
+    logger.debug("Converting %s images to embeddings", len(images))
+    # Check if all image paths exist (already decoded PIL images are passed through as they are)
+    for img_path in images:
+        if isinstance(img_path, str) and not os.path.exists(img_path):
+            logger.warning("Image path does not exist: %s", img_path)
+
+    image_model = get_image_model(embedding_model)
+    try:
+        images_embedded = list(image_model.embed(images))
+        logger.debug("Image embedding conversion complete. Shape: %s", len(images_embedded))
+        return images_embedded
+    except Exception as e:
+        logger.error("Error during image embedding: %s", e)
+        raise
+
+
+# Query embeddings by normalized text and by decoded pixels, so repeated, re-typed and re-uploaded queries skip the
+# CLIP forward pass
+query_embedding_cache = EmbeddingCache(Config.QUERY_EMBEDDING_CACHE_SIZE)
+
+
+def _cached_embedding(kind, key):
+    if key is None or not query_embedding_cache.max_entries:
+        return None
+    embedding = query_embedding_cache.get(key)
+    telemetry.inc("query_embedding_cache_lookups_total", kind=kind, result="miss" if embedding is None else "hit")
+    return embedding
+
+
+def _cache_embedding(key, embedding, preloaded=False):
+    if key is not None and query_embedding_cache.max_entries:
+        query_embedding_cache.put(key, embedding, preloaded=preloaded)
+    return embedding
+
+
+def _query_text(query):
+    # The model sees the normalized text, so a cached embedding equals the one a fresh forward pass would give
+    return normalize_query(query) or query
+
+
+def embed_query_text(query):
+    key = text_key(TEXT_MODEL_NAME, query)
+    embedding = _cached_embedding("text", key)
+    if embedding is None:
+        with telemetry.span("embed_text"):
+            embedding = _cache_embedding(key, list(get_text_model(TEXT_MODEL_NAME).embed([_query_text(query)]))[0])
+    return embedding
+
+
+def embed_query_image(query_image):
+    # Anything QueryImage can decode is cached by its pixels; other inputs (e.g. a missing path) go to the model as is
+    query_image = QueryImage.from_any(query_image)
+    key = None
+    if isinstance(query_image, QueryImage):
+        key = image_key(IMAGE_MODEL_NAME, query_image.content_hash)
+        query_image = query_image.image
+    embedding = _cached_embedding("image", key)
+    if embedding is None:
+        with telemetry.span("embed_image"):
+            embedding = _cache_embedding(key, list(get_image_model(IMAGE_MODEL_NAME).embed([query_image]))[0])
+    return embedding
+
+
+def _embed_batch(kind, model, keys, inputs):
+    # Only the cache misses are embedded, still in a single model call
+    embeddings = [_cached_embedding(kind, key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        with telemetry.span(f"embed_{kind}_batch"):
+            computed = list(model.embed([inputs[i] for i in missing]))
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = _cache_embedding(keys[i], embedding)
+    return embeddings
+
+
+def embed_query_texts(queries):
+    # Batched embed_query_text: the cache misses are embedded in one model call
+    if not queries:
+        return []
+    return _embed_batch("text", get_text_model(TEXT_MODEL_NAME),
+                        [text_key(TEXT_MODEL_NAME, query) for query in queries],
+                        [_query_text(query) for query in queries])
+
+
+def embed_query_images(query_images):
+    # Batched embed_query_image
+    if not query_images:
+        return []
+    query_images = [QueryImage.from_any(image) for image in query_images]
+    keys = [image_key(IMAGE_MODEL_NAME, image.content_hash) if isinstance(image, QueryImage) else None
+            for image in query_images]
+    return _embed_batch("image", get_image_model(IMAGE_MODEL_NAME), keys,
+                        [image.image if isinstance(image, QueryImage) else image for image in query_images])
+
+
+def load_preload_queries():
+    queries = list(Config.PRELOAD_QUERIES or [])
+    if Config.PRELOAD_QUERIES_PATH:
+        with open(Config.PRELOAD_QUERIES_PATH, encoding="utf-8") as preload_file:
+            queries.extend(line.strip() for line in preload_file if line.strip() and not line.startswith("#"))
+    return queries
+
+
+def preload_query_embeddings(queries=None):
+    # Embed the frequent queries in one batch at startup; returns how many new entries were added
+    if not query_embedding_cache.max_entries:
+        return 0
+    queries = load_preload_queries() if queries is None else queries
+    pending = {}
+    for query in queries:
+        key = text_key(TEXT_MODEL_NAME, query)
+        if key not in query_embedding_cache and key not in pending:
+            pending[key] = _query_text(query)
+    if not pending:
+        return 0
+    start_time = time.time()
+    embeddings = list(get_text_model(TEXT_MODEL_NAME).embed(list(pending.values())))
+    for key, embedding in zip(pending, embeddings):
+        query_embedding_cache.put(key, embedding, preloaded=True)
+    logger.info("Preloaded %s query embeddings in %.2f seconds", len(pending), time.time() - start_time)
+    return len(pending)
+
+
+def clear_query_embedding_cache():
+    query_embedding_cache.clear()
+
+
+def _query_vector(embedding):
+    # Cached embeddings are shared read-only arrays, and local-mode Qdrant normalizes a query array in place; a plain
+    # list of floats is safe for every backend
+    return list(map(float, embedding))
+
+
+# Search for similar text and get corresponding images as well
+def search_similar_text(collection_name, client, query, limit=3, query_embedding=None, filters=None):
+    # filters: facet values to restrict the search to, e.g. {"modality": "CT", "split": ["train", "valid"]}
+    logger.debug("Searching for text similar to: '%s'", query)
+    # Callers that already embedded the query (e.g. for the response cache) pass the embedding in
+    if query_embedding is None:
+        query_embedding = embed_query_text(query)
+    with telemetry.span("vector_search_text"):
+        search_results = client.search(
+            collection_name=collection_name,
+            query_vector=('text', _query_vector(query_embedding)),
+            query_filter=build_query_filter(filters),
+            with_payload=['image_path', 'caption'],
+            search_params=get_search_params(),
+            limit=limit,
+        )
+    logger.debug("Found %s text matches", len(search_results))
+    return search_results
+
+
+# Search for similar images and get corresponding text as well
+def search_similar_image(collection_name, client, query_image_path, limit=3, filters=None,
+                         query_image_embedding=None):
+    # query_image_path may also be an in-memory PIL image or QueryImage; decoded images are cached by their pixels
+    logger.debug("Searching for images similar to: %s", query_image_path)
+    if isinstance(query_image_path, str) and not os.path.exists(query_image_path):
+        logger.error("Query image path does not exist: %s", query_image_path)
+        return []
+
+    try:
+        # Embed the query image with the same model used for the indexed images (or reuse its cached embedding)
+        if query_image_embedding is None:
+            logger.debug("Generating embedding for query image")
+            query_image_embedding = embed_query_image(query_image_path)
+
+        # Perform the similarity search in the Qdrant collection for image embeddings
+        with telemetry.span("vector_search_image"):
+            search_results = client.search(
+                collection_name=collection_name,
+                query_vector=('image', _query_vector(query_image_embedding)),
+                query_filter=build_query_filter(filters),
+                with_payload=['image_path', 'caption'],  # Fetch image paths and captions as metadata
+                search_params=get_search_params(),
+                limit=limit,
+            )
+        logger.debug("Found %s image matches", len(search_results))
+        return search_results
+    except Exception as e:
+        logger.error("Error during image search: %s", e)
+        return []
+
+
+def _search_batch(collection_name, client, vector_name, embeddings, limit, filters=None):
+    # One round trip to Qdrant for all query vectors of a modality
+    query_filter = build_query_filter(filters)
+    requests = [
+        models.SearchRequest(
+            vector=models.NamedVector(name=vector_name, vector=_query_vector(embedding)),
+            filter=query_filter,
+            with_payload=['image_path', 'caption'],
+            limit=limit,
+            params=get_search_params(),
+        )
+        for embedding in embeddings
+    ]
+    with telemetry.span(f"vector_search_batch_{vector_name}"):
+        return client.search_batch(collection_name=collection_name, requests=requests)
+
+
+# Batched variant of search_similar_text: all queries are embedded in one call and searched in one request
+def search_batch_text(collection_name, client, queries: List[str], limit=3, filters=None, query_embeddings=None):
+    logger.debug("Batch searching for text similar to %s queries", len(queries))
+    if not queries:
+        return []
+    if query_embeddings is None:
+        query_embeddings = embed_query_texts(queries)
+    return _search_batch(collection_name, client, 'text', query_embeddings, limit, filters)
+
+
+# Batched variant of search_similar_image; the caller is responsible for passing existing image paths
+def search_batch_image(collection_name, client, query_image_paths: List[str], limit=3, filters=None,
+                       query_embeddings=None):
+    logger.debug("Batch searching for images similar to %s query images", len(query_image_paths))
+    if not query_image_paths:
+        return []
+    if query_embeddings is None:
+        query_embeddings = embed_query_images(query_image_paths)
+    return _search_batch(collection_name, client, 'image', query_embeddings, limit, filters)
+
+
+def fuse_results(result_lists, weights=None, method=None, min_score=CONFIGURED, max_results=None):
+    # Fuse ranked result lists from different retrieval channels into one deduplicated ranking.
+    # "rrf": reciprocal-rank fusion, sum(weight / (k + rank)); "weighted": per-channel min-max normalized scores,
+    # weighted and summed. Results below min_score (raw channel similarity) are dropped before fusion, and the fused
+    # list is cut to max_results; PromptBuilder fits the references into the prompt token budget. min_score may be
+    # a list with one threshold per channel, since channels score on different scales; None keeps every result
+    # (default: FUSION_MIN_SCORE). Returned points carry the fused score.
+    method = method or Config.FUSION_METHOD
+    min_score = Config.FUSION_MIN_SCORE if min_score is CONFIGURED else min_score
+    min_scores = min_score if isinstance(min_score, (list, tuple)) else [min_score] * len(result_lists)
+    max_results = max_results or Config.FUSION_MAX_RESULTS
+    weights = weights or [1.0] * len(result_lists)
+
+    fused_scores = {}
+    best_points = {}
+    for results, weight, channel_min_score in zip(result_lists, weights, min_scores):
+        results = [r for r in results if channel_min_score is None or r.score >= channel_min_score]
+        if not results:
+            continue
+        if method == "weighted":
+            scores = [r.score for r in results]
+            low, high = min(scores), max(scores)
+            spread = high - low
+        for rank, result in enumerate(results):
+            if method == "weighted":
+                contribution = weight * ((result.score - low) / spread if spread > 0 else 1.0)
+            else:
+                contribution = weight / (Config.RRF_K + rank + 1)
+            fused_scores[result.id] = fused_scores.get(result.id, 0.0) + contribution
+            if result.id not in best_points or result.score > best_points[result.id].score:
+                best_points[result.id] = result
+
+    fused = []
+    for point_id in sorted(fused_scores, key=fused_scores.get, reverse=True):
+        if max_results and len(fused) >= max_results:
+            break
+        point = copy.copy(best_points[point_id])
+        point.score = fused_scores[point_id]
+        fused.append(point)
+    return fused
+
+
+def merge_results(text_results, image_results, lexical_results=None, reranked=False):
+    # Deduplicate by point ID and fuse the rankings instead of concatenating them.
+    # BM25 scores are not cosine similarities, so the lexical channel has no similarity threshold. Reranked dense
+    # results carry rerank scores and were already cut at FUSION_MIN_SCORE by their search similarity (see
+    # reranking.rerank), so they are not thresholded again.
+    lexical_results = lexical_results or []
+    dense_min_score = None if reranked else Config.FUSION_MIN_SCORE
+    with telemetry.span("fuse"):
+        combined_results = fuse_results([text_results, image_results, lexical_results],
+                                        weights=[Config.FUSION_TEXT_WEIGHT, Config.FUSION_IMAGE_WEIGHT,
+                                                 Config.FUSION_LEXICAL_WEIGHT],
+                                        min_score=[dense_min_score, dense_min_score, None])
+    logger.debug("Merged results: %s text + %s image + %s lexical -> %s fused", len(text_results),
+                 len(image_results), len(lexical_results), len(combined_results))
     return combined_results
\ No newline at end of file
@@ -0,0 +1,90 @@
+## facets.py
+
+import re
+
+from qdrant_client import models
+
+# Imaging modality inferred from caption keywords; the first matching modality wins (so PET-CT counts as PET)
+MODALITY_PATTERNS = [
+    ("PET", re.compile(r"\b(pet|pet-ct|positron emission)\b")),
+    ("CT", re.compile(r"\b(ct|cta|computed tomograph\w*|tomodensitometr\w*)\b")),
+    ("MRI", re.compile(r"\b(mri|mr|magnetic resonance|flair|t1-weighted|t2-weighted|dwi)\b")),
+    ("Ultrasound", re.compile(r"\b(ultrasound\w*|ultrasonograph\w*|sonograph\w*|doppler|echocardiogra\w*)\b")),
+    ("Angiography", re.compile(r"\b(angiogra\w*|dsa)\b")),
+    ("X-ray", re.compile(r"\b(x-ray\w*|xray\w*|radiograph\w*|chest film|plain film|mammogra\w*|fluoroscop\w*)\b")),
+]
+UNKNOWN = "unknown"
+
+
+def infer_modality(caption):
+    text = str(caption).lower()
+    for modality, pattern in MODALITY_PATTERNS:
+        if pattern.search(text):
+            return modality
+    return UNKNOWN
+
+
+# Body region inferred the same way; spine comes first so "cervical spine" is not read as the neck
+BODY_REGION_PATTERNS = [
+    ("Spine", re.compile(r"\b(spine|spinal|vertebra\w*|lumbar|sacr\w*|coccy\w*|intervertebral|cervical spine|"
+                         r"thoracic spine)\b")),
+    ("Head", re.compile(r"\b(brain|head|skull|cranial|intracranial|cerebr\w*|cerebell\w*|orbit\w*|sinus\w*|"
+                        r"facial|mandib\w*|maxill\w*|temporal bone)\b")),
+    ("Neck", re.compile(r"\b(neck|cervical|thyroid|laryn\w*|pharyn\w*|carotid|parotid)\b")),
+    ("Chest", re.compile(r"\b(chest|thora\w*|lung\w*|pulmonary|pleura\w*|mediastin\w*|heart|cardiac|coronary|"
+                         r"aort\w*|breast\w*|ribs?)\b")),
+    ("Abdomen", re.compile(r"\b(abdom\w*|liver|hepat\w*|kidney\w*|renal|pancrea\w*|spleen|splenic|bowel|colon\w*|"
+                           r"gallbladder|biliary|stomach|gastr\w*|duoden\w*|adrenal)\b")),
+    ("Pelvis", re.compile(r"\b(pelvi\w*|hips?|bladder|uter\w*|ovar\w*|prostat\w*|rect\w*|sacroiliac|acetabul\w*)\b")),
+    ("Upper limb", re.compile(r"\b(shoulder|arm|humer\w*|elbow|forearm|wrist|hand|fingers?|thumb|ulna\w*)\b")),
+    ("Lower limb", re.compile(r"\b(leg|femur|femoral|knee|patella\w*|tibia\w*|fibula\w*|ankle|foot|feet|toes?)\b")),
+]
+
+# Payload fields with a keyword index; each one can restrict a search
+FACET_FIELDS = ("split", "modality", "body_region")
+FACET_VALUES = {
+    "split": ["train", "valid", "test"],
+    "modality": [modality for modality, _ in MODALITY_PATTERNS] + [UNKNOWN],
+    "body_region": [region for region, _ in BODY_REGION_PATTERNS] + [UNKNOWN],
+}
+# Bumped when the inference rules change, so persisted collections get their facet payloads recomputed
+FACETS_VERSION = 1
+
+
+def infer_body_region(caption):
+    text = str(caption).lower()
+    for region, pattern in BODY_REGION_PATTERNS:
+        if pattern.search(text):
+            return region
+    return UNKNOWN
+
+
+def caption_facets(caption):
+    return {"modality": infer_modality(caption), "body_region": infer_body_region(caption)}
+
+
+def normalize_filters(filters):
+    # {"modality": "CT", "split": ["train", "valid"], "body_region": None} -> {field: tuple of allowed values}.
+    # Empty selections mean "any"; unknown fields are an error rather than a silently unfiltered search.
+    normalized = {}
+    for field, values in (filters or {}).items():
+        if field not in FACET_FIELDS:
+            raise ValueError(f"Unknown filter field: {field}. Available: {', '.join(FACET_FIELDS)}")
+        if values is None or values == "":
+            continue
+        values = (values,) if isinstance(values, str) else tuple(values)
+        if values:
+            normalized[field] = values
+    return normalized
+
+
+def build_query_filter(filters):
+    # Qdrant filter for the normalized facets; a Qdrant server applies it during the HNSW traversal using the
+    # keyword indexes, the local mode with an exact scan
+    filters = normalize_filters(filters)
+    if not filters:
+        return None
+    return models.Filter(must=[
+        models.FieldCondition(key=field, match=models.MatchAny(any=list(values)))
+        for field, values in filters.items()
+    ])
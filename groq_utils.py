@@ -1,115 +1,350 @@
-from groq import Groq
-import base64
-import os
-from config import Config
-import time
-
-
-class GroqClient:
-    def __init__(self):
-        self.api_key = Config.GROQ_API_KEY
-        self.client = Groq(api_key=self.api_key)
-        print(f"GroqClient initialized with API key ending in: ...{self.api_key[-5:]}")
-
-    def encode_image(self, image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    def query(self, prompt, retrieved_contexts, user_image=None):
-        print(f"GroqClient query: {prompt[:50]}...")
-        print(f"Retrieved contexts: {len(retrieved_contexts)}")
-        print(f"User image: {user_image}")
-
-        # System role content (to be included as text in user message)
-        radiologist_instructions = """You are a radiologist with an experience of 30 years.
-        You analyse medical scans and text, and help diagnose underlying issues.
-
-        Please analyze the following query and image using your expertise:
-        """
-
-        # Initialize message structure - use only user message (no system message)
-        messages = [
-            {"role": "user", "content": [
-                {"type": "text", "text": f"{radiologist_instructions}\n\n{prompt}"}
-            ]}
-        ]
-
-        # Add the user-uploaded image (if any)
-        if user_image:
-            if not os.path.exists(user_image):
-                print(f"ERROR: User image file does not exist: {user_image}")
-                return {"error": f"Image file not found: {user_image}"}
-
-            try:
-                base64_image = self.encode_image(user_image)
-                print(f"Successfully encoded user image, size: {len(base64_image)}")
-                messages[0]["content"].append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                })
-            except Exception as e:
-                print(f"ERROR encoding user image: {str(e)}")
-                return {"error": f"Image encoding failed: {str(e)}"}
-
-        # Add context message for retrieved images as text only
-        if retrieved_contexts:
-            context_text = "Additional context that you may use as a reference. Use them if you feel they are relevant to " \
-                           "the case. NOTE: They are not the patient's images. They are descriptions of other patients' " \
-                           "images which can be used as a reference, if required.\n\n"
-
-            # Compile all context descriptions into a single text block
-            for i, context in enumerate(retrieved_contexts):
-                try:
-                    caption = context.payload['caption']
-                    image_path = context.payload['image_path']
-
-                    # Add the caption and image reference (without sending the actual image)
-                    context_text += f"Reference {i + 1}: {caption}\n"
-                    # We can add image filename as additional reference
-                    context_text += f"Source: {os.path.basename(image_path)}\n\n"
-
-                except Exception as e:
-                    print(f"ERROR processing context: {str(e)}")
-                    continue
-
-            # Add all contexts as a single text message
-            messages[0]["content"].append({
-                "type": "text",
-                "text": context_text
-            })
-
-            print(f"Added {len(retrieved_contexts)} context items as text")
-
-        # Call the API
-        print("Sending request to Groq API...")
-        try:
-            start_time = time.time()
-            response = self.client.chat.completions.create(
-                model=Config.GROQ_MODEL,
-                messages=[m for m in messages],  # Convert to format expected by the client
-                max_tokens=Config.MAX_TOKENS
-            )
-            elapsed_time = time.time() - start_time
-            print(f"Groq API response received in {elapsed_time:.2f} seconds.")
-
-            return {"choices": [{"message": {"content": response.choices[0].message.content}}]}
-        except Exception as e:
-            print(f"ERROR making API request: {str(e)}")
-            return {"error": f"API request failed: {str(e)}"}
-
-    def process_response(self, response):
-        print(f"Processing response: {response.keys() if isinstance(response, dict) else 'Not a dict'}")
-
-        if isinstance(response, dict) and 'error' in response:
-            return f"Error: {response['error']}"
-
-        if isinstance(response, dict) and 'choices' in response and len(response['choices']) > 0:
-            content = response['choices'][0]['message']['content']
-            print(f"Successfully extracted content: {content[:50]}...")
-            return content
-        else:
-            error_msg = f"Invalid response structure: {response}"
-            print(error_msg)
+from groq import Groq, AsyncGroq, APIConnectionError, APITimeoutError
+import asyncio
+import base64
+import hashlib
+import httpx
+import os
+from config import Config
+from src.response_cache import ResponseCache, make_cache_key, make_context_key
+from src.image_utils import QueryImage
+from src.rate_limiter import RequestLimiter, backoff_delay, parse_retry_after
+from src.prompt_builder import PromptBuilder, count_tokens
+from src import telemetry
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rate limits, timeouts and transient server errors are retried; anything else fails immediately
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable_error(error):
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES
+
+
+def estimate_request_tokens(messages):
+    # Local estimate for tokens/min pacing: counted text tokens, a flat cost per image, plus the completion budget
+    tokens = Config.MAX_TOKENS
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part["type"] == "text":
+                tokens += count_tokens(part["text"])
+            else:
+                tokens += Config.GROQ_IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+class GroqClient:
+    def __init__(self):
+        self.api_key = Config.GROQ_API_KEY
+        # Pooled keep-alive connections; retries are handled here (max_retries=0) so every attempt is paced by the
+        # limiter.
+        # GROQ_BASE_URL points the client at another OpenAI-compatible endpoint, e.g. a local mock server in tests
+        limits = httpx.Limits(max_connections=Config.GROQ_MAX_CONNECTIONS,
+                              max_keepalive_connections=Config.GROQ_MAX_CONNECTIONS,
+                              keepalive_expiry=Config.GROQ_KEEPALIVE_EXPIRY)
+        self.client = Groq(api_key=self.api_key, base_url=Config.GROQ_BASE_URL, max_retries=0,
+                           timeout=Config.TIMEOUT, http_client=httpx.Client(limits=limits, timeout=Config.TIMEOUT))
+        self.async_client = AsyncGroq(api_key=self.api_key, base_url=Config.GROQ_BASE_URL, max_retries=0,
+                                      timeout=Config.TIMEOUT,
+                                      http_client=httpx.AsyncClient(limits=limits, timeout=Config.TIMEOUT))
+        self.limiter = RequestLimiter(max_concurrency=Config.GROQ_MAX_CONCURRENCY,
+                                      requests_per_minute=Config.GROQ_REQUESTS_PER_MINUTE,
+                                      tokens_per_minute=Config.GROQ_TOKENS_PER_MINUTE)
+        # Primary model first, then the fail-over models in order
+        self.models = [Config.GROQ_MODEL] + [m for m in Config.GROQ_FALLBACK_MODELS if m != Config.GROQ_MODEL]
+        self.cache = ResponseCache.from_config() if Config.RESPONSE_CACHE_ENABLED else None
+        self.prompt_builder = PromptBuilder()
+        logger.info("GroqClient initialized with API key ending in: ...%s", self.api_key[-5:])
+
+    # User images are a QueryImage (decoded once per request), an in-memory PIL image or a file path
+    def encode_image(self, image_path):
+        query_image = QueryImage.from_any(image_path)
+        if isinstance(query_image, QueryImage):
+            return query_image.llm_base64()
+        with open(image_path, "rb") as image_file:
+            return base64.b64encode(image_file.read()).decode('utf-8')
+
+    def hash_image(self, image_path):
+        query_image = QueryImage.from_any(image_path)
+        if isinstance(query_image, QueryImage):
+            return query_image.content_hash
+        with open(image_path, "rb") as image_file:
+            return hashlib.sha256(image_file.read()).hexdigest()
+
+    def _retry_delay(self, model_index, attempt, error):
+        # Returns the seconds to wait before the next attempt on the same model, or None to move on
+        if not is_retryable_error(error) or attempt >= Config.GROQ_MAX_RETRIES:
+            return None
+        response = getattr(error, 'response', None)
+        retry_after = parse_retry_after(response.headers if response is not None else None)
+        delay = backoff_delay(attempt, Config.GROQ_RETRY_BASE_DELAY, Config.GROQ_RETRY_MAX_DELAY, retry_after)
+        # A long server-imposed wait is better spent on the next model, if there is one
+        if delay > Config.GROQ_RETRY_MAX_DELAY and model_index < len(self.models) - 1:
+            return None
+        return delay
+
+    def _create_completion(self, messages, estimated_tokens=0, **kwargs):
+        # Returns (answering model, response). Every attempt, retries and fail-overs included, is charged to the
+        # requests/min and tokens/min buckets.
+        last_error = None
+        for model_index, model in enumerate(self.models):
+            attempt = 0
+            while True:
+                try:
+                    self.limiter.pace(estimated_tokens)
+                    return model, self.client.chat.completions.create(
+                        model=model, messages=messages, max_tokens=Config.MAX_TOKENS, **kwargs)
+                except Exception as e:
+                    last_error = e
+                    if not is_retryable_error(e):
+                        raise
+                    delay = self._retry_delay(model_index, attempt, e)
+                    if delay is None:
+                        break
+                    logger.warning("Groq request to %s failed (%s), retrying in %.2f seconds", model, e, delay)
+                    telemetry.inc("llm_retries_total", model=model)
+                    time.sleep(delay)
+                    attempt += 1
+            if model_index < len(self.models) - 1:
+                logger.warning("Model %s unavailable, failing over to %s", model, self.models[model_index + 1])
+                telemetry.inc("llm_failovers_total", model=model)
+        raise last_error
+
+    async def _create_completion_async(self, messages, estimated_tokens=0, **kwargs):
+        last_error = None
+        for model_index, model in enumerate(self.models):
+            attempt = 0
+            while True:
+                try:
+                    await self.limiter.pace_async(estimated_tokens)
+                    return model, await self.async_client.chat.completions.create(
+                        model=model, messages=messages, max_tokens=Config.MAX_TOKENS, **kwargs)
+                except Exception as e:
+                    last_error = e
+                    if not is_retryable_error(e):
+                        raise
+                    delay = self._retry_delay(model_index, attempt, e)
+                    if delay is None:
+                        break
+                    logger.warning("Groq request to %s failed (%s), retrying in %.2f seconds", model, e, delay)
+                    telemetry.inc("llm_retries_total", model=model)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+            if model_index < len(self.models) - 1:
+                logger.warning("Model %s unavailable, failing over to %s", model, self.models[model_index + 1])
+                telemetry.inc("llm_failovers_total", model=model)
+        raise last_error
+
+    def _cache_keys(self, prompt, retrieved_contexts, user_image):
+        # Returns (cache_key, context_key), or (None, None) when caching is off or the image is unreadable
+        if self.cache is None:
+            return None, None
+        try:
+            image_hash = self.hash_image(user_image) if user_image is not None else None
+        except (OSError, ValueError, TypeError):
+            # A missing or undecodable image is reported by build_messages
+            return None, None
+        point_ids = [getattr(context, 'id', None) for context in retrieved_contexts]
+        return (make_cache_key(prompt, image_hash, point_ids, self.models[0], Config.MAX_TOKENS),
+                make_context_key(image_hash, point_ids, self.models[0], Config.MAX_TOKENS))
+
+    def _store_response(self, cache_key, context_key, result, query_embedding, model):
+        # Cache keys name the primary model, so answers from a fail-over model are not cached under them
+        if cache_key is None:
+            return
+        if model != self.models[0]:
+            logger.debug("Not caching the answer of fail-over model %s", model)
+            return
+        self.cache.put(cache_key, result, context_key, query_embedding)
+
+    def _lookup_cache(self, cache_key, context_key, query_embedding):
+        if cache_key is None:
+            return None
+        with telemetry.span("cache_lookup"):
+            cached_response = self.cache.get(cache_key, context_key, query_embedding)
+        telemetry.inc("response_cache_lookups_total", result="miss" if cached_response is None else "hit")
+        return cached_response
+
+    def build_messages(self, prompt, retrieved_contexts, user_image=None):
+        # Returns (messages, None) or (None, error_dict)
+        with telemetry.span("prompt_build"):
+            return self._build_messages(prompt, retrieved_contexts, user_image)
+
+    def _build_messages(self, prompt, retrieved_contexts, user_image=None):
+        # Encode the user-uploaded image (if any); the prompt builder places it after the question
+        image_url = None
+        if user_image is not None:
+            if isinstance(user_image, str) and not os.path.exists(user_image):
+                logger.error("User image file does not exist: %s", user_image)
+                return None, {"error": f"Image file not found: {user_image}"}
+
+            try:
+                base64_image = self.encode_image(user_image)
+                logger.debug("Successfully encoded user image, size: %s", len(base64_image))
+                image_url = f"data:image/jpeg;base64,{base64_image}"
+            except Exception as e:
+                logger.error("Error encoding user image: %s", e)
+                return None, {"error": f"Image encoding failed: {str(e)}"}
+
+        # Retrieved contexts are sent as text only, cut to the input token budget
+        prompt_build = self.prompt_builder.build(prompt, retrieved_contexts, image_url)
+        telemetry.inc("prompt_input_tokens_total", prompt_build.input_tokens)
+        if prompt_build.references_truncated or prompt_build.references_dropped:
+            telemetry.inc("prompt_references_truncated_total", prompt_build.references_truncated)
+            telemetry.inc("prompt_references_dropped_total", prompt_build.references_dropped)
+        logger.debug("Prompt has ~%s input tokens with %s references (%s truncated, %s dropped)",
+                     prompt_build.input_tokens, prompt_build.references_used, prompt_build.references_truncated,
+                     prompt_build.references_dropped)
+        return prompt_build.messages, None
+
+    def query(self, prompt, retrieved_contexts, user_image=None, query_embedding=None):
+        logger.debug("GroqClient query: %s...", prompt[:50])
+        logger.debug("Retrieved contexts: %s", len(retrieved_contexts))
+        logger.debug("User image provided: %s", user_image is not None)
+
+        # Answer from the response cache when the same (or, optionally, a near-identical) question was asked
+        # with the same image and references
+        cache_key, context_key = self._cache_keys(prompt, retrieved_contexts, user_image)
+        cached_response = self._lookup_cache(cache_key, context_key, query_embedding)
+        if cached_response is not None:
+            logger.debug("Response served from cache")
+            return cached_response
+
+        messages, error = self.build_messages(prompt, retrieved_contexts, user_image)
+        if error:
+            return error
+
+        # Call the API
+        logger.debug("Sending request to Groq API...")
+        try:
+            with telemetry.span("llm_total"), self.limiter.slot():
+                model, response = self._create_completion(messages, estimate_request_tokens(messages))
+            logger.debug("Groq API response received")
+
+            result = {"choices": [{"message": {"content": response.choices[0].message.content}}]}
+            self._store_response(cache_key, context_key, result, query_embedding, model)
+            return result
+        except Exception as e:
+            logger.error("Error making API request: %s", e)
+            return {"error": f"API request failed: {str(e)}"}
+
+    def query_stream(self, prompt, retrieved_contexts, user_image=None, query_embedding=None):
+        # Generator variant of query: yields content deltas as the model produces them.
+        # Errors are raised as exceptions since there is no response dict to put them in.
+        logger.debug("GroqClient streaming query: %s...", prompt[:50])
+        cache_key, context_key = self._cache_keys(prompt, retrieved_contexts, user_image)
+        cached_response = self._lookup_cache(cache_key, context_key, query_embedding)
+        if cached_response is not None:
+            logger.debug("Response served from cache")
+            yield self.process_response(cached_response)
+            return
+
+        messages, error = self.build_messages(prompt, retrieved_contexts, user_image)
+        if error:
+            raise RuntimeError(error["error"])
+
+        logger.debug("Sending streaming request to Groq API...")
+        start_time = time.perf_counter()
+        first_token_time = None
+        chunks = []
+        # The concurrency slot is held until the stream is fully consumed
+        with self.limiter.slot():
+            model, stream = self._create_completion(messages, estimate_request_tokens(messages), stream=True)
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                    telemetry.record_span("llm_ttft", first_token_time)
+                    logger.debug("Groq API first token received in %.2f seconds.", first_token_time)
+                chunks.append(delta)
+                yield delta
+        telemetry.record_span("llm_total", time.perf_counter() - start_time)
+        logger.debug("Groq API stream completed in %.2f seconds.", time.perf_counter() - start_time)
+
+        result = {"choices": [{"message": {"content": "".join(chunks)}}]}
+        self._store_response(cache_key, context_key, result, query_embedding, model)
+
+    async def query_async(self, prompt, retrieved_contexts, user_image=None, query_embedding=None):
+        # Async variant of query for the concurrent request path; same cache and message building
+        cache_key, context_key = self._cache_keys(prompt, retrieved_contexts, user_image)
+        cached_response = self._lookup_cache(cache_key, context_key, query_embedding)
+        if cached_response is not None:
+            return cached_response
+
+        messages, error = self.build_messages(prompt, retrieved_contexts, user_image)
+        if error:
+            return error
+
+        try:
+            with telemetry.span("llm_total"):
+                async with self.limiter.aslot():
+                    model, response = await self._create_completion_async(messages, estimate_request_tokens(messages))
+            logger.debug("Groq API response received")
+            result = {"choices": [{"message": {"content": response.choices[0].message.content}}]}
+            self._store_response(cache_key, context_key, result, query_embedding, model)
+            return result
+        except Exception as e:
+            logger.error("Error making API request: %s", e)
+            return {"error": f"API request failed: {str(e)}"}
+
+    async def query_stream_async(self, prompt, retrieved_contexts, user_image=None, query_embedding=None):
+        # Async generator variant of query_stream
+        cache_key, context_key = self._cache_keys(prompt, retrieved_contexts, user_image)
+        cached_response = self._lookup_cache(cache_key, context_key, query_embedding)
+        if cached_response is not None:
+            yield self.process_response(cached_response)
+            return
+
+        messages, error = self.build_messages(prompt, retrieved_contexts, user_image)
+        if error:
+            raise RuntimeError(error["error"])
+
+        start_time = time.perf_counter()
+        first_token_time = None
+        chunks = []
+        async with self.limiter.aslot():
+            model, stream = await self._create_completion_async(messages, estimate_request_tokens(messages),
+                                                                stream=True)
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                    telemetry.record_span("llm_ttft", first_token_time)
+                    logger.debug("Groq API first token received in %.2f seconds.", first_token_time)
+                chunks.append(delta)
+                yield delta
+        telemetry.record_span("llm_total", time.perf_counter() - start_time)
+
+        result = {"choices": [{"message": {"content": "".join(chunks)}}]}
+        self._store_response(cache_key, context_key, result, query_embedding, model)
+
+    def process_response(self, response):
+        with telemetry.span("post_process"):
+            return self._process_response(response)
+
+    def _process_response(self, response):
+        logger.debug("Processing response of type %s", type(response).__name__)
+
+        if isinstance(response, dict) and 'error' in response:
+            return f"Error: {response['error']}"
+
+        if isinstance(response, dict) and 'choices' in response and len(response['choices']) > 0:
+            content = response['choices'][0]['message']['content']
+            logger.debug("Successfully extracted content: %s...", content[:50])
+            return content
+        else:
+            error_msg = f"Invalid response structure: {response}"
+            logger.error("%s", error_msg)
             return f"Error: Unable to process response from API. Full response: {response}"
\ No newline at end of file
@@ -0,0 +1,82 @@
+## image_utils.py
+
+import base64
+import hashlib
+import io
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class QueryImage:
+    """A user image decoded once and shared by the CLIP embedder, the LLM payload and the cache keys."""
+
+    def __init__(self, image, source=None):
+        self.image = image if image.mode == "RGB" else image.convert("RGB")
+        self.source = source
+        self._content_hash = None
+        self._llm_base64 = None
+
+    @classmethod
+    def from_any(cls, value):
+        # Accepts a QueryImage, PIL image, numpy array, raw bytes or a file path. Returns the value unchanged if it
+        # cannot be decoded, so the caller's existing error reporting (e.g. missing file) still applies.
+        if value is None or isinstance(value, cls):
+            return value
+        try:
+            if isinstance(value, Image.Image):
+                return cls(value)
+            if isinstance(value, np.ndarray):
+                return cls(Image.fromarray(value))
+            if isinstance(value, (bytes, bytearray)):
+                return cls(_open_image(io.BytesIO(value)))
+            if isinstance(value, str) and os.path.exists(value):
+                return cls(_open_image(value), source=value)
+        except Exception as e:
+            logger.error("Error decoding query image: %s", e)
+        return value
+
+    @property
+    def content_hash(self):
+        # Hash of the decoded pixels, so re-encoded copies of the same upload share cache entries
+        if self._content_hash is None:
+            hasher = hashlib.sha256()
+            hasher.update(f"{self.image.mode}:{self.image.size}".encode("utf-8"))
+            hasher.update(self.image.tobytes())
+            self._content_hash = hasher.hexdigest()
+        return self._content_hash
+
+    def llm_base64(self):
+        # Downscaled, size- and quality-bounded JPEG for the LLM request, encoded once per image
+        if self._llm_base64 is None:
+            image = self.image
+            max_side = Config.LLM_IMAGE_MAX_SIDE
+            if max_side and max(image.size) > max_side:
+                image = image.copy()
+                image.thumbnail((max_side, max_side), Image.BICUBIC)
+
+            quality = Config.LLM_IMAGE_QUALITY
+            while True:
+                buffer = io.BytesIO()
+                image.save(buffer, format="JPEG", quality=quality, optimize=True)
+                # Lower the quality until the payload fits, but never below a readable floor
+                if buffer.tell() <= Config.LLM_IMAGE_MAX_BYTES or quality <= 40:
+                    break
+                quality -= 10
+            self._llm_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        return self._llm_base64
+
+    def __repr__(self):
+        return f"QueryImage(source={self.source!r}, size={self.image.size})"
+
+
+def _open_image(fp):
+    with Image.open(fp) as image:
+        image.load()
+        return image.convert("RGB") if image.mode != "RGB" else image.copy()
@@ -0,0 +1,63 @@
+## index_files.py
+
+import json
+import logging
+import os
+import sqlite3
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Index state that can be read from disk without importing qdrant_client (which loads fastembed and ONNX Runtime),
+# so `cli.py status` stays fast. Layout of a local Qdrant index (qdrant_client.local):
+#   <QDRANT_PATH>/meta.json                               collection configs
+#   <QDRANT_PATH>/collection/<name>/storage.sqlite        one row per point in the `points` table
+LOCAL_META_FILE = "meta.json"
+LOCAL_STORAGE_FILE = "storage.sqlite"
+
+
+def is_persistent_index():
+    return bool(Config.QDRANT_URL or Config.QDRANT_PATH)
+
+
+def get_manifest_path(collection_name, shard=None):
+    if shard:
+        index, count = shard
+        manifest_dir = Config.QDRANT_PATH or Config.TEMP_DIR
+        return os.path.join(manifest_dir, f"{collection_name}_manifest.shard-{index}-of-{count}.json")
+    if Config.INDEX_MANIFEST_PATH:
+        return Config.INDEX_MANIFEST_PATH
+    manifest_dir = Config.QDRANT_PATH or Config.TEMP_DIR
+    return os.path.join(manifest_dir, f"{collection_name}_manifest.json")
+
+
+def load_manifest(collection_name, shard=None):
+    manifest_path = get_manifest_path(collection_name, shard)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except Exception as e:
+        logger.warning("Could not read index manifest %s: %s", manifest_path, e)
+        return None
+
+
+def count_local_points(index_path, collection_name):
+    # Point count of a collection in a local on-disk index, or None if the collection does not exist. Reads the
+    # files directly (read-only), so it also works while another process holds the index open.
+    meta_path = os.path.join(index_path, LOCAL_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as meta_file:
+        if collection_name not in json.load(meta_file).get("collections", {}):
+            return None
+    storage_path = os.path.join(index_path, "collection", collection_name, LOCAL_STORAGE_FILE)
+    if not os.path.exists(storage_path):
+        return 0
+    connection = sqlite3.connect(f"file:{storage_path}?mode=ro", uri=True)
+    try:
+        return connection.execute("SELECT COUNT(*) FROM points").fetchone()[0]
+    finally:
+        connection.close()
@@ -0,0 +1,259 @@
+## lexical_index.py
+
+import logging
+import math
+import os
+import pickle
+import re
+import threading
+import time
+
+import numpy as np
+from qdrant_client import models
+
+from config import Config
+from src.facets import normalize_filters, FACET_FIELDS
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were with which
+""".split())
+
+# One shared index per collection, like the embedding model registry
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(str(text).lower()) if token not in STOPWORDS]
+
+
+class _Snapshot:
+    # Immutable search view of a LexicalIndex: postings in CSR form (term -> slice of doc rows and their BM25
+    # term-frequency weights, which only depend on the document) and one boolean row mask per facet value.
+    # Searches read it without locking; writes to the index replace it.
+
+    def __init__(self, documents, k1, b):
+        self.point_ids = [point_id for point_id, _, _ in documents]
+        self.payloads = [payload for _, payload, _ in documents]
+        self.doc_count = len(documents)
+        lengths = np.fromiter((sum(term_counts.values()) for _, _, term_counts in documents), dtype=np.float64,
+                              count=self.doc_count)
+        average_length = lengths.mean() if self.doc_count else 0.0
+        length_norms = k1 * (1 - b + b * lengths / (average_length or 1.0))
+
+        self.terms = {}
+        term_ids, rows, frequencies = [], [], []
+        for row, (_, _, term_counts) in enumerate(documents):
+            for term, count in term_counts.items():
+                term_ids.append(self.terms.setdefault(term, len(self.terms)))
+                rows.append(row)
+                frequencies.append(count)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        self.rows = np.asarray(rows, dtype=np.int64)[order]
+        frequencies = np.asarray(frequencies, dtype=np.float64)[order]
+        self.weights = frequencies * (k1 + 1) / (frequencies + length_norms[self.rows])
+        self.indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.terms)), out=self.indptr[1:])
+
+        self.facet_masks = {field: {} for field in FACET_FIELDS}
+        for row, payload in enumerate(self.payloads):
+            for field in FACET_FIELDS:
+                value = payload.get(field)
+                mask = self.facet_masks[field].get(value)
+                if mask is None:
+                    mask = self.facet_masks[field][value] = np.zeros(self.doc_count, dtype=bool)
+                mask[row] = True
+
+    def filter_mask(self, filters):
+        # Rows whose payload matches every field (any of the field's values); None when nothing is filtered
+        allowed = None
+        for field, values in filters.items():
+            field_masks = self.facet_masks[field]
+            field_mask = np.zeros(self.doc_count, dtype=bool)
+            for value in values:
+                if value in field_masks:
+                    field_mask |= field_masks[value]
+            allowed = field_mask if allowed is None else allowed & field_mask
+        return allowed
+
+
+class LexicalIndex:
+    """In-memory inverted index over captions with BM25 scoring, kept in sync with the vector collection."""
+
+    def __init__(self, k1=None, b=None):
+        self.k1 = Config.BM25_K1 if k1 is None else k1
+        self.b = Config.BM25_B if b is None else b
+        self.documents = {}  # point id -> (payload, {term: frequency}), in insertion order
+        self._snapshot = None  # Search view, rebuilt on the first search after a change
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, point_id, caption, payload=None):
+        term_counts = {}
+        for token in tokenize(caption):
+            term_counts[token] = term_counts.get(token, 0) + 1
+        with self._lock:
+            # Re-adding a point replaces its previous caption
+            self.documents.pop(point_id, None)
+            self.documents[point_id] = (payload or {"caption": caption}, term_counts)
+            self._snapshot = None
+
+    def remove(self, point_id):
+        with self._lock:
+            if self.documents.pop(point_id, None) is not None:
+                self._snapshot = None
+
+    def _current_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    start_time = time.time()
+                    snapshot = self._snapshot = _Snapshot(
+                        [(point_id, payload, term_counts)
+                         for point_id, (payload, term_counts) in self.documents.items()], self.k1, self.b)
+                    logger.debug("Built lexical search snapshot of %s captions in %.2f seconds", snapshot.doc_count,
+                                 time.time() - start_time)
+        return snapshot
+
+    def search(self, query, limit=3, filters=None):
+        # Returns ScoredPoint objects so lexical hits fuse and render like vector hits. filters restrict the
+        # candidates before scoring, like the payload filter of the vector searches.
+        query_terms = set(tokenize(query))
+        filters = normalize_filters(filters)
+        snapshot = self._current_snapshot()
+        if not snapshot.doc_count or not query_terms or limit <= 0:
+            return []
+        allowed = snapshot.filter_mask(filters)
+        if allowed is not None and not allowed.any():
+            return []
+
+        rows, contributions = [], []
+        for term in query_terms:
+            term_id = snapshot.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = snapshot.indptr[term_id], snapshot.indptr[term_id + 1]
+            term_rows, weights = snapshot.rows[start:end], snapshot.weights[start:end]
+            # Document frequency and IDF come from the whole corpus, so filtering does not change the scores
+            idf = math.log(1 + (snapshot.doc_count - (end - start) + 0.5) / ((end - start) + 0.5))
+            if allowed is not None:
+                keep = allowed[term_rows]
+                term_rows, weights = term_rows[keep], weights[keep]
+            rows.append(term_rows)
+            contributions.append(idf * weights)
+        if not rows:
+            return []
+        scores = np.bincount(np.concatenate(rows), weights=np.concatenate(contributions),
+                             minlength=snapshot.doc_count)
+        # Every matched term adds a positive score, so the scored rows are exactly the candidates
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        # Highest score first; ties keep insertion order
+        best = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return [
+            models.ScoredPoint(id=snapshot.point_ids[row], version=0, score=float(scores[row]),
+                               payload=snapshot.payloads[row])
+            for row in best
+        ]
+
+    def save(self, path):
+        with self._lock:
+            state = {"k1": self.k1, "b": self.b, "points": [
+                (point_id, payload) for point_id, (payload, _) in self.documents.items()
+            ]}
+        # Only captions and payloads are stored; postings are rebuilt on load, which keeps the file small
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as index_file:
+            pickle.dump(state, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as index_file:
+            state = pickle.load(index_file)
+        index = cls(k1=state["k1"], b=state["b"])
+        for point_id, payload in state["points"]:
+            index.add(point_id, payload.get("caption", ""), payload)
+        return index
+
+
+def is_persisted():
+    return bool(Config.QDRANT_URL or Config.QDRANT_PATH)
+
+
+def get_lexical_index_path(collection_name):
+    index_dir = Config.QDRANT_PATH or Config.TEMP_DIR
+    return os.path.join(index_dir, f"{collection_name}_bm25.pkl")
+
+
+def get_lexical_index(collection_name):
+    # Shared per-collection index, loaded from disk on first use if a saved copy exists
+    with _indexes_lock:
+        index = _indexes.get(collection_name)
+        if index is None:
+            index_path = get_lexical_index_path(collection_name)
+            index = LexicalIndex()
+            # An in-memory vector index is rebuilt on every start, so a saved lexical index would be stale
+            if is_persisted() and os.path.exists(index_path):
+                try:
+                    start_time = time.time()
+                    index = LexicalIndex.load(index_path)
+                    logger.info("Loaded lexical index with %s captions in %.2f seconds", len(index),
+                                time.time() - start_time)
+                except Exception as e:
+                    logger.warning("Could not load lexical index %s: %s", index_path, e)
+                    index = LexicalIndex()
+            _indexes[collection_name] = index
+        return index
+
+
+def reset_lexical_index(collection_name):
+    index = LexicalIndex()
+    with _indexes_lock:
+        _indexes[collection_name] = index
+    return index
+
+
+def save_lexical_index(collection_name):
+    index = get_lexical_index(collection_name)
+    index_path = get_lexical_index_path(collection_name)
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    index.save(index_path)
+
+
+def rebuild_lexical_index(collection_name, client, batch_size=1000):
+    # Refill the lexical index from the payloads already stored in the collection (no embedding needed)
+    index = reset_lexical_index(collection_name)
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset,
+                                       with_payload=['image_path', 'caption', 'split', 'modality', 'body_region'],
+                                       with_vectors=False)
+        for point in points:
+            index.add(point.id, point.payload.get('caption', ''), point.payload)
+        if offset is None:
+            break
+    logger.info("Rebuilt lexical index from collection %s: %s captions", collection_name, len(index))
+    return index
+
+
+def ensure_lexical_index(collection_name, client):
+    # The lexical index is saved less often than the vector index; rebuild it if the two have drifted apart
+    index = get_lexical_index(collection_name)
+    point_count = client.count(collection_name).count
+    if len(index) != point_count:
+        logger.info("Lexical index has %s captions but the collection has %s points, rebuilding", len(index),
+                    point_count)
+        index = rebuild_lexical_index(collection_name, client)
+        if is_persisted():
+            save_lexical_index(collection_name)
+    return index
@@ -0,0 +1,140 @@
+## load_test.py
+
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+from config import Config
+from src.api_server import serve_api
+from src.benchmarks import StubLLMServer, override_attributes, latency_summary, synthetic_caption, git_commit
+
+logger = logging.getLogger(__name__)
+
+
+def wait_until_ready(host, port, process, timeout=300):
+    # Workers load the models and open the index before they accept connections
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not process.is_alive():
+            raise RuntimeError(f"API server exited with code {process.exitcode} during startup")
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=2)
+            connection.request("GET", "/health")
+            if connection.getresponse().status == 200:
+                connection.close()
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"API server did not become ready within {timeout} seconds")
+
+
+def _client_loop(host, port, path, queries, top_k, deadline, latencies, errors, lock):
+    # One keep-alive connection per client; requests are sent back to back until the deadline
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    local_latencies, local_errors = [], 0
+    while time.time() < deadline:
+        body = json.dumps({"query": next(queries), "top_k": top_k})
+        start_time = time.perf_counter()
+        try:
+            connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                local_latencies.append((time.perf_counter() - start_time) * 1000)
+            else:
+                local_errors += 1
+        except (OSError, http.client.HTTPException):
+            local_errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=60)
+    connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+
+class _QueryStream:
+    # Thread-safe endless supply of distinct synthetic questions, so the query embedding and response caches
+    # do not turn the load test into a cache benchmark
+
+    def __init__(self, seed):
+        self._rng = random.Random(seed)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            self._count += 1
+            return f"{synthetic_caption(self._rng)} Case {self._count}"
+
+
+def drive_load(host, port, path, clients, duration, top_k, seed):
+    latencies, errors, lock = [], [], threading.Lock()
+    queries = _QueryStream(seed)
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=_client_loop, daemon=True,
+                                args=(host, port, path, queries, top_k, deadline, latencies, errors, lock))
+               for _ in range(clients)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    return {"requests": len(latencies), "errors": sum(errors), "qps": round(len(latencies) / elapsed, 2),
+            "latency": latency_summary(latencies)}
+
+
+def run_load_test(worker_counts=(1, 2, 4), clients=16, duration=15, mode="retrieve", top_k=3, port=8765,
+                  llm_latency=0.2, seed=0):
+    # Starts `serve_api` with each worker count against the configured shared index (QDRANT_URL or SNAPSHOT_PATH),
+    # drives it with `clients` concurrent keep-alive clients for `duration` seconds and reports the QPS per worker
+    # count. Answers come from a local stub LLM, so `query` mode measures serving overhead, not the Groq API.
+    # Returns a JSON-serializable dict.
+    if mode not in ("retrieve", "query"):
+        raise ValueError(f"Unknown load test mode {mode!r}; use 'retrieve' or 'query'")
+    if not hasattr(os, "fork"):
+        raise RuntimeError("The load test forks the API server and needs Linux or macOS")
+    host = "127.0.0.1"
+    path = "/" + mode
+    runs = []
+    with StubLLMServer(latency=llm_latency) as llm, override_attributes(
+            Config, GROQ_BASE_URL=llm.base_url, GROQ_API_KEY="benchmark", GROQ_FALLBACK_MODELS=[],
+            GROQ_REQUESTS_PER_MINUTE=None, GROQ_TOKENS_PER_MINUTE=None, RESPONSE_CACHE_ENABLED=False):
+        for workers in worker_counts:
+            # The server process inherits the overrides above through the fork
+            process = multiprocessing.get_context("fork").Process(target=serve_api, args=(host, port, workers),
+                                                                  daemon=False)
+            process.start()
+            try:
+                wait_until_ready(host, port, process)
+                # A short untimed pass so each worker has served a request before measuring
+                drive_load(host, port, path, clients, min(2, duration), top_k, seed + 1000)
+                run = drive_load(host, port, path, clients, duration, top_k, seed)
+            finally:
+                process.terminate()
+                process.join(30)
+            run["workers"] = workers
+            runs.append(run)
+            logger.info("%s worker(s): %s QPS, p95 %s ms, %s errors", workers, run["qps"],
+                        run["latency"]["p95_ms"], run["errors"])
+
+    baseline = runs[0]["qps"] if runs else None
+    for run in runs:
+        run["speedup"] = round(run["qps"] / baseline, 2) if baseline else None
+    return {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": git_commit(),
+                 "cpu_count": os.cpu_count(), "index": Config.SNAPSHOT_PATH or Config.QDRANT_URL},
+        "parameters": {"mode": mode, "clients": clients, "duration": duration, "top_k": top_k,
+                       "worker_threads": Config.API_WORKER_THREADS, "llm_latency": llm_latency},
+        "runs": runs,
+    }
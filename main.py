@@ -1,151 +1,248 @@
-## main.py
-
-import gradio as gr
-from PIL import Image
-import numpy as np
-import os
-import sys
-import logging
-from config import Config
-
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logger = logging.getLogger("multimodal_assistant")
-
-# Import after logging is set up
-from src.multimodal_rag_system import MultimodalRAGSystem
-from src.groq_utils import GroqClient
-
-# Create a temporary directory for uploads if it doesn't exist
-TEMP_DIR = Config.TEMP_DIR
-os.makedirs(TEMP_DIR, exist_ok=True)
-logger.info(f"Temporary directory: {TEMP_DIR}")
-
-# Initialize the MultimodalRAGSystem
-logger.info("Initializing MultimodalRAGSystem...")
-try:
-    system = MultimodalRAGSystem()
-    logger.info("MultimodalRAGSystem initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize MultimodalRAGSystem: {str(e)}")
-    system = None
-
-
-def test_groq_api():
-    """Test function for Groq API connection"""
-    logger.info("Testing Groq API connection...")
-    try:
-        client = GroqClient()
-        response = client.query("Test message to verify API connection.", [], None)
-        result = client.process_response(response)
-        logger.info("Groq API test completed successfully")
-        return result
-    except Exception as e:
-        logger.error(f"Groq API test failed: {str(e)}")
-        return f"Error: {str(e)}"
-
-
-# Define the Gradio function that will process the user input and image
-def chatbot_interface(user_query, user_image=None):
-    """Process user query and optional image input"""
-    logger.info(f"Processing user query: {user_query}")
-    logger.info(f"User provided image: {user_image is not None}")
-
-    try:
-        if user_image is not None:
-            # If image is a numpy array (from Gradio), convert to PIL Image
-            if isinstance(user_image, np.ndarray):
-                logger.info(f"Converting numpy array image of shape {user_image.shape}")
-                user_image = Image.fromarray(user_image)
-
-            # Save the image temporarily
-            user_image_path = os.path.join(TEMP_DIR, "temp_upload.jpg")
-            user_image.save(user_image_path)
-            logger.info(f"Saved user image to: {user_image_path}")
-        else:
-            user_image_path = None
-            logger.info("No user image provided")
-
-        # Check if system is initialized
-        if system is None:
-            logger.error("MultimodalRAGSystem not initialized")
-            return "Error: System not initialized properly. Check logs for details."
-
-        # Get the response from the Multimodal AI system
-        logger.info("Calling process_query on MultimodalRAGSystem")
-        response = system.process_query(user_query, query_image_path=user_image_path)
-        logger.info("Received response from system")
-        return response
-    except Exception as e:
-        logger.error(f"Error in chatbot_interface: {str(e)}")
-        return f"Error processing your request: {str(e)}"
-
-
-# Create the Gradio interface with text input and image input
-# Create the Gradio interface with text input, image input, and a test button
-interface = gr.Interface(
-    fn=chatbot_interface,
-    inputs=[
-        gr.components.Textbox(lines=5, label="User Query", placeholder="Ask a medical question..."),
-        gr.components.Image(label="Upload Medical Image", type="pil")
-    ],
-    outputs=gr.components.Textbox(label="AI Response"),
-    title="Multimodal Medical Assistant",
-    description="Ask medical-related questions and upload relevant medical images for analysis.",
-    examples=[
-        ["Can you describe what you see in this X-ray?", None],
-        ["What might be causing the abnormality in this scan?", None],
-        ["Is there any fracture visible in this image?", None]
-    ]
-)
-
-# Add a separate interface for testing the API connection
-test_interface = gr.Interface(
-    fn=test_groq_api,
-    inputs=[],
-    outputs=gr.components.Textbox(label="API Test Result"),
-    title="Test Groq API Connection",
-    description="Click submit to test the connection to the Groq API."
-)
-
-
-# Add a utility function to check collection status
-def check_collection_status():
-    """Check the status of the Qdrant collection"""
-    try:
-        from src.create_data_embeddings import create_embeddings
-        from src.multimodal_rag_system import COLLECTION_NAME
-
-        client = create_embeddings(COLLECTION_NAME)
-        collection_info = client.get_collection(COLLECTION_NAME)
-        point_count = client.count(COLLECTION_NAME).count
-
-        return f"Collection info: {collection_info}\nPoints in collection: {point_count}"
-    except Exception as e:
-        return f"Error checking collection status: {str(e)}"
-
-
-# Add a diagnostic interface
-diagnostic_interface = gr.Interface(
-    fn=check_collection_status,
-    inputs=[],
-    outputs=gr.components.Textbox(label="Collection Status"),
-    title="Check Collection Status",
-    description="Check the status of the vector database collection."
-)
-
-# Launch the interfaces
-if __name__ == "__main__":
-    logger.info("Starting Gradio application...")
-    gr.TabbedInterface(
-        [interface, test_interface, diagnostic_interface],
-        ["Medical Assistant", "API Test", "Diagnostics"]
-    ).launch(debug=True)
-    logger.info("Gradio application stopped")
\ No newline at end of file
+## main.py
+
+import gradio as gr
+from PIL import Image
+import numpy as np
+import os
+import sys
+import logging
+import threading
+from config import Config
+
+# Setup logging
+logging.basicConfig(
+    level=Config.LOG_LEVEL,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("app.log"),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger("multimodal_assistant")
+
+# Import after logging is set up
+from src.multimodal_rag_system import MultimodalRAGSystem
+from src.groq_utils import GroqClient
+from src.facets import FACET_VALUES
+from src.image_utils import QueryImage
+from src import telemetry
+
+# Create a temporary directory for uploads if it doesn't exist
+TEMP_DIR = Config.TEMP_DIR
+os.makedirs(TEMP_DIR, exist_ok=True)
+logger.info(f"Temporary directory: {TEMP_DIR}")
+
+# The MultimodalRAGSystem is built on first use (or by launch()), never at import time
+_system = None
+_system_error = None
+_system_lock = threading.Lock()
+
+
+def get_system():
+    """Return the shared MultimodalRAGSystem, initializing it on the first call"""
+    global _system, _system_error
+    if _system is not None:
+        return _system
+    with _system_lock:
+        if _system is None and _system_error is None:
+            logger.info("Initializing MultimodalRAGSystem...")
+            try:
+                _system = MultimodalRAGSystem()
+                logger.info("MultimodalRAGSystem initialized successfully")
+            except Exception as e:
+                logger.error(f"Failed to initialize MultimodalRAGSystem: {str(e)}")
+                _system_error = e
+    return _system
+
+
+def test_groq_api():
+    """Test function for Groq API connection"""
+    logger.info("Testing Groq API connection...")
+    try:
+        client = GroqClient()
+        response = client.query("Test message to verify API connection.", [], None)
+        result = client.process_response(response)
+        logger.info("Groq API test completed successfully")
+        return result
+    except Exception as e:
+        logger.error(f"Groq API test failed: {str(e)}")
+        return f"Error: {str(e)}"
+
+
+def to_query_image(user_image):
+    """Per-request in-memory image, decoded once; nothing is written to a shared upload file"""
+    if user_image is None:
+        return None
+    # If image is a numpy array (from Gradio), convert to PIL Image
+    if isinstance(user_image, np.ndarray):
+        logger.info(f"Converting numpy array image of shape {user_image.shape}")
+        user_image = Image.fromarray(user_image)
+    return QueryImage.from_any(user_image)
+
+
+def selected_filters(splits=None, modalities=None, body_regions=None):
+    """Facet selections from the UI as a retrieval filter; an empty selection means any value"""
+    return {"split": splits or None, "modality": modalities or None, "body_region": body_regions or None}
+
+
+# Define the Gradio function that will process the user input and image
+async def chatbot_interface(user_query, user_image=None, splits=None, modalities=None, body_regions=None):
+    """Process user query and optional image input"""
+    logger.info(f"Processing user query: {user_query}")
+    logger.info(f"User provided image: {user_image is not None}")
+
+    try:
+        query_image = to_query_image(user_image)
+        filters = selected_filters(splits, modalities, body_regions)
+        system = get_system()
+
+        # Check if system is initialized
+        if system is None:
+            logger.error("MultimodalRAGSystem not initialized")
+            return "Error: System not initialized properly. Check logs for details."
+
+        # Get the response from the Multimodal AI system
+        logger.info("Calling process_query_async on MultimodalRAGSystem")
+        response = await system.process_query_async(user_query, query_image=query_image, filters=filters)
+        logger.info("Received response from system")
+        return response
+    except Exception as e:
+        logger.error(f"Error in chatbot_interface: {str(e)}")
+        return f"Error processing your request: {str(e)}"
+
+
+async def chatbot_interface_stream(user_query, user_image=None, splits=None, modalities=None, body_regions=None):
+    """Streaming variant of chatbot_interface: shows retrieval status, then the answer as it is generated"""
+    logger.info(f"Processing streaming user query: {user_query}")
+    try:
+        query_image = to_query_image(user_image)
+        filters = selected_filters(splits, modalities, body_regions)
+        system = get_system()
+
+        # Check if system is initialized
+        if system is None:
+            logger.error("MultimodalRAGSystem not initialized")
+            yield "Error: System not initialized properly. Check logs for details."
+            return
+
+        answer = ""
+        async for kind, text in system.process_query_stream_async(user_query, query_image=query_image,
+                                                                  filters=filters):
+            if kind == "token":
+                answer += text
+                yield answer
+            elif kind == "error":
+                yield f"{answer}\n\n{text}" if answer else text
+            else:
+                yield text
+    except Exception as e:
+        logger.error(f"Error in chatbot_interface_stream: {str(e)}")
+        yield f"Error processing your request: {str(e)}"
+
+
+# Add a utility function to check collection status
+def check_collection_status():
+    """Check the status of the Qdrant collection"""
+    try:
+        from src.create_data_embeddings import open_index, load_manifest
+        from src.multimodal_rag_system import COLLECTION_NAME
+
+        # Reuse the running system's client; status checks must never build the system or trigger re-embedding
+        system = _system
+        if system is not None:
+            client = system.qdrant_client
+        else:
+            client = open_index(COLLECTION_NAME)
+        if client is None:
+            return f"No persisted index found for collection {COLLECTION_NAME}"
+
+        collection_info = client.get_collection(COLLECTION_NAME)
+        point_count = client.count(COLLECTION_NAME).count
+        manifest = load_manifest(COLLECTION_NAME)
+        manifest_summary = "none"
+        if manifest is not None:
+            manifest_summary = f"{len(manifest.get('images', {}))} images indexed with {manifest.get('models')}"
+
+        cache_summary = "disabled"
+        if system is not None and system.groq_client.cache is not None:
+            cache_summary = system.groq_client.cache.stats()
+
+        embedding_cache_summary = "not loaded"
+        if system is not None:
+            from src.embeddings_utils import query_embedding_cache
+            embedding_cache_summary = query_embedding_cache.stats()
+
+        return (f"Collection info: {collection_info}\nPoints in collection: {point_count}\n"
+                f"Manifest: {manifest_summary}\nResponse cache: {cache_summary}\n"
+                f"Query embedding cache: {embedding_cache_summary}")
+    except Exception as e:
+        return f"Error checking collection status: {str(e)}"
+
+
+def diagnostics():
+    """Collection status plus live latency percentiles per stage, counters and the last request trace"""
+    return check_collection_status(), telemetry.format_summary()
+
+
+def build_app():
+    """Build the tabbed Gradio app; importing this module does not create any interface"""
+    # Create the Gradio interface with text input and image input
+    # Create the Gradio interface with text input, image input, and a test button
+    interface = gr.Interface(
+        fn=chatbot_interface_stream if Config.STREAM_RESPONSES else chatbot_interface,
+        inputs=[
+            gr.components.Textbox(lines=5, label="User Query", placeholder="Ask a medical question..."),
+            gr.components.Image(label="Upload Medical Image", type="pil"),
+            # Reference filters; leaving a group empty searches all of its values
+            gr.components.CheckboxGroup(FACET_VALUES["split"], label="Reference split"),
+            gr.components.CheckboxGroup(FACET_VALUES["modality"], label="Reference modality"),
+            gr.components.CheckboxGroup(FACET_VALUES["body_region"], label="Reference body region"),
+        ],
+        outputs=gr.components.Textbox(label="AI Response"),
+        title="Multimodal Medical Assistant",
+        description="Ask medical-related questions and upload relevant medical images for analysis.",
+        examples=[
+            ["Can you describe what you see in this X-ray?", None, [], ["X-ray"], []],
+            ["What might be causing the abnormality in this scan?", None, [], [], []],
+            ["Is there any fracture visible in this image?", None, [], [], []]
+        ]
+    )
+
+    # Add a separate interface for testing the API connection
+    test_interface = gr.Interface(
+        fn=test_groq_api,
+        inputs=[],
+        outputs=gr.components.Textbox(label="API Test Result"),
+        title="Test Groq API Connection",
+        description="Click submit to test the connection to the Groq API."
+    )
+
+    # Add a diagnostic interface
+    diagnostic_interface = gr.Interface(
+        fn=diagnostics,
+        inputs=[],
+        outputs=[gr.components.Textbox(label="Collection Status"),
+                 gr.components.Textbox(label="Live Metrics", lines=20)],
+        title="Check Collection Status",
+        description="Check the status of the vector database collection and the live request metrics."
+    )
+
+    return gr.TabbedInterface(
+        [interface, test_interface, diagnostic_interface],
+        ["Medical Assistant", "API Test", "Diagnostics"]
+    )
+
+
+def launch(server_name=None, server_port=None, concurrency=None):
+    # Build the index and load the models before accepting requests, so the first query is served warm
+    get_system()
+    if Config.METRICS_PORT:
+        telemetry.start_metrics_server()
+    logger.info("Starting Gradio application...")
+    build_app().queue(default_concurrency_limit=concurrency or Config.GRADIO_CONCURRENCY).launch(
+        server_name=server_name, server_port=server_port, debug=True)
+    logger.info("Gradio application stopped")
+
+
+if __name__ == "__main__":
+    launch()
@@ -1,73 +1,415 @@
-## multimodal_rag_system.py
-
-from src.create_data_embeddings import create_embeddings
-from src.embeddings_utils import search_similar_text, search_similar_image, merge_results
-from src.groq_utils import GroqClient  # New import for Groq client
-import os
-
-COLLECTION_NAME = "medical_images_text"
-
-
-class MultimodalRAGSystem:
-    collection_name: str
-
-    def __init__(self):
-        print("Initializing MultimodalRAGSystem...")
-        self.groq_client = GroqClient()  # Changed from GPTClient to GroqClient
-        try:
-            self.qdrant_client = create_embeddings(COLLECTION_NAME)
-            print(f"Collection {COLLECTION_NAME} created/loaded successfully")
-            # Check if collection has points
-            point_count = self.qdrant_client.count(COLLECTION_NAME).count
-            print(f"Collection has {point_count} points")
-        except Exception as e:
-            print(f"ERROR initializing Qdrant collection: {str(e)}")
-            raise
-        self.collection_name = COLLECTION_NAME
-
-    def process_query(self, query, query_image_path=None, top_k=3):
-        print(f"\n--- Processing query: '{query}' ---")
-        print(f"Query image path: {query_image_path}")
-        if query_image_path and not os.path.exists(query_image_path):
-            print(f"WARNING: Query image path does not exist: {query_image_path}")
-
-        # 1. Text-based search if query is textual
-        try:
-            search_results_text = search_similar_text(self.collection_name, self.qdrant_client, query, limit=top_k)
-            print(f"Text search found {len(search_results_text)} results")
-        except Exception as e:
-            print(f"ERROR in text search: {str(e)}")
-            search_results_text = []
-
-        # 2. Image-based search if a query image is provided
-        search_results_image = []
-        if query_image_path:  # Only perform image retrieval if an image path is provided
-            try:
-                search_results_image = search_similar_image(self.collection_name, self.qdrant_client, query_image_path,
-                                                            limit=top_k)
-                print(f"Image search found {len(search_results_image)} results")
-            except Exception as e:
-                print(f"ERROR in image search: {str(e)}")
-                search_results_image = []
-
-        # 3. Combine both results - merging text and image results
-        combined_results = merge_results(search_results_text, search_results_image)
-        print(f"Total combined results: {len(combined_results)}")
-
-        # 4. Query Groq with the context and images
-        try:
-            print("Calling Groq API...")
-            groq_response = self.groq_client.query(query, combined_results, query_image_path)
-            print("Groq API call completed")
-        except Exception as e:
-            print(f"ERROR in Groq API call: {str(e)}")
-            return f"Error: Could not get a response from the medical assistant. Details: {str(e)}"
-
-        # 5. Process and return the response
-        try:
-            response = self.groq_client.process_response(groq_response)
-            print(f"Response processed, length: {len(response) if response else 'None'}")
-            return response
-        except Exception as e:
-            print(f"ERROR processing response: {str(e)}")
-            return f"Error: Could not process the response. Details: {str(e)}"
\ No newline at end of file
+## multimodal_rag_system.py
+
+from src.create_data_embeddings import create_embeddings
+from src.embeddings_utils import search_similar_text, search_similar_image, merge_results, warmup_models, \
+    search_batch_text, search_batch_image, embed_query_text, embed_query_image, embed_query_texts, \
+    embed_query_images, preload_query_embeddings
+from src.groq_utils import GroqClient  # New import for Groq client
+from src.facets import normalize_filters
+from src.image_utils import QueryImage
+from src.lexical_index import ensure_lexical_index
+from src.reranking import rerank, fetch_vectors, rerank_results, above_min_score
+from src import telemetry
+from config import Config
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_NAME = "medical_images_text"
+
+
+class MultimodalRAGSystem:
+    collection_name: str
+
+    def __init__(self, qdrant_client=None, warmup=None):
+        logger.info("Initializing MultimodalRAGSystem...")
+        self.groq_client = GroqClient()  # Changed from GPTClient to GroqClient
+        try:
+            # An already opened index (e.g. from the CLI) skips the build/refresh step entirely
+            if qdrant_client is None:
+                qdrant_client = create_embeddings(COLLECTION_NAME)
+            self.qdrant_client = qdrant_client
+            logger.info("Collection %s created/loaded successfully", COLLECTION_NAME)
+            # Check if collection has points
+            point_count = self.qdrant_client.count(COLLECTION_NAME).count
+            logger.info("Collection has %s points", point_count)
+        except Exception as e:
+            logger.error("Error initializing Qdrant collection: %s", e)
+            raise
+        self.collection_name = COLLECTION_NAME
+
+        # BM25 index over captions, queried alongside the dense searches
+        self.lexical_index = None
+        if Config.LEXICAL_SEARCH_ENABLED:
+            try:
+                self.lexical_index = ensure_lexical_index(COLLECTION_NAME, self.qdrant_client)
+            except Exception as e:
+                logger.warning("Lexical index unavailable: %s", e)
+
+        self.retrieval_pool = ThreadPoolExecutor(max_workers=Config.RETRIEVAL_WORKERS,
+                                                 thread_name_prefix="retrieval")
+
+        # Load the shared embedding models now so the first query does not pay the session load
+        if Config.WARMUP_MODELS if warmup is None else warmup:
+            try:
+                warmup_models()
+            except Exception as e:
+                logger.warning("Embedding model warm-up failed: %s", e)
+
+        # Frequent queries are embedded up front, so they never wait on the text model
+        if Config.PRELOAD_QUERIES or Config.PRELOAD_QUERIES_PATH:
+            try:
+                preload_query_embeddings()
+            except Exception as e:
+                logger.warning("Query embedding preload failed: %s", e)
+
+    def _branch_result(self, future, branch, deadline, default=None):
+        # deadline: time.monotonic() value shared by all branches of a request, so waiting on them one after the
+        # other never exceeds RETRIEVAL_TIMEOUT in total. default: what a failed or timed-out branch returns ([]
+        # unless given)
+        try:
+            results = future.result(timeout=max(deadline - time.monotonic(), 0))
+            logger.debug("%s search finished", branch.capitalize())
+            return results
+        except TimeoutError:
+            logger.error("Error in %s search: timed out after %s seconds", branch, Config.RETRIEVAL_TIMEOUT)
+            telemetry.inc("retrieval_timeouts_total", branch=branch)
+            future.cancel()
+        except Exception as e:
+            logger.error("Error in %s search: %s", branch, e)
+        return [] if default is None else default
+
+    def _lexical_search(self, query, top_k, filters=None):
+        # In-process BM25 lookup; fast enough to run inline while the dense searches are in flight, and on the
+        # retrieval pool in the async path
+        if self.lexical_index is None:
+            return []
+        try:
+            with telemetry.span("lexical_search"):
+                results = self.lexical_index.search(query, limit=top_k, filters=filters)
+            logger.debug("Lexical search found %s results", len(results))
+            return results
+        except Exception as e:
+            logger.error("Error in lexical search: %s", e)
+            return []
+
+    def _search_limit(self, top_k):
+        # The reranker picks top_k out of a larger candidate pool per vector search
+        return max(top_k, Config.RERANK_CANDIDATES) if Config.RERANK_ENABLED else top_k
+
+    def _search_image(self, query_image, limit, filters):
+        # Image branch: returns (results, query image embedding), so the reranker reuses the embedding the search used
+        query_image_embedding = embed_query_image(query_image) if isinstance(query_image, QueryImage) else None
+        results = search_similar_image(self.collection_name, self.qdrant_client, query_image, limit=limit,
+                                       filters=filters, query_image_embedding=query_image_embedding)
+        logger.debug("Image search found %s results", len(results))
+        return results, query_image_embedding
+
+    def _rerank(self, text_results, image_results, query_embedding, image_embedding, top_k):
+        # Returns (text_results, image_results), each reranked by cross-modal similarity and cut to top_k
+        return rerank(self.qdrant_client, self.collection_name, [text_results, image_results], query_embedding,
+                      image_embedding if image_results else None, top_k)
+
+    def retrieve(self, query, query_image_path=None, top_k=3, filters=None):
+        # Returns (combined_results, query_embedding). filters restrict every retrieval channel to the given facet
+        # values, e.g. {"modality": "CT", "body_region": ["Chest", "Abdomen"]} (see facets.FACET_FIELDS).
+        filters = normalize_filters(filters)
+        with telemetry.span("retrieve"):
+            return self._retrieve(query, query_image_path, top_k, filters)
+
+    def _retrieve(self, query, query_image_path=None, top_k=3, filters=None):
+        query_image_path = QueryImage.from_any(query_image_path)
+        # 1./2. Text-based and image-based search run concurrently under one shared timeout; a failed or slow
+        # branch only loses its own results
+        image_future = None
+        if query_image_path is not None:  # Only perform image retrieval if an image is provided
+            image_future = self.retrieval_pool.submit(telemetry.bind(
+                self._search_image, query_image_path, self._search_limit(top_k), filters))
+
+        # The query embedding is computed once and shared by the text search and the response cache
+        query_embedding = None
+        try:
+            query_embedding = embed_query_text(query)
+        except Exception as e:
+            logger.error("Error embedding query text: %s", e)
+        text_future = self.retrieval_pool.submit(telemetry.bind(
+            search_similar_text, self.collection_name, self.qdrant_client, query, limit=self._search_limit(top_k),
+            query_embedding=query_embedding, filters=filters))
+        deadline = time.monotonic() + Config.RETRIEVAL_TIMEOUT
+
+        search_results_lexical = self._lexical_search(query, top_k, filters)
+        search_results_text = self._branch_result(text_future, "text", deadline)
+        search_results_image, image_embedding = [], None
+        if image_future is not None:
+            search_results_image, image_embedding = self._branch_result(image_future, "image", deadline, ([], None))
+        if Config.RERANK_ENABLED:
+            search_results_text, search_results_image = self._rerank(search_results_text, search_results_image,
+                                                                     query_embedding, image_embedding, top_k)
+
+        # 3. Combine the results - fusing text, image and lexical results
+        combined_results = merge_results(search_results_text, search_results_image, search_results_lexical,
+                                         reranked=Config.RERANK_ENABLED)
+        logger.debug("Total combined results: %s", len(combined_results))
+        return combined_results, query_embedding
+
+    def process_query(self, query, query_image_path=None, top_k=3, filters=None):
+        with telemetry.request("query"):
+            return self._process_query(query, query_image_path, top_k, filters)
+
+    def _process_query(self, query, query_image_path=None, top_k=3, filters=None):
+        logger.debug("Processing query: %r", query)
+        logger.debug("Query image path: %s", query_image_path)
+        if isinstance(query_image_path, str) and not os.path.exists(query_image_path):
+            logger.warning("Query image path does not exist: %s", query_image_path)
+
+        # Decode the image once; the same object feeds the CLIP embedding, the LLM payload and the cache key
+        query_image_path = QueryImage.from_any(query_image_path)
+        combined_results, query_embedding = self.retrieve(query, query_image_path, top_k, filters)
+
+        # 4. Query Groq with the context and images
+        try:
+            logger.debug("Calling Groq API...")
+            groq_response = self.groq_client.query(query, combined_results, query_image_path,
+                                                   query_embedding=query_embedding)
+            logger.debug("Groq API call completed")
+        except Exception as e:
+            logger.error("Error in Groq API call: %s", e)
+            telemetry.inc("query_errors_total", stage="llm")
+            return f"Error: Could not get a response from the medical assistant. Details: {str(e)}"
+
+        # 5. Process and return the response
+        try:
+            response = self.groq_client.process_response(groq_response)
+            logger.debug("Response processed, length: %s", len(response) if response else None)
+            return response
+        except Exception as e:
+            logger.error("Error processing response: %s", e)
+            return f"Error: Could not process the response. Details: {str(e)}"
+
+    def process_query_stream(self, query, query_image_path=None, top_k=3, filters=None):
+        # Streaming counterpart of process_query. Yields (kind, text) events: "status" while retrieving,
+        # then "token" for each generated chunk, or a final "error".
+        with telemetry.request("stream"):
+            yield from self._process_query_stream(query, query_image_path, top_k, filters)
+
+    def _process_query_stream(self, query, query_image_path=None, top_k=3, filters=None):
+        logger.debug("Processing streaming query: %r", query)
+        yield "status", "Searching similar cases..."
+        query_image_path = QueryImage.from_any(query_image_path)
+        combined_results, query_embedding = self.retrieve(query, query_image_path, top_k, filters)
+        yield "status", f"Found {len(combined_results)} reference cases. Generating answer..."
+
+        try:
+            for token in self.groq_client.query_stream(query, combined_results, query_image_path,
+                                                       query_embedding=query_embedding):
+                yield "token", token
+        except Exception as e:
+            logger.error("Error in Groq streaming call: %s", e)
+            telemetry.inc("query_errors_total", stage="llm")
+            yield "error", f"Error: Could not get a response from the medical assistant. Details: {str(e)}"
+
+    async def _branch_result_async(self, awaitable, branch, default=None):
+        try:
+            results = await asyncio.wait_for(awaitable, Config.RETRIEVAL_TIMEOUT)
+            logger.debug("%s search finished", branch.capitalize())
+            return results
+        except asyncio.TimeoutError:
+            logger.error("Error in %s search: timed out after %s seconds", branch, Config.RETRIEVAL_TIMEOUT)
+            telemetry.inc("retrieval_timeouts_total", branch=branch)
+        except Exception as e:
+            logger.error("Error in %s search: %s", branch, e)
+        return [] if default is None else default
+
+    async def retrieve_async(self, query, query_image=None, top_k=3, filters=None):
+        # Async counterpart of retrieve. query_image may be an in-memory PIL image, so concurrent requests never
+        # share an upload file. Embedding and search run on the retrieval pool to keep the event loop free.
+        filters = normalize_filters(filters)
+        with telemetry.span("retrieve"):
+            return await self._retrieve_async(query, query_image, top_k, filters)
+
+    async def _retrieve_async(self, query, query_image=None, top_k=3, filters=None):
+        loop = asyncio.get_running_loop()
+        query_image = QueryImage.from_any(query_image)
+        image_task = None
+        if query_image is not None:
+            image_task = loop.run_in_executor(self.retrieval_pool, telemetry.bind(
+                self._search_image, query_image, self._search_limit(top_k), filters))
+        # BM25 scoring is CPU work too; inline it would stall every other request on the event loop
+        lexical_task = loop.run_in_executor(self.retrieval_pool, telemetry.bind(
+            self._lexical_search, query, top_k, filters))
+
+        query_embedding = None
+        try:
+            query_embedding = await loop.run_in_executor(self.retrieval_pool, telemetry.bind(embed_query_text, query))
+        except Exception as e:
+            logger.error("Error embedding query text: %s", e)
+        text_task = loop.run_in_executor(self.retrieval_pool, telemetry.bind(
+            search_similar_text, self.collection_name, self.qdrant_client, query, limit=self._search_limit(top_k),
+            query_embedding=query_embedding, filters=filters))
+
+        branches = [self._branch_result_async(text_task, "text"), self._branch_result_async(lexical_task, "lexical")]
+        if image_task is not None:
+            branches.append(self._branch_result_async(image_task, "image", ([], None)))
+        results = await asyncio.gather(*branches)
+        search_results_text, search_results_lexical = results[:2]
+        search_results_image, image_embedding = results[2] if image_task is not None else ([], None)
+        if Config.RERANK_ENABLED:
+            search_results_text, search_results_image = await loop.run_in_executor(
+                self.retrieval_pool, telemetry.bind(self._rerank, search_results_text, search_results_image,
+                                                    query_embedding, image_embedding, top_k))
+
+        combined_results = merge_results(search_results_text, search_results_image, search_results_lexical,
+                                         reranked=Config.RERANK_ENABLED)
+        return combined_results, query_embedding
+
+    async def process_query_async(self, query, query_image=None, top_k=3, filters=None):
+        with telemetry.request("query"):
+            return await self._process_query_async(query, query_image, top_k, filters)
+
+    async def _process_query_async(self, query, query_image=None, top_k=3, filters=None):
+        query_image = QueryImage.from_any(query_image)
+        combined_results, query_embedding = await self.retrieve_async(query, query_image, top_k, filters)
+        try:
+            groq_response = await self.groq_client.query_async(query, combined_results, query_image,
+                                                               query_embedding=query_embedding)
+            return self.groq_client.process_response(groq_response)
+        except Exception as e:
+            logger.error("Error in Groq API call: %s", e)
+            telemetry.inc("query_errors_total", stage="llm")
+            return f"Error: Could not get a response from the medical assistant. Details: {str(e)}"
+
+    async def process_query_stream_async(self, query, query_image=None, top_k=3, filters=None):
+        # Async counterpart of process_query_stream, yielding the same (kind, text) events
+        with telemetry.request("stream"):
+            async for event in self._process_query_stream_async(query, query_image, top_k, filters):
+                yield event
+
+    async def _process_query_stream_async(self, query, query_image=None, top_k=3, filters=None):
+        yield "status", "Searching similar cases..."
+        query_image = QueryImage.from_any(query_image)
+        combined_results, query_embedding = await self.retrieve_async(query, query_image, top_k, filters)
+        yield "status", f"Found {len(combined_results)} reference cases. Generating answer..."
+
+        try:
+            async for token in self.groq_client.query_stream_async(query, combined_results, query_image,
+                                                                   query_embedding=query_embedding):
+                yield "token", token
+        except Exception as e:
+            logger.error("Error in Groq streaming call: %s", e)
+            telemetry.inc("query_errors_total", stage="llm")
+            yield "error", f"Error: Could not get a response from the medical assistant. Details: {str(e)}"
+
+    def retrieve_batch(self, queries, query_image_paths=None, top_k=3, filters=None):
+        # Retrieve references for many queries with one embedding call and one Qdrant request per modality.
+        # Returns one {"results", "error"} dict per query, in input order.
+        query_image_paths = query_image_paths or [None] * len(queries)
+        if len(query_image_paths) != len(queries):
+            raise ValueError("query_image_paths must have the same length as queries")
+        filters = normalize_filters(filters)
+        limit = self._search_limit(top_k)
+        items = [{"results": [], "error": None} for _ in queries]
+
+        # The query embeddings are computed once and shared by the batch searches and the reranker
+        text_embeddings = [None] * len(queries)
+        try:
+            text_embeddings = embed_query_texts(list(queries))
+            text_results = search_batch_text(self.collection_name, self.qdrant_client, list(queries), limit=limit,
+                                             filters=filters, query_embeddings=text_embeddings)
+        except Exception as e:
+            logger.error("Error in batch text search: %s", e)
+            text_results = [[] for _ in queries]
+            for item in items:
+                item["error"] = f"Text search failed: {str(e)}"
+
+        # Missing images are a per-item error; the remaining images are searched together
+        image_indices = []
+        for i, image_path in enumerate(query_image_paths):
+            if image_path and not os.path.exists(image_path):
+                items[i]["error"] = f"Image file not found: {image_path}"
+            elif image_path:
+                image_indices.append(i)
+        image_results, image_embeddings = {}, {}
+        try:
+            batch_embeddings = embed_query_images([query_image_paths[i] for i in image_indices])
+            batch_results = search_batch_image(self.collection_name, self.qdrant_client,
+                                               [query_image_paths[i] for i in image_indices], limit=limit,
+                                               filters=filters, query_embeddings=batch_embeddings)
+            image_results = dict(zip(image_indices, batch_results))
+            image_embeddings = dict(zip(image_indices, batch_embeddings))
+        except Exception as e:
+            logger.error("Error in batch image search: %s", e)
+            for i in image_indices:
+                items[i]["error"] = f"Image search failed: {str(e)}"
+
+        if Config.RERANK_ENABLED:
+            text_results, image_results = self._rerank_batch(text_results, image_results, text_embeddings,
+                                                             image_embeddings, top_k)
+
+        for i, item in enumerate(items):
+            item["results"] = merge_results(text_results[i], image_results.get(i, []),
+                                            self._lexical_search(queries[i], top_k, filters),
+                                            reranked=Config.RERANK_ENABLED)
+        return items
+
+    def _rerank_batch(self, text_results, image_results, text_embeddings, image_embeddings, top_k):
+        # Same reranking as retrieve, with the stored vectors of all queries' candidates fetched in one call and the
+        # query embeddings the batch searches used
+        text_results = above_min_score(text_results)
+        image_results = dict(zip(image_results, above_min_score(list(image_results.values()))))
+        point_ids = list(dict.fromkeys(result.id for results in list(text_results) + list(image_results.values())
+                                       for result in results))
+        try:
+            with telemetry.span("rerank"):
+                fetched_ids, text_vectors, image_vectors = fetch_vectors(self.qdrant_client, self.collection_name,
+                                                                         point_ids)
+                reranked_text, reranked_image = [], {}
+                for i, text_embedding in enumerate(text_embeddings):
+                    image_embedding = image_embeddings.get(i) if image_results.get(i) else None
+                    reranked_text_i, reranked_image_i = rerank_results(
+                        [text_results[i], image_results.get(i, [])], fetched_ids, text_vectors, image_vectors,
+                        text_embedding, image_embedding, top_k)
+                    reranked_text.append(reranked_text_i)
+                    reranked_image[i] = reranked_image_i
+            return reranked_text, reranked_image
+        except Exception as e:
+            logger.error("Error reranking batch candidates: %s", e)
+            return ([results[:top_k] for results in text_results],
+                    {i: results[:top_k] for i, results in image_results.items()})
+
+    def _answer(self, index, query, query_image_path, retrieved):
+        with telemetry.request("batch"):
+            return self._answer_item(index, query, query_image_path, retrieved)
+
+    def _answer_item(self, index, query, query_image_path, retrieved):
+        item = {"index": index, "query": query, "response": None, "error": retrieved["error"]}
+        try:
+            groq_response = self.groq_client.query(query, retrieved["results"], query_image_path)
+            if isinstance(groq_response, dict) and 'error' in groq_response:
+                item["error"] = groq_response['error']
+            item["response"] = self.groq_client.process_response(groq_response)
+        except Exception as e:
+            item["error"] = str(e)
+        return item
+
+    def iter_process_queries(self, queries, query_image_paths=None, top_k=3, max_concurrency=None, filters=None):
+        # Batched counterpart of process_query. Retrieval is batched, LLM calls fan out over a bounded pool and
+        # results are yielded as they complete; each carries its input "index".
+        query_image_paths = query_image_paths or [None] * len(queries)
+        retrieved = self.retrieve_batch(queries, query_image_paths, top_k=top_k, filters=filters)
+        max_concurrency = max_concurrency or Config.LLM_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm") as llm_pool:
+            futures = [llm_pool.submit(self._answer, i, query, query_image_paths[i], retrieved[i])
+                       for i, query in enumerate(queries)]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def process_queries(self, queries, query_image_paths=None, top_k=3, max_concurrency=None, filters=None):
+        # Same as iter_process_queries, but returns all results in input order
+        results = [None] * len(queries)
+        for item in self.iter_process_queries(queries, query_image_paths, top_k, max_concurrency, filters):
+            results[item["index"]] = item
+        return results
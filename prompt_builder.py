@@ -0,0 +1,149 @@
+## prompt_builder.py
+
+import os
+import threading
+from collections import namedtuple
+
+from config import Config
+
+# Fixed instructions, identical byte-for-byte on every request so the provider can reuse the cached prefix
+SYSTEM_PROMPT = ("You are a radiologist with an experience of 30 years.\n"
+                 "You analyse medical scans and text, and help diagnose underlying issues.\n\n"
+                 "Please analyze the following query and image using your expertise.")
+REFERENCE_HEADER = ("Additional context that you may use as a reference. Use them if you feel they are relevant to "
+                    "the case. NOTE: They are not the patient's images. They are descriptions of other patients' "
+                    "images which can be used as a reference, if required.\n\n")
+TRUNCATION_MARK = " [...]"
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separator tokens the chat template adds around each message
+MIN_REFERENCE_TOKENS = 24  # A reference cut shorter than this carries too little to be worth sending
+
+PromptBuild = namedtuple("PromptBuild", ["messages", "input_tokens", "references_used", "references_truncated",
+                                         "references_dropped"])
+
+
+class TokenCounter:
+    """Local token counts: tiktoken when it is installed, otherwise ~4 characters per token."""
+
+    def __init__(self, encoding_name=None):
+        self.encoding = None
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(encoding_name or Config.TOKENIZER_ENCODING)
+        except Exception:
+            # tiktoken is optional; the heuristic over-counts slightly, which keeps the budget safe
+            pass
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def truncate(self, text, max_tokens):
+        # Cut text to at most max_tokens (including the truncation mark), on a word boundary where possible
+        if self.count(text) <= max_tokens:
+            return text
+        keep = max(0, max_tokens - self.count(TRUNCATION_MARK))
+        if self.encoding is not None:
+            cut = self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:keep])
+        else:
+            cut = text[:keep * 4]
+        if " " in cut:
+            cut = cut.rsplit(" ", 1)[0]
+        return cut.rstrip() + TRUNCATION_MARK
+
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter():
+    global _token_counter
+    if _token_counter is None:
+        with _token_counter_lock:
+            if _token_counter is None:
+                _token_counter = TokenCounter()
+    return _token_counter
+
+
+def count_tokens(text):
+    return get_token_counter().count(text)
+
+
+class PromptBuilder:
+    """Assembles chat messages: a stable instruction prefix, the question, the image and as many references as
+    fit the input token budget."""
+
+    def __init__(self, system_prompt=SYSTEM_PROMPT, input_token_budget=None, reference_max_tokens=None,
+                 use_system_message=None, counter=None):
+        self.counter = counter or get_token_counter()
+        self.input_token_budget = input_token_budget or Config.PROMPT_INPUT_TOKEN_BUDGET
+        self.reference_max_tokens = reference_max_tokens or Config.PROMPT_REFERENCE_MAX_TOKENS
+        self.use_system_message = Config.PROMPT_USE_SYSTEM_MESSAGE if use_system_message is None \
+            else use_system_message
+        self.system_prompt = system_prompt
+        # Counted once; these parts never change between requests
+        self.system_tokens = self.counter.count(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        self.header_tokens = self.counter.count(REFERENCE_HEADER)
+
+    def format_reference(self, number, caption, image_path):
+        return f"Reference {number}: {caption}\nSource: {os.path.basename(image_path)}\n\n"
+
+    def build_references(self, retrieved_contexts, token_budget):
+        # Returns (reference block, tokens used, used, truncated, dropped). References arrive in rank order, so
+        # the lowest-ranked ones are cut first.
+        if not retrieved_contexts or token_budget <= self.header_tokens:
+            return "", 0, 0, 0, len(retrieved_contexts or [])
+        parts = [REFERENCE_HEADER]
+        used_tokens = self.header_tokens
+        used = truncated = 0
+        for context in retrieved_contexts:
+            try:
+                caption = str(context.payload['caption'])
+                image_path = context.payload['image_path']
+            except Exception:
+                continue
+            reference = self.format_reference(used + 1, caption, image_path)
+            cost = self.counter.count(reference)
+            remaining = token_budget - used_tokens
+            limit = min(self.reference_max_tokens, remaining)
+            if cost > limit:
+                # Shorten the caption; the "Reference n:" and "Source:" lines are kept whole
+                frame_tokens = cost - self.counter.count(caption)
+                if limit - frame_tokens < MIN_REFERENCE_TOKENS:
+                    break
+                caption = self.counter.truncate(caption, limit - frame_tokens)
+                reference = self.format_reference(used + 1, caption, image_path)
+                cost = self.counter.count(reference)
+                truncated += 1
+            parts.append(reference)
+            used_tokens += cost
+            used += 1
+        if not used:
+            return "", 0, 0, 0, len(retrieved_contexts)
+        return "".join(parts), used_tokens, used, truncated, len(retrieved_contexts) - used
+
+    def build(self, prompt, retrieved_contexts=None, image_url=None):
+        prompt_tokens = self.counter.count(prompt) + MESSAGE_OVERHEAD_TOKENS
+        image_tokens = Config.GROQ_IMAGE_TOKEN_ESTIMATE if image_url else 0
+        # The question and the image are always sent; the references get whatever budget is left
+        reference_budget = self.input_token_budget - self.system_tokens - prompt_tokens - image_tokens
+        references, reference_tokens, used, truncated, dropped = self.build_references(retrieved_contexts,
+                                                                                      reference_budget)
+
+        if self.use_system_message:
+            messages = [{"role": "system", "content": self.system_prompt}]
+            user_content = [{"type": "text", "text": prompt}]
+        else:
+            # Some vision endpoints reject system messages; the instructions then lead the user message instead
+            messages = []
+            user_content = [{"type": "text", "text": f"{self.system_prompt}\n\n{prompt}"}]
+        if image_url:
+            user_content.append({"type": "image_url", "image_url": {"url": image_url}})
+        if references:
+            user_content.append({"type": "text", "text": references})
+        messages.append({"role": "user", "content": user_content})
+
+        input_tokens = self.system_tokens + prompt_tokens + image_tokens + reference_tokens
+        return PromptBuild(messages, input_tokens, used, truncated, dropped)
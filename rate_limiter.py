@@ -0,0 +1,159 @@
+## rate_limiter.py
+
+import asyncio
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class TokenBucket:
+    """Thread-safe token bucket. reserve() books capacity up front and returns how long to wait for it."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_second = rate_per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1.0):
+        # Requests larger than the bucket are capped so they can still go through, just at the slowest pace
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            self._updated_at = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate_per_second
+
+
+class HybridSemaphore:
+    """Counting semaphore shared by threads and coroutines. Threads block on a condition; coroutines await a future
+    that release() resolves on the waiter's event loop, so neither side polls."""
+
+    def __init__(self, value):
+        self._value = value
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters = deque()  # (loop, future), oldest first
+
+    def acquire(self):
+        with self._condition:
+            while self._value <= 0:
+                self._condition.wait()
+            self._value -= 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0:
+                self._value -= 1
+                return
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._async_waiters.remove((loop, future))
+                except ValueError:
+                    pass  # Already handed a permit: _grant gives it back, or it is released below
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            # Waiting coroutines get the permit handed over directly; threads wait for the count to go up
+            while self._async_waiters:
+                loop, future = self._async_waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue  # The waiter's event loop is closed
+            self._value += 1
+            self._condition.notify()
+
+    def _grant(self, future):
+        # Runs on the waiter's loop; a waiter cancelled in the meantime passes the permit on
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class RequestLimiter:
+    """Caps in-flight requests and paces every HTTP attempt by requests/min and tokens/min."""
+
+    def __init__(self, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None):
+        self._slots = HybridSemaphore(max_concurrency)
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _pacing_delay(self, estimated_tokens):
+        delay = 0.0
+        if self._requests is not None:
+            delay = max(delay, self._requests.reserve(1))
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.reserve(estimated_tokens))
+        return delay
+
+    def pace(self, estimated_tokens=0):
+        # Call before every HTTP attempt, retries included: each one counts against the provider's limits
+        delay = self._pacing_delay(estimated_tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def pace_async(self, estimated_tokens=0):
+        delay = self._pacing_delay(estimated_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    @contextmanager
+    def slot(self):
+        # One logical request, held across its retries and, for streams, until the stream is consumed
+        self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self._slots.acquire_async()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+def backoff_delay(attempt, base_delay, max_delay, retry_after=None):
+    # Exponential backoff with full jitter; a server-provided retry-after always wins if it is longer
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("x-ratelimit-reset-requests")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # Durations such as "2.5s", "500ms" or "1m3s" from the x-ratelimit headers
+        units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+        total = sum(float(number) * units[unit] for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value))
+        return total or None
@@ -0,0 +1,104 @@
+## reranking.py
+
+import copy
+import logging
+
+import numpy as np
+
+from config import Config
+from src import telemetry
+from src.embeddings_utils import CONFIGURED
+
+logger = logging.getLogger(__name__)
+
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def fetch_vectors(client, collection_name, point_ids):
+    # Stored text and image vectors of all candidates in one retrieve call -> (ids, text matrix, image matrix)
+    if not point_ids:
+        return [], None, None
+    with telemetry.span("rerank_fetch"):
+        records = client.retrieve(collection_name=collection_name, ids=list(point_ids), with_payload=False,
+                                  with_vectors=['text', 'image'])
+    records = [record for record in records if record.vector and 'text' in record.vector and 'image' in record.vector]
+    if not records:
+        return [], None, None
+    text_vectors = _unit_rows(np.asarray([record.vector['text'] for record in records], dtype=np.float32))
+    image_vectors = _unit_rows(np.asarray([record.vector['image'] for record in records], dtype=np.float32))
+    return [record.id for record in records], text_vectors, image_vectors
+
+
+def cross_modal_scores(text_vectors, image_vectors, text_embedding=None, image_embedding=None, cross_weight=None):
+    # One score per candidate row. For each query modality: (1 - w) * same-modal cosine + w * cross-modal cosine
+    # (query text vs. candidate image, query image vs. candidate caption), averaged over the query modalities given.
+    cross_weight = Config.RERANK_CROSS_WEIGHT if cross_weight is None else cross_weight
+    scores = np.zeros(len(text_vectors), dtype=np.float32)
+    parts = 0
+    for query_embedding, same_vectors, cross_vectors in ((text_embedding, text_vectors, image_vectors),
+                                                         (image_embedding, image_vectors, text_vectors)):
+        if query_embedding is None:
+            continue
+        query_vector = _unit_rows(np.asarray(query_embedding, dtype=np.float32))
+        scores += (1 - cross_weight) * (same_vectors @ query_vector) + cross_weight * (cross_vectors @ query_vector)
+        parts += 1
+    return scores / parts if parts else scores
+
+
+def rerank_results(result_lists, point_ids, text_vectors, image_vectors, text_embedding=None, image_embedding=None,
+                   top_k=3):
+    # Re-sort each channel's candidates by the cross-modal score and keep its best top_k. Candidates whose vectors
+    # could not be fetched keep their search score. Returned points carry the rerank score.
+    if text_embedding is None and image_embedding is None:
+        return [results[:top_k] for results in result_lists]
+    # point_ids may cover more candidates than these lists (a whole batch); only their rows are scored
+    rows = {point_id: row for row, point_id in enumerate(point_ids)}
+    candidate_ids = [point_id for point_id in dict.fromkeys(result.id for results in result_lists for result in results)
+                     if point_id in rows]
+    scores = {}
+    if candidate_ids:
+        selected = [rows[point_id] for point_id in candidate_ids]
+        scores = dict(zip(candidate_ids, cross_modal_scores(text_vectors[selected], image_vectors[selected],
+                                                            text_embedding, image_embedding).tolist()))
+    reranked_lists = []
+    for results in result_lists:
+        reranked = []
+        for result in results:
+            point = copy.copy(result)
+            point.score = scores.get(result.id, result.score)
+            reranked.append(point)
+        reranked.sort(key=lambda point: point.score, reverse=True)
+        reranked_lists.append(reranked[:top_k])
+    return reranked_lists
+
+
+def above_min_score(result_lists, min_score=CONFIGURED):
+    # The similarity threshold (FUSION_MIN_SCORE) is defined on search cosine similarity, so it is applied here,
+    # before the search scores are replaced by rerank scores. min_score=None keeps every result.
+    min_score = Config.FUSION_MIN_SCORE if min_score is CONFIGURED else min_score
+    if min_score is None:
+        return result_lists
+    return [[result for result in results if result.score >= min_score] for results in result_lists]
+
+
+def rerank(client, collection_name, result_lists, text_embedding=None, image_embedding=None, top_k=3):
+    """Rerank over-fetched candidate lists (e.g. [text hits, image hits]) against the query embeddings the searches
+    used and the stored vectors; no model inference and a single Qdrant round trip. Candidates below the similarity
+    threshold are dropped first. Falls back to the search order on errors."""
+    result_lists = above_min_score(result_lists)
+    if text_embedding is None and image_embedding is None:
+        return [results[:top_k] for results in result_lists]
+    point_ids = list(dict.fromkeys(result.id for results in result_lists for result in results))
+    try:
+        with telemetry.span("rerank"):
+            fetched_ids, text_vectors, image_vectors = fetch_vectors(client, collection_name, point_ids)
+            reranked = rerank_results(result_lists, fetched_ids, text_vectors, image_vectors, text_embedding,
+                                      image_embedding, top_k)
+        logger.debug("Reranked %s candidates", len(point_ids))
+        return reranked
+    except Exception as e:
+        logger.error("Error reranking candidates: %s", e)
+        return [results[:top_k] for results in result_lists]
@@ -0,0 +1,158 @@
+## response_cache.py
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(prompt, image_hash, point_ids, model, max_tokens):
+    # Exact-match key: the answer only depends on these inputs
+    key_source = json.dumps([prompt, image_hash, sorted(str(p) for p in point_ids), model, max_tokens])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def make_context_key(image_hash, point_ids, model, max_tokens):
+    # Everything except the prompt; semantic matches are only allowed within the same context
+    key_source = json.dumps([image_hash, sorted(str(p) for p in point_ids), model, max_tokens])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-level LLM response cache: exact key match, then optional query-embedding similarity."""
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, semantic_threshold=None, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_threshold = semantic_threshold
+        self._entries = OrderedDict()  # key -> entry, least recently used first
+        self._by_context = {}  # context key -> set of keys, for semantic lookups
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._db = None
+        if persist_path:
+            self._open_db(persist_path)
+
+    @classmethod
+    def from_config(cls):
+        return cls(max_entries=Config.RESPONSE_CACHE_SIZE,
+                   ttl_seconds=Config.RESPONSE_CACHE_TTL,
+                   semantic_threshold=Config.RESPONSE_CACHE_SEMANTIC_THRESHOLD,
+                   persist_path=Config.RESPONSE_CACHE_PATH)
+
+    def _open_db(self, persist_path):
+        self._db = sqlite3.connect(persist_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, context_key TEXT, "
+                         "response TEXT, embedding BLOB, expires_at REAL)")
+        self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        self._db.commit()
+        # Warm the in-memory level with the entries that expire last
+        rows = self._db.execute("SELECT key, context_key, response, embedding, expires_at FROM responses "
+                                "ORDER BY expires_at DESC LIMIT ?", (self.max_entries,)).fetchall()
+        for key, context_key, response, embedding, expires_at in reversed(rows):
+            if embedding is not None:
+                embedding = np.frombuffer(embedding, dtype=np.float32)
+            self._store(key, context_key, json.loads(response), embedding, expires_at)
+        logger.info("Loaded %s cached responses from %s", len(rows), persist_path)
+
+    def _store(self, key, context_key, response, embedding, expires_at):
+        self._entries[key] = {"context_key": context_key, "response": response, "embedding": embedding,
+                              "expires_at": expires_at}
+        self._entries.move_to_end(key)
+        self._by_context.setdefault(context_key, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = next(iter(self._entries.items()))
+            self._remove(old_key)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_context.get(entry["context_key"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry["context_key"]]
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _live_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] < now:
+            self._remove(key)
+            self._stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, context_key=None, query_embedding=None):
+        now = time.time()
+        with self._lock:
+            entry = self._live_entry(key, now)
+            if entry is not None:
+                self._stats["hits"] += 1
+                return entry["response"]
+
+            # Semantic level: the most similar cached query with the same context, above the threshold
+            if self.semantic_threshold is not None and query_embedding is not None and context_key is not None:
+                query_vector = _normalize(query_embedding)
+                best_key, best_score = None, self.semantic_threshold
+                for candidate_key in list(self._by_context.get(context_key, ())):
+                    candidate = self._live_entry(candidate_key, now)
+                    if candidate is None or candidate["embedding"] is None:
+                        continue
+                    score = float(np.dot(query_vector, candidate["embedding"]))
+                    if score >= best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None:
+                    self._stats["semantic_hits"] += 1
+                    return self._entries[best_key]["response"]
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, response, context_key=None, query_embedding=None):
+        embedding = _normalize(query_embedding) if query_embedding is not None else None
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store(key, context_key, response, embedding, expires_at)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                 (key, context_key, json.dumps(response),
+                                  embedding.tobytes() if embedding is not None else None, expires_at))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -0,0 +1,323 @@
+## snapshot.py
+
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+from qdrant_client import models
+
+from config import Config
+from src.embeddings_utils import TEXT_MODEL_NAME, IMAGE_MODEL_NAME
+from src.facets import FACET_FIELDS
+from src.storage_profiles import VECTOR_NAMES, VECTOR_SIZE, get_search_params
+
+logger = logging.getLogger(__name__)
+
+# On-disk layout of an embedding snapshot directory:
+#   snapshot.json                 format version, collection, models, dtype, row count and payload schema
+#   ids.npy                       point ID of every row
+#   text.npy, image.npy           (rows, 512) L2-normalized vectors, float32 or float16, row-aligned with ids.npy
+#   payload/<field>.codes.npy     facet fields: int16 category codes (-1 = missing), categories in snapshot.json
+#   payload/<field>.data.npy      other fields: UTF-8 bytes of all rows back to back (uint8)
+#   payload/<field>.offsets.npy   row i is data[offsets[i]:offsets[i + 1]] (int64, rows + 1)
+#   payload/<field>.valid.npy     only present if some rows lack the field (bool)
+# Every array is a plain .npy file, so loading memory-maps it: no copy is made and all processes that open the same
+# snapshot share one physical copy through the page cache.
+SNAPSHOT_FORMAT = "embedding-snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DTYPES = ("float32", "float16")
+MANIFEST_NAME = "snapshot.json"
+SEARCH_CHUNK_ROWS = 65536  # float16 rows upcast per step of an exact search, bounding its temporary memory
+
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def _write_payload_columns(payload_dir, payloads):
+    # Columnar payload: facet fields as category codes, everything else as offset-indexed UTF-8 strings
+    fields = sorted({field for payload in payloads for field in payload})
+    schema = {}
+    for field in fields:
+        values = [payload.get(field) for payload in payloads]
+        valid = np.array([value is not None for value in values], dtype=bool)
+        if field in FACET_FIELDS:
+            categories = sorted({str(value) for value in values if value is not None})
+            codes = {category: code for code, category in enumerate(categories)}
+            np.save(os.path.join(payload_dir, f"{field}.codes.npy"),
+                    np.array([codes[str(value)] if value is not None else -1 for value in values], dtype=np.int16))
+            schema[field] = {"kind": "category", "categories": categories}
+            continue
+        encoded = [str(value).encode("utf-8") if value is not None else b"" for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(payload_dir, f"{field}.data.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(payload_dir, f"{field}.offsets.npy"), offsets)
+        schema[field] = {"kind": "string"}
+        if not valid.all():
+            np.save(os.path.join(payload_dir, f"{field}.valid.npy"), valid)
+            schema[field]["nullable"] = True
+    return schema
+
+
+def export_snapshot(client, collection_name, path, dtype=None, batch_size=1000):
+    """Write the vectors and payloads of a collection to a snapshot directory (see the layout above). Vectors are
+    streamed into preallocated memory-mapped files; the directory is replaced atomically when complete."""
+    dtype = dtype or Config.SNAPSHOT_DTYPE
+    if dtype not in SNAPSHOT_DTYPES:
+        raise ValueError(f"Unknown snapshot dtype: {dtype}. Available: {', '.join(SNAPSHOT_DTYPES)}")
+    start_time = time.time()
+    count = client.count(collection_name).count
+    if not count:
+        raise ValueError(f"Collection {collection_name} is empty; nothing to export")
+    tmp_path = path.rstrip("/\\") + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_path, "payload"))
+
+    matrices = {name: np.lib.format.open_memmap(os.path.join(tmp_path, f"{name}.npy"), mode="w+", dtype=dtype,
+                                                shape=(count, VECTOR_SIZE))
+                for name in VECTOR_NAMES}
+    ids = []
+    payloads = []
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset,
+                                       with_payload=True, with_vectors=list(VECTOR_NAMES))
+        if len(ids) + len(points) > count:
+            raise RuntimeError(f"Collection {collection_name} changed during the export; retry when ingest is idle")
+        if points:
+            rows = slice(len(ids), len(ids) + len(points))
+            for name, matrix in matrices.items():
+                matrix[rows] = _unit_rows(np.asarray([point.vector[name] for point in points], dtype=np.float32))
+            ids.extend(point.id for point in points)
+            payloads.extend(point.payload or {} for point in points)
+        if offset is None:
+            break
+    if len(ids) != count:
+        raise RuntimeError(f"Collection {collection_name} changed during the export; retry when ingest is idle")
+    for matrix in matrices.values():
+        matrix.flush()
+    del matrices
+
+    # Qdrant point IDs are UUID strings or unsigned integers
+    if all(isinstance(point_id, int) for point_id in ids):
+        np.save(os.path.join(tmp_path, "ids.npy"), np.array(ids, dtype=np.uint64))
+    else:
+        np.save(os.path.join(tmp_path, "ids.npy"), np.array([str(point_id) for point_id in ids], dtype=np.str_))
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "collection_name": collection_name,
+        "models": {"text": TEXT_MODEL_NAME, "image": IMAGE_MODEL_NAME},
+        "dtype": dtype,
+        "dimension": VECTOR_SIZE,
+        "count": count,
+        "payload": _write_payload_columns(os.path.join(tmp_path, "payload"), payloads),
+        "created_at": time.time(),
+    }
+    with open(os.path.join(tmp_path, MANIFEST_NAME), "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    logger.info("Exported %s points of %s to %s (%s) in %.2f seconds", count, collection_name, path, dtype,
+                time.time() - start_time)
+    return manifest
+
+
+def load_snapshot_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} embedding snapshot")
+    return manifest
+
+
+class SnapshotIndex:
+    """Exact (brute-force) NumPy search over a memory-mapped embedding snapshot.
+
+    Implements the part of the QdrantClient interface the retrieval code uses (count, scroll, search, search_batch,
+    retrieve), so it can stand in for the vector database in small deployments and serve as ground truth for recall
+    checks. Only `must` conditions on the facet fields are supported as filters."""
+
+    def __init__(self, path, collection_name=None, mmap=True):
+        self.path = path
+        self.manifest = load_snapshot_manifest(path)
+        if collection_name is not None and collection_name != self.manifest["collection_name"]:
+            raise ValueError(f"Snapshot {path} holds collection {self.manifest['collection_name']}, "
+                             f"not {collection_name}")
+        mmap_mode = "r" if mmap else None
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode)
+        self.vectors = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                        for name in VECTOR_NAMES}
+        self.columns = {}
+        for field, column in self.manifest["payload"].items():
+            column_path = os.path.join(path, "payload", field)
+            if column["kind"] == "category":
+                self.columns[field] = (column, np.load(column_path + ".codes.npy", mmap_mode=mmap_mode))
+            else:
+                valid = None
+                if column.get("nullable"):
+                    valid = np.load(column_path + ".valid.npy", mmap_mode=mmap_mode)
+                self.columns[field] = (column, (np.load(column_path + ".data.npy", mmap_mode=mmap_mode),
+                                                np.load(column_path + ".offsets.npy", mmap_mode=mmap_mode), valid))
+        self._rows = None  # point ID -> row, built on the first retrieve
+
+    @property
+    def collection_name(self):
+        return self.manifest["collection_name"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def models_match(self):
+        return self.manifest["models"] == {"text": TEXT_MODEL_NAME, "image": IMAGE_MODEL_NAME}
+
+    def _point_id(self, row):
+        point_id = self.ids[row]
+        return int(point_id) if self.ids.dtype.kind == "u" else str(point_id)
+
+    def _value(self, field, row):
+        column, data = self.columns[field]
+        if column["kind"] == "category":
+            code = int(data[row])
+            return column["categories"][code] if code >= 0 else None
+        values, offsets, valid = data
+        if valid is not None and not valid[row]:
+            return None
+        return bytes(values[offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def payload(self, row, with_payload=True):
+        if not with_payload:
+            return None
+        fields = self.columns if with_payload is True else [field for field in with_payload if field in self.columns]
+        payload = {}
+        for field in fields:
+            value = self._value(field, row)
+            if value is not None:
+                payload[field] = value
+        return payload
+
+    def _vectors(self, row, with_vectors):
+        if not with_vectors:
+            return None
+        names = VECTOR_NAMES if with_vectors is True else with_vectors
+        return {name: self.vectors[name][row].astype(np.float32).tolist() for name in names}
+
+    def filter_mask(self, query_filter):
+        # Boolean row mask for a Qdrant filter built by facets.build_query_filter (None = every row)
+        if query_filter is None:
+            return None
+        if query_filter.should or query_filter.must_not:
+            raise ValueError("Snapshot search only supports `must` filter conditions")
+        mask = np.ones(len(self), dtype=bool)
+        for condition in query_filter.must or []:
+            column, codes = self.columns.get(condition.key, (None, None))
+            if column is None or column["kind"] != "category":
+                raise ValueError(f"Snapshot search can only filter on facet fields, not {condition.key}")
+            values = condition.match.any if hasattr(condition.match, "any") else [condition.match.value]
+            allowed = [code for code, category in enumerate(column["categories"]) if category in values]
+            mask &= np.isin(codes, allowed)
+        return mask
+
+    def scores(self, vector_name, query_vectors):
+        # (queries, rows) cosine similarities; the rows are stored normalized, so this is one matrix product.
+        # float16 snapshots are upcast chunk by chunk.
+        matrix = self.vectors[vector_name]
+        queries = _unit_rows(np.asarray(query_vectors, dtype=np.float32).reshape(-1, matrix.shape[1]))
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        scores = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(chunk)] = queries @ chunk.T
+        return scores
+
+    def _top_rows(self, scores, limit, mask):
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        limit = min(limit, len(scores) if mask is None else int(mask.sum()))
+        if limit <= 0:
+            return []
+        rows = np.argpartition(-scores, limit - 1)[:limit]
+        return rows[np.argsort(-scores[rows], kind="stable")]
+
+    def _scored_points(self, scores, rows, with_payload, with_vectors=False):
+        return [models.ScoredPoint(id=self._point_id(row), version=0, score=float(scores[row]),
+                                   payload=self.payload(row, with_payload), vector=self._vectors(row, with_vectors))
+                for row in rows]
+
+    # QdrantClient-compatible subset
+
+    def collection_exists(self, collection_name):
+        return collection_name == self.collection_name
+
+    def count(self, collection_name, exact=True):
+        return models.CountResult(count=len(self))
+
+    def get_collection(self, collection_name):
+        return {"status": "snapshot", "path": self.path, "points_count": len(self), "dtype": self.manifest["dtype"]}
+
+    def search(self, collection_name, query_vector, query_filter=None, search_params=None, limit=10,
+               with_payload=True, with_vectors=False, **kwargs):
+        # query_vector is (vector name, vector) as in QdrantClient.search; the search is always exact
+        vector_name, vector = query_vector
+        scores = self.scores(vector_name, vector)[0]
+        rows = self._top_rows(scores, limit, self.filter_mask(query_filter))
+        return self._scored_points(scores, rows, with_payload, with_vectors)
+
+    def search_batch(self, collection_name, requests, **kwargs):
+        # Requests for the same vector are scored together with one matrix product
+        results = [None] * len(requests)
+        by_vector = {}
+        for i, request in enumerate(requests):
+            by_vector.setdefault(request.vector.name, []).append(i)
+        for vector_name, indices in by_vector.items():
+            scores = self.scores(vector_name, [requests[i].vector.vector for i in indices])
+            for query_scores, i in zip(scores, indices):
+                request = requests[i]
+                rows = self._top_rows(query_scores, request.limit, self.filter_mask(request.filter))
+                results[i] = self._scored_points(query_scores, rows, request.with_payload, request.with_vector)
+        return results
+
+    def retrieve(self, collection_name, ids, with_payload=True, with_vectors=False, **kwargs):
+        if self._rows is None:
+            self._rows = {self._point_id(row): row for row in range(len(self))}
+        rows = [self._rows[point_id] for point_id in ids if point_id in self._rows]
+        return [models.Record(id=self._point_id(row), payload=self.payload(row, with_payload),
+                              vector=self._vectors(row, with_vectors)) for row in rows]
+
+    def scroll(self, collection_name, limit=10, offset=None, with_payload=True, with_vectors=False, **kwargs):
+        # The offset is a row number
+        start = offset or 0
+        end = min(start + limit, len(self))
+        records = [models.Record(id=self._point_id(row), payload=self.payload(row, with_payload),
+                                 vector=self._vectors(row, with_vectors)) for row in range(start, end)]
+        return records, end if end < len(self) else None
+
+    def close(self):
+        pass
+
+
+def recall_against_snapshot(client, collection_name, snapshot, sample_size=50, limit=10):
+    # Recall@limit of the collection's configured search against exact search over the snapshot, using evenly
+    # spaced stored vectors as queries
+    rows = np.linspace(0, len(snapshot) - 1, num=min(sample_size, len(snapshot)), dtype=np.int64)
+    recall = {}
+    for vector_name in VECTOR_NAMES:
+        found = expected = 0
+        query_vectors = np.asarray(snapshot.vectors[vector_name][rows], dtype=np.float32)
+        exact_scores = snapshot.scores(vector_name, query_vectors)
+        for query_vector, scores in zip(query_vectors, exact_scores):
+            exact_ids = {snapshot._point_id(row) for row in snapshot._top_rows(scores, limit, None)}
+            hits = client.search(collection_name=collection_name, query_vector=(vector_name, query_vector.tolist()),
+                                 limit=limit, search_params=get_search_params())
+            found += len(exact_ids & {hit.id for hit in hits})
+            expected += len(exact_ids)
+        recall[vector_name] = found / expected if expected else None
+    return recall
@@ -0,0 +1,112 @@
+## storage_profiles.py
+
+from qdrant_client import models
+
+from config import Config
+
+VECTOR_NAMES = ("image", "text")
+VECTOR_SIZE = 512  # CLIP ViT-B-32 has 512-dimensional embeddings for both text and images
+
+# Storage profiles trade RAM for recall. Quantized vectors stay in RAM for the HNSW traversal while the float32
+# originals live on disk and are only read to rescore the oversampled candidates.
+# Note: quantization, on-disk storage and HNSW settings are applied by a Qdrant server (QDRANT_URL); the local
+# on-disk mode accepts the same configuration but always searches exactly.
+STORAGE_PROFILES = {
+    "default": {
+        "quantization": None,
+        "vectors_on_disk": False,
+        "payload_on_disk": False,
+        "hnsw_m": 16,
+        "hnsw_ef_construct": 100,
+        "search_ef": None,
+        "oversampling": None,
+    },
+    "compact": {
+        "quantization": "scalar",
+        "vectors_on_disk": True,
+        "payload_on_disk": True,
+        "hnsw_m": 16,
+        "hnsw_ef_construct": 128,
+        "search_ef": 128,
+        "oversampling": 2.0,
+    },
+    "minimal": {
+        "quantization": "binary",
+        "vectors_on_disk": True,
+        "payload_on_disk": True,
+        "hnsw_m": 12,
+        "hnsw_ef_construct": 128,
+        "search_ef": 256,
+        "oversampling": 3.0,
+    },
+}
+
+
+def get_storage_profile(name=None):
+    name = name or Config.STORAGE_PROFILE
+    if name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {name}. Available: {', '.join(STORAGE_PROFILES)}")
+    return STORAGE_PROFILES[name]
+
+
+def build_quantization_config(profile):
+    if profile["quantization"] == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True))
+    if profile["quantization"] == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    return None
+
+
+def build_vectors_config(profile):
+    hnsw_config = models.HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["hnsw_ef_construct"])
+    return {
+        name: models.VectorParams(
+            size=VECTOR_SIZE,
+            distance=models.Distance.COSINE,
+            on_disk=profile["vectors_on_disk"],
+            hnsw_config=hnsw_config,
+            quantization_config=build_quantization_config(profile),
+        )
+        for name in VECTOR_NAMES
+    }
+
+
+def build_vectors_config_diff(profile):
+    # Same settings as build_vectors_config, for switching the profile of an existing collection in place
+    hnsw_config = models.HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["hnsw_ef_construct"])
+    quantization_config = build_quantization_config(profile) or models.Disabled.DISABLED
+    return {
+        name: models.VectorParamsDiff(on_disk=profile["vectors_on_disk"], hnsw_config=hnsw_config,
+                                      quantization_config=quantization_config)
+        for name in VECTOR_NAMES
+    }
+
+
+def get_search_params(profile_name=None, exact=False):
+    # Search-time side of the profile: HNSW ef and rescoring of quantized candidates with the original vectors
+    if exact:
+        return models.SearchParams(exact=True)
+    profile = get_storage_profile(profile_name)
+    quantization = None
+    if profile["quantization"]:
+        quantization = models.QuantizationSearchParams(rescore=True, oversampling=profile["oversampling"])
+    if profile["search_ef"] is None and quantization is None:
+        return None
+    return models.SearchParams(hnsw_ef=profile["search_ef"], quantization=quantization)
+
+
+def estimate_memory_bytes(profile_name, point_count, average_payload_bytes=0):
+    # Approximate RAM for vectors, HNSW links (2 * m four-byte ids per vector on layer 0) and in-memory payloads
+    profile = get_storage_profile(profile_name)
+    float_bytes = VECTOR_SIZE * 4
+    if profile["quantization"] == "scalar":
+        quantized_bytes = VECTOR_SIZE
+    elif profile["quantization"] == "binary":
+        quantized_bytes = VECTOR_SIZE // 8
+    else:
+        quantized_bytes = 0
+    per_vector = quantized_bytes + (0 if profile["vectors_on_disk"] else float_bytes)
+    per_vector += profile["hnsw_m"] * 2 * 4
+    payload_bytes = 0 if profile["payload_on_disk"] else average_payload_bytes
+    return point_count * (len(VECTOR_NAMES) * per_vector + payload_bytes)
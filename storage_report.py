@@ -0,0 +1,196 @@
+## storage_report.py
+
+import gc
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+
+from qdrant_client import QdrantClient, models
+
+from config import Config
+from src.storage_profiles import STORAGE_PROFILES, VECTOR_NAMES, get_storage_profile, build_vectors_config, \
+    get_search_params, estimate_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+# Every profile is measured on its own temporary copy of the collection: on the Qdrant server (QDRANT_URL) when
+# one is configured, otherwise in a temporary local index. Note: the local mode ignores quantization and HNSW
+# settings and always searches exactly, so there every profile reports recall 1.0 and its memory is that of the
+# local client; only a server run measures the trade-off the profiles are meant to make.
+
+
+def measure_recall(client, collection_name, points, profile_name=None, limit=10):
+    # Recall@limit of a profile's search params against exact search, using the stored vectors of `points` as queries
+    recall = {}
+    for vector_name in VECTOR_NAMES:
+        found = expected = 0
+        for point in points:
+            query_vector = (vector_name, point.vector[vector_name])
+            exact_hits = client.search(collection_name=collection_name, query_vector=query_vector, limit=limit,
+                                       search_params=get_search_params(exact=True))
+            approximate_hits = client.search(collection_name=collection_name, query_vector=query_vector,
+                                             limit=limit, search_params=get_search_params(profile_name))
+            exact_ids = {hit.id for hit in exact_hits}
+            found += len(exact_ids & {hit.id for hit in approximate_hits})
+            expected += len(exact_ids)
+        recall[vector_name] = round(found / expected, 4) if expected else None
+    return recall
+
+
+def read_points(client, collection_name, max_points=None, batch_size=256):
+    # Vectors and payloads of the collection (or its first max_points points)
+    points = []
+    offset = None
+    while max_points is None or len(points) < max_points:
+        limit = batch_size if max_points is None else min(batch_size, max_points - len(points))
+        batch, offset = client.scroll(collection_name=collection_name, limit=limit, offset=offset, with_vectors=True,
+                                      with_payload=True)
+        points.extend(batch)
+        if offset is None:
+            break
+    return points
+
+
+def process_rss_bytes():
+    # Resident set size of this process (Linux); None where /proc is not available
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def server_collection_usage(collection_name):
+    # (RAM bytes, disk bytes) of a server collection, summed over its segments from the detailed telemetry
+    url = Config.QDRANT_URL.rstrip("/") + "/telemetry?details_level=3"
+    with urllib.request.urlopen(url, timeout=Config.TIMEOUT) as response:
+        telemetry = json.load(response)["result"]
+    ram_bytes = disk_bytes = 0
+    for collection in telemetry.get("collections", {}).get("collections", []):
+        if collection.get("id") != collection_name:
+            continue
+        for shard in collection.get("shards", []):
+            for segment in (shard.get("local") or {}).get("segments", []):
+                ram_bytes += segment.get("info", {}).get("ram_usage_bytes", 0)
+                disk_bytes += segment.get("info", {}).get("disk_usage_bytes", 0)
+    return ram_bytes, disk_bytes
+
+
+def wait_until_indexed(client, collection_name, timeout=600):
+    # The server builds quantized vectors and the HNSW graph in the background; recall is only meaningful after
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = client.get_collection(collection_name)
+        if info.status == models.CollectionStatus.GREEN:
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f"Collection {collection_name} was not indexed within {timeout} seconds")
+
+
+def _create_profile_collection(client, collection_name, profile_name, points, batch_size=256):
+    profile = get_storage_profile(profile_name)
+    client.create_collection(collection_name=collection_name, vectors_config=build_vectors_config(profile),
+                             on_disk_payload=profile["payload_on_disk"],
+                             # Index even a small sample, so the searches go through HNSW and quantization
+                             optimizers_config=models.OptimizersConfigDiff(indexing_threshold=1))
+    for start in range(0, len(points), batch_size):
+        client.upsert(collection_name=collection_name, points=[
+            models.PointStruct(id=point.id, vector=point.vector, payload=point.payload)
+            for point in points[start:start + batch_size]
+        ])
+
+
+def measure_profile(profile_name, collection_name, points, queries, limit=10):
+    # Builds a temporary collection with the profile's storage settings and measures its recall, build time and size
+    temp_name = f"{collection_name}_profile_{profile_name}"
+    result = {}
+    start_time = time.time()
+    if Config.QDRANT_URL:
+        client = QdrantClient(url=Config.QDRANT_URL, timeout=Config.TIMEOUT)
+        if client.collection_exists(temp_name):
+            client.delete_collection(temp_name)
+        try:
+            _create_profile_collection(client, temp_name, profile_name, points)
+            wait_until_indexed(client, temp_name)
+            result["build_seconds"] = round(time.time() - start_time, 2)
+            result[f"recall@{limit}"] = measure_recall(client, temp_name, queries, profile_name, limit)
+            try:
+                ram_bytes, disk_bytes = server_collection_usage(temp_name)
+                result["measured_ram_mb"] = round(ram_bytes / 2 ** 20, 1)
+                result["measured_disk_mb"] = round(disk_bytes / 2 ** 20, 1)
+            except Exception as e:
+                logger.warning("Could not read the server telemetry for %s: %s", temp_name, e)
+                result["measured_ram_mb"] = result["measured_disk_mb"] = None
+        finally:
+            client.delete_collection(temp_name)
+            client.close()
+        return result
+
+    index_path = tempfile.mkdtemp(prefix=f"storage_report_{profile_name}_")
+    try:
+        client = QdrantClient(path=index_path)
+        _create_profile_collection(client, temp_name, profile_name, points)
+        client.close()
+        result["build_seconds"] = round(time.time() - start_time, 2)
+        result["measured_disk_mb"] = round(directory_bytes(index_path) / 2 ** 20, 1)
+        # The local client loads the whole collection when it opens the index; the RSS growth is its memory
+        gc.collect()
+        rss_before = process_rss_bytes()
+        client = QdrantClient(path=index_path)
+        rss_after = process_rss_bytes()
+        result["measured_ram_mb"] = round((rss_after - rss_before) / 2 ** 20, 1) if rss_before is not None else None
+        try:
+            result[f"recall@{limit}"] = measure_recall(client, temp_name, queries, profile_name, limit)
+        finally:
+            client.close()
+    finally:
+        shutil.rmtree(index_path, ignore_errors=True)
+    return result
+
+
+def recall_memory_report(client, collection_name, sample_size=50, limit=10, max_points=None, profiles=None):
+    """Measure every storage profile on a temporary copy of the collection (or of its first max_points points):
+    recall@limit against exact search for sample_size stored vectors as queries, and the measured memory and disk
+    size next to the estimate from storage_profiles.estimate_memory_bytes."""
+    point_count = client.count(collection_name).count
+    points = read_points(client, collection_name, max_points)
+    queries = points[:sample_size]
+    payload_sizes = [len(json.dumps(point.payload)) for point in points]
+    average_payload_bytes = sum(payload_sizes) / len(payload_sizes) if payload_sizes else 0
+
+    report = {
+        "collection": collection_name,
+        "points": point_count,
+        "copied_points": len(points),
+        "sampled_queries": len(queries),
+        "active_profile": Config.STORAGE_PROFILE,
+        "index": "server" if Config.QDRANT_URL else "local (exact search; recall and memory do not differ)",
+        "profiles": {},
+    }
+    for name in profiles or STORAGE_PROFILES:
+        logger.info("Measuring storage profile '%s' on %s points", name, len(points))
+        measured = measure_profile(name, collection_name, points, queries, limit)
+        measured["estimated_memory_mb"] = round(estimate_memory_bytes(name, len(points), average_payload_bytes)
+                                                / 2 ** 20, 1)
+        report["profiles"][name] = measured
+    return report
+
+
+if __name__ == "__main__":
+    from src.create_data_embeddings import open_index
+    from src.multimodal_rag_system import COLLECTION_NAME
+
+    index_client = open_index(COLLECTION_NAME)
+    if index_client is None:
+        print(f"No persisted index found for collection {COLLECTION_NAME}")
+        sys.exit(1)
+    print(json.dumps(recall_memory_report(index_client, COLLECTION_NAME), indent=2))
@@ -0,0 +1,303 @@
+## telemetry.py
+
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+# One JSON line per finished span and request, at DEBUG level
+trace_logger = logging.getLogger(__name__ + ".trace")
+
+# Upper bounds in seconds of the latency histogram buckets (the Prometheus "le" label)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_SAMPLES = 1024  # Most recent observations kept per histogram for the live percentiles
+
+_current_trace = contextvars.ContextVar("telemetry_trace", default=None)
+
+
+class Histogram:
+    """Bucketed latency histogram plus a window of recent values for percentiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def quantile(fraction):
+            return recent[min(len(recent) - 1, int(round(fraction * (len(recent) - 1))))] if recent else None
+
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "p50": quantile(0.50), "p95": quantile(0.95), "p99": quantile(0.99)}
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms keyed by (name, labels)."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": {_series_name(name, labels): value for (name, labels), value in self._counters.items()},
+                "histograms": {_series_name(name, labels): histogram.summary()
+                               for (name, labels), histogram in self._histograms.items()},
+            }
+
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{_series_name(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f"{_series_name(name + '_bucket', labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{_series_name(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_series_name(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _series_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = MetricsRegistry()
+recent_traces = deque(maxlen=Config.TELEMETRY_TRACE_BUFFER)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name, value=1, **labels):
+    if Config.TELEMETRY_ENABLED:
+        registry.inc(name, value, _labels(labels))
+
+
+def observe(name, value, **labels):
+    if Config.TELEMETRY_ENABLED:
+        registry.observe(name, value, _labels(labels))
+
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace["request_id"] if trace is not None else None
+
+
+class _NoopSpan:
+    # Shared by span() and request() when telemetry is off, so disabled instrumentation allocates nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.finish(time.perf_counter() - self.start, exc_type)
+        return False
+
+    def finish(self, elapsed, exc_type=None):
+        labels = (("stage", self.stage),)
+        registry.observe("stage_duration_seconds", elapsed, labels)
+        if exc_type is not None:
+            registry.inc("stage_errors_total", 1, labels)
+        trace = _current_trace.get()
+        record = {"stage": self.stage, "duration_ms": round(elapsed * 1000, 3)}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        # A span that outlives its request (e.g. a timed-out search branch) only goes to the metrics
+        trace_start = trace.get("_start") if trace is not None else None
+        if trace_start is not None:
+            record["start_ms"] = round((self.start - trace_start) * 1000, 3)
+            trace["spans"].append(record)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug(json.dumps(dict(record, request_id=trace and trace["request_id"])))
+
+
+def span(stage):
+    """Time a stage of the current request: `with telemetry.span("vector_search"): ...`"""
+    if not Config.TELEMETRY_ENABLED:
+        return _NOOP_SPAN
+    return _Span(stage)
+
+
+def record_span(stage, elapsed):
+    # For stages that are not a single block of code, e.g. the time to the first streamed token
+    if Config.TELEMETRY_ENABLED:
+        span_ = _Span(stage)
+        span_.start = time.perf_counter() - elapsed
+        span_.finish(elapsed)
+
+
+class _Request:
+    __slots__ = ("kind", "trace", "token")
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __enter__(self):
+        self.trace = {"request_id": uuid.uuid4().hex[:16], "kind": self.kind, "started_at": time.time(),
+                      "spans": [], "_start": time.perf_counter()}
+        self.token = _current_trace.set(self.trace)
+        registry.inc("requests_total", 1, (("kind", self.kind),))
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.trace.pop("_start")
+        try:
+            _current_trace.reset(self.token)
+        except ValueError:
+            # A generator finished in another context than it started in; that context is not ours to restore
+            pass
+        labels = (("kind", self.kind),)
+        registry.observe("request_duration_seconds", elapsed, labels)
+        self.trace["total_ms"] = round(elapsed * 1000, 3)
+        if exc_type is not None:
+            registry.inc("request_errors_total", 1, labels)
+            self.trace["error"] = exc_type.__name__
+        recent_traces.append(self.trace)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug(json.dumps(self.trace))
+        return False
+
+
+def request(kind="query"):
+    """Start a traced request; spans opened inside it (also on bound pool threads) carry its request ID."""
+    if not Config.TELEMETRY_ENABLED:
+        return _NOOP_SPAN
+    return _Request(kind)
+
+
+def bind(function, *args, **kwargs):
+    # Executor threads do not inherit context variables; run the call in a copy of the caller's context so its
+    # spans are attributed to the current request
+    if not Config.TELEMETRY_ENABLED:
+        return partial(function, *args, **kwargs)
+    return partial(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+def snapshot(trace_count=20):
+    data = registry.snapshot()
+    data["enabled"] = Config.TELEMETRY_ENABLED
+    data["recent_traces"] = list(recent_traces)[-trace_count:]
+    return data
+
+
+def format_summary():
+    # Plain-text view of the live metrics for the Diagnostics tab
+    if not Config.TELEMETRY_ENABLED:
+        return "Telemetry is disabled (Config.TELEMETRY_ENABLED = False)"
+    data = registry.snapshot()
+    lines = [f"{'Latency (ms)':<48} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8}"]
+    for name, summary in sorted(data["histograms"].items()):
+        if summary["count"]:
+            lines.append(f"{name:<48} {summary['count']:>7} {summary['p50'] * 1000:>8.1f} "
+                         f"{summary['p95'] * 1000:>8.1f} {summary['p99'] * 1000:>8.1f}")
+    lines.append("")
+    lines.append("Counters")
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"{name:<48} {value}")
+    if recent_traces:
+        trace = recent_traces[-1]
+        stages = ", ".join(f"{record['stage']} {record['duration_ms']:.1f}" for record in trace["spans"])
+        lines.append("")
+        lines.append(f"Last request {trace['request_id']} ({trace['kind']}): {trace['total_ms']:.1f} ms [{stages}]")
+    return "\n".join(lines)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = registry.prometheus_text().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot(), default=str).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=None, host=None):
+    """Serve /metrics (Prometheus text format) and /metrics.json from a daemon thread."""
+    port = Config.METRICS_PORT if port is None else port
+    server = ThreadingHTTPServer((host or Config.METRICS_HOST, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", *server.server_address[:2])
+    return server
@@ -0,0 +1,18 @@
+## tests/conftest.py
+
+import os
+import sys
+import types
+
+# The modules import each other as `src.<module>` (the repository is checked out as the `src` package) and the
+# config as the top-level `config` module; make both importable from a plain checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+if "src" not in sys.modules:
+    try:
+        import src  # noqa: F401
+    except ImportError:
+        package = types.ModuleType("src")
+        package.__path__ = [ROOT]
+        sys.modules["src"] = package
@@ -0,0 +1,33 @@
+## tests/test_api_server.py
+
+import json
+
+import pytest
+
+from config import Config
+from src.api_server import _QueryHandler
+
+
+def parse(request):
+    return _QueryHandler._parse_request(json.dumps(request).encode())
+
+
+def test_parse_request_defaults_and_clamps_top_k():
+    assert parse({"query": "chest"}) == ("chest", None, 3, None)
+    assert parse({"query": "chest", "top_k": 10 ** 6})[2] == Config.API_MAX_TOP_K
+    assert parse({"query": "chest", "top_k": -4})[2] == 1
+
+
+def test_parse_request_accepts_string_and_list_filters():
+    filters = {"modality": "CT", "body_region": ["Chest", "Abdomen"], "split": None}
+    assert parse({"query": "chest", "filters": filters})[3] == filters
+
+
+@pytest.mark.parametrize("request_body", [
+    [], {}, {"query": 5}, {"query": "chest", "top_k": "many"}, {"query": "chest", "image": "not base64!"},
+    {"query": "chest", "filters": ["CT"]}, {"query": "chest", "filters": {"modality": 5}},
+    {"query": "chest", "filters": {"modality": ["CT", 5]}}, {"query": "chest", "filters": {"modality": {"a": 1}}},
+])
+def test_parse_request_rejects_malformed_input(request_body):
+    with pytest.raises((ValueError, TypeError)):
+        parse(request_body)
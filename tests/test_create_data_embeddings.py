@@ -0,0 +1,104 @@
+## tests/test_create_data_embeddings.py
+
+import random
+
+import pytest
+from qdrant_client import QdrantClient, models
+
+from config import Config
+from src import lexical_index
+from src.create_data_embeddings import (sample_image_ids, parse_shard, in_shard, get_shard_path, create_collection,
+                                        create_uuid_from_image_id, new_manifest, save_manifest, load_manifest,
+                                        merge_shards)
+from src.lexical_index import get_lexical_index, save_lexical_index
+from src.storage_profiles import VECTOR_NAMES, VECTOR_SIZE
+
+IMAGE_IDS = [f"img-{number:04d}" for number in range(1000)]
+CAPTIONS = {image_id: "Axial CT of the abdomen" if number % 10 else "Chest X-ray, frontal view"
+            for number, image_id in enumerate(IMAGE_IDS)}
+COLLECTION_NAME = "test_collection"
+
+
+def test_sample_is_reproducible_per_seed():
+    sample = sample_image_ids(IMAGE_IDS, CAPTIONS, seed=1, strategy="uniform", sample_rate=0.3)
+    assert len(sample) == 300
+    # The input order does not matter, only the seed does
+    shuffled = random.Random(0).sample(IMAGE_IDS, len(IMAGE_IDS))
+    assert sample_image_ids(shuffled, CAPTIONS, seed=1, strategy="uniform", sample_rate=0.3) == sample
+    assert set(sample_image_ids(IMAGE_IDS, CAPTIONS, seed=2, strategy="uniform", sample_rate=0.3)) != set(sample)
+    # A larger rate keeps the smaller sample, so growing the sample never re-embeds what is already indexed
+    assert set(sample) <= set(sample_image_ids(IMAGE_IDS, CAPTIONS, seed=1, strategy="uniform", sample_rate=0.5))
+
+
+def test_stratified_sample_keeps_each_modality_share():
+    sample = sample_image_ids(IMAGE_IDS, CAPTIONS, seed=1, strategy="stratified", sample_rate=0.3)
+    x_rays = [image_id for image_id in sample if CAPTIONS[image_id].startswith("Chest X-ray")]
+    assert len(x_rays) == 30 and len(sample) == 300
+    assert sample_image_ids(IMAGE_IDS, CAPTIONS, seed=1, strategy="stratified", sample_rate=0.3) == sample
+    with pytest.raises(ValueError):
+        sample_image_ids(IMAGE_IDS, CAPTIONS, strategy="random")
+
+
+def test_parse_shard():
+    assert parse_shard("1/4") == (1, 4)
+    assert parse_shard((0, 2)) == (0, 2)
+    assert parse_shard(None) is None
+    for spec in ("4/4", "-1/4", "0/0"):
+        with pytest.raises(ValueError):
+            parse_shard(spec)
+
+
+def test_shards_are_disjoint_and_cover_the_corpus():
+    shards = [[image_id for image_id in IMAGE_IDS if in_shard(image_id, (index, 4))] for index in range(4)]
+    assert sorted(sum(shards, [])) == IMAGE_IDS
+    assert all(len(shard) > 150 for shard in shards)
+    assert all(in_shard(image_id, None) for image_id in IMAGE_IDS)
+
+
+def _point(image_id):
+    vector = {name: [1.0] + [0.0] * (VECTOR_SIZE - 1) for name in VECTOR_NAMES}
+    caption = CAPTIONS.get(image_id, "Knee radiograph")
+    return models.PointStruct(id=create_uuid_from_image_id(image_id), vector=vector,
+                              payload={"image_id": image_id, "caption": caption, "split": "train"})
+
+
+def test_merge_deletes_points_missing_from_the_merged_manifests(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "QDRANT_PATH", str(tmp_path))
+    monkeypatch.setattr(Config, "QDRANT_URL", None)
+    monkeypatch.setattr(Config, "INDEX_MANIFEST_PATH", None)
+    monkeypatch.setattr(lexical_index, "_indexes", {})
+    image_ids = IMAGE_IDS[:20]
+
+    for index in range(2):
+        shard = (index, 2)
+        shard_ids = [image_id for image_id in image_ids if in_shard(image_id, shard)]
+        client = QdrantClient(path=get_shard_path(shard))
+        create_collection(client, COLLECTION_NAME)
+        client.upsert(COLLECTION_NAME, points=[_point(image_id) for image_id in shard_ids])
+        client.close()
+        manifest = new_manifest(COLLECTION_NAME, shard)
+        manifest["complete"] = True
+        manifest["images"] = {image_id: {"split": "train"} for image_id in shard_ids}
+        save_manifest(COLLECTION_NAME, manifest)
+
+    # The main index still holds points of an earlier run that are in no shard manifest any more
+    stale_ids = ["gone-1", "gone-2"]
+    client = QdrantClient(path=str(tmp_path))
+    create_collection(client, COLLECTION_NAME)
+    client.upsert(COLLECTION_NAME, points=[_point(image_id) for image_id in image_ids[:5] + stale_ids])
+    client.close()
+    index = get_lexical_index(COLLECTION_NAME)
+    for image_id in stale_ids:
+        index.add(create_uuid_from_image_id(image_id), "Knee radiograph")
+    save_lexical_index(COLLECTION_NAME)
+
+    client = merge_shards(COLLECTION_NAME, 2)
+    try:
+        points, _ = client.scroll(COLLECTION_NAME, limit=100, with_payload=["image_id"])
+        assert sorted(point.payload["image_id"] for point in points) == image_ids
+        manifest = load_manifest(COLLECTION_NAME)
+        assert sorted(manifest["images"]) == image_ids and manifest["complete"]
+        assert len(get_lexical_index(COLLECTION_NAME)) == len(image_ids)
+        assert get_lexical_index(COLLECTION_NAME).search("knee radiograph") == []
+    finally:
+        client.close()
@@ -0,0 +1,61 @@
+## tests/test_embeddings_utils.py
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient, models
+
+from config import Config
+from src.embedding_cache import text_key, image_key
+from src.embeddings_utils import (TEXT_MODEL_NAME, IMAGE_MODEL_NAME, query_embedding_cache, search_similar_text,
+                                  search_similar_image, fuse_results)
+from src.image_utils import QueryImage
+
+COLLECTION_NAME = "test_collection"
+
+
+@pytest.fixture
+def client():
+    client = QdrantClient(":memory:")
+    vector_params = models.VectorParams(size=4, distance=models.Distance.COSINE)
+    client.create_collection(COLLECTION_NAME, vectors_config={"text": vector_params, "image": vector_params})
+    client.upsert(COLLECTION_NAME, points=[
+        models.PointStruct(id=1, vector={"text": [1.0, 0, 0, 0], "image": [0, 1.0, 0, 0]},
+                           payload={"caption": "Chest X-ray", "image_path": "a.jpg"}),
+        models.PointStruct(id=2, vector={"text": [0, 0, 1.0, 0], "image": [0, 0, 0, 1.0]},
+                           payload={"caption": "Axial CT scan", "image_path": "b.jpg"}),
+    ])
+    yield client
+    query_embedding_cache.clear()
+    client.close()
+
+
+def test_cached_text_embedding_round_trips_through_local_search(client):
+    # Cached embeddings are read-only; local-mode Qdrant must not be handed the shared array itself
+    key = text_key(TEXT_MODEL_NAME, "Chest X-ray")
+    query_embedding_cache.put(key, np.array([2.0, 0.5, 0, 0], dtype=np.float32))
+    assert not query_embedding_cache.get(key).flags.writeable
+
+    for _ in range(2):
+        results = search_similar_text(COLLECTION_NAME, client, "chest x-ray", limit=1)
+        assert [hit.id for hit in results] == [1]
+    np.testing.assert_array_equal(query_embedding_cache.get(key), [2.0, 0.5, 0, 0])
+
+
+def test_cached_image_embedding_round_trips_through_local_search(client):
+    from PIL import Image
+
+    query_image = QueryImage(Image.new("RGB", (8, 8)))
+    query_embedding_cache.put(image_key(IMAGE_MODEL_NAME, query_image.content_hash),
+                              np.array([0, 0, 0, 3.0], dtype=np.float32))
+
+    results = search_similar_image(COLLECTION_NAME, client, query_image, limit=1)
+    assert [hit.id for hit in results] == [2]
+
+
+def test_fuse_results_min_score_none_disables_the_threshold(monkeypatch):
+    monkeypatch.setattr(Config, "FUSION_MIN_SCORE", 0.5)
+    hits = [models.ScoredPoint(id=i, version=0, score=score, payload={"caption": "x"})
+            for i, score in enumerate([0.9, 0.3])]
+    assert [hit.id for hit in fuse_results([hits], max_results=5)] == [0]
+    assert [hit.id for hit in fuse_results([hits], min_score=None, max_results=5)] == [0, 1]
+    assert [hit.id for hit in fuse_results([hits], min_score=0.95, max_results=5)] == []
@@ -0,0 +1,115 @@
+## tests/test_groq_utils.py
+
+import asyncio
+import time
+
+import pytest
+
+from config import Config
+from src.benchmarks import StubLLMServer
+from src.groq_utils import GroqClient
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    # Points GroqClient at a stub endpoint with a primary and a fail-over model and fast retries
+    def apply(llm, **overrides):
+        settings = dict(GROQ_BASE_URL=llm.base_url, GROQ_API_KEY="test-key", GROQ_MODEL="primary",
+                        GROQ_FALLBACK_MODELS=["fallback"], GROQ_MAX_RETRIES=2, GROQ_RETRY_BASE_DELAY=0.01,
+                        GROQ_RETRY_MAX_DELAY=1.0, GROQ_REQUESTS_PER_MINUTE=None, GROQ_TOKENS_PER_MINUTE=None,
+                        RESPONSE_CACHE_ENABLED=False, RESPONSE_CACHE_PATH=None, MAX_TOKENS=16)
+        settings.update(overrides)
+        for name, value in settings.items():
+            monkeypatch.setattr(Config, name, value)
+        return GroqClient()
+
+    return apply
+
+
+def answer(client, prompt="Is there a fracture?"):
+    return client.process_response(client.query(prompt, []))
+
+
+def test_retries_429_after_retry_after(configure):
+    with StubLLMServer(latency=0, tokens=3, failures={"primary": [429]}, retry_after=0.3) as llm:
+        client = configure(llm)
+        start_time = time.perf_counter()
+        assert answer(client) == "token token token"
+        assert time.perf_counter() - start_time >= 0.3
+        assert llm.requests == ["primary", "primary"]
+
+
+def test_fails_over_when_primary_keeps_failing(configure):
+    with StubLLMServer(latency=0, tokens=2, failures={"primary": [503] * 10}) as llm:
+        client = configure(llm, GROQ_MAX_RETRIES=1)
+        assert answer(client) == "token token"
+        assert llm.requests == ["primary", "primary", "fallback"]
+
+
+def test_non_retryable_error_is_returned(configure):
+    with StubLLMServer(latency=0, failures={"primary": [400]}) as llm:
+        client = configure(llm)
+        assert "error" in client.query("Is there a fracture?", [])
+        assert llm.requests == ["primary"]
+
+
+def test_cache_hit_skips_the_api(configure):
+    with StubLLMServer(latency=0, tokens=2) as llm:
+        client = configure(llm, RESPONSE_CACHE_ENABLED=True)
+        assert answer(client) == "token token"
+        assert answer(client) == "token token"
+        assert llm.requests == ["primary"]
+
+
+def test_fail_over_answers_are_not_cached(configure):
+    # Cache keys name the primary model
+    with StubLLMServer(latency=0, tokens=2, failures={"primary": [503] * 3}) as llm:
+        client = configure(llm, GROQ_MAX_RETRIES=0, RESPONSE_CACHE_ENABLED=True)
+        assert answer(client) == "token token"
+        assert answer(client) == "token token"
+        assert answer(client) == "token token"
+        assert llm.requests == ["primary", "fallback", "primary", "fallback", "primary", "fallback"]
+
+
+def test_every_attempt_is_paced(configure):
+    # One requests/min token per attempt: the retried call uses two of the bucket's three
+    with StubLLMServer(latency=0, tokens=2, failures={"primary": [429]}, retry_after=0) as llm:
+        client = configure(llm, GROQ_REQUESTS_PER_MINUTE=3)
+        assert answer(client) == "token token"
+        start_time = time.perf_counter()
+        assert answer(client) == "token token"
+        assert time.perf_counter() - start_time < 1.0
+        # The bucket is empty now; the next attempt waits for a refill (one request per 20 seconds)
+        assert client.limiter._pacing_delay(0) > 15
+
+
+def test_stream_yields_tokens_in_order(configure):
+    with StubLLMServer(latency=0, tokens=4) as llm:
+        client = configure(llm)
+        deltas = list(client.query_stream("Is there a fracture?", []))
+        assert len(deltas) == 4
+        assert "".join(deltas) == "token token token token"
+
+
+def test_stream_delivers_the_first_token_before_the_answer_is_complete(configure):
+    with StubLLMServer(latency=0, tokens=5, token_interval=0.1) as llm:
+        client = configure(llm)
+        start_time = time.perf_counter()
+        stream = client.query_stream("Is there a fracture?", [])
+        next(stream)
+        first_token_seconds = time.perf_counter() - start_time
+        rest = list(stream)
+        assert first_token_seconds < 0.3 < time.perf_counter() - start_time
+        assert len(rest) == 4
+
+
+def test_async_stream_and_cached_replay(configure):
+    async def collect(client):
+        return [delta async for delta in client.query_stream_async("Is there a fracture?", [])]
+
+    with StubLLMServer(latency=0, tokens=3) as llm:
+        client = configure(llm, RESPONSE_CACHE_ENABLED=True)
+        assert "".join(asyncio.run(collect(client))) == "token token token"
+        # A cached answer is replayed as a single delta without calling the API
+        assert asyncio.run(collect(client)) == ["token token token"]
+        assert llm.requests == ["primary"]
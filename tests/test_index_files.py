@@ -0,0 +1,22 @@
+## tests/test_index_files.py
+
+from qdrant_client import QdrantClient, models
+
+from src.index_files import count_local_points
+
+
+def test_count_local_points_reads_the_index_files(tmp_path):
+    index_path = str(tmp_path)
+    client = QdrantClient(path=index_path)
+    client.create_collection("collection", vectors_config=models.VectorParams(size=2, distance=models.Distance.COSINE))
+    client.upsert("collection", points=[models.PointStruct(id=i, vector=[1.0, float(i)]) for i in range(5)])
+    client.delete("collection", points_selector=models.PointIdsList(points=[0]))
+    client.create_collection("empty", vectors_config=models.VectorParams(size=2, distance=models.Distance.COSINE))
+
+    # Readable while the client still holds the index open
+    assert count_local_points(index_path, "collection") == 4
+    client.close()
+    assert count_local_points(index_path, "collection") == 4
+    assert count_local_points(index_path, "empty") == 0
+    assert count_local_points(index_path, "missing") is None
+    assert count_local_points(str(tmp_path / "no-index"), "collection") is None
@@ -0,0 +1,98 @@
+## tests/test_lexical_index.py
+
+import pytest
+from qdrant_client import QdrantClient, models
+
+from config import Config
+from src import lexical_index
+from src.lexical_index import LexicalIndex, ensure_lexical_index, get_lexical_index, save_lexical_index
+
+CAPTIONS = {
+    "p1": ("Chest X-ray showing a right lower lobe pneumonia", {"modality": "X-ray", "body_region": "Chest"}),
+    "p2": ("Axial CT of the chest with a pulmonary nodule", {"modality": "CT", "body_region": "Chest"}),
+    "p3": ("Brain MRI after a treated pneumonia, no acute intracranial finding seen",
+           {"modality": "MRI", "body_region": "Head"}),
+    "p4": ("Pneumonia pneumonia on chest radiograph", {"modality": "X-ray", "body_region": "Chest"}),
+}
+
+
+@pytest.fixture
+def index():
+    index = LexicalIndex()
+    for point_id, (caption, facets) in CAPTIONS.items():
+        index.add(point_id, caption, {"caption": caption, "split": "train", **facets})
+    return index
+
+
+@pytest.fixture
+def persisted(tmp_path, monkeypatch):
+    # A persistent index directory and an empty per-collection registry
+    monkeypatch.setattr(Config, "QDRANT_PATH", str(tmp_path))
+    monkeypatch.setattr(Config, "QDRANT_URL", None)
+    monkeypatch.setattr(lexical_index, "_indexes", {})
+    return tmp_path
+
+
+def test_bm25_ranks_frequent_and_rare_terms_first(index):
+    # p4 repeats "pneumonia" in a short caption; "nodule" only occurs in p2
+    assert [hit.id for hit in index.search("pneumonia", limit=4)] == ["p4", "p1", "p3"]
+    assert [hit.id for hit in index.search("pulmonary nodule pneumonia", limit=1)] == ["p2"]
+    scores = [hit.score for hit in index.search("pneumonia chest", limit=4)]
+    assert scores == sorted(scores, reverse=True) and scores[-1] > 0
+
+
+def test_stopwords_and_unknown_terms_match_nothing(index):
+    assert index.search("the of with") == []
+    assert index.search("fracture") == []
+
+
+def test_filters_exclude_non_matching_documents(index):
+    results = index.search("pneumonia", limit=4, filters={"modality": "X-ray"})
+    assert [hit.id for hit in results] == ["p4", "p1"]
+    assert index.search("pneumonia", limit=4, filters={"modality": ["MRI"], "body_region": "Chest"}) == []
+    # Filtering does not change the scores of the documents that remain
+    unfiltered = {hit.id: hit.score for hit in index.search("pneumonia", limit=4)}
+    assert all(hit.score == pytest.approx(unfiltered[hit.id]) for hit in results)
+    with pytest.raises(ValueError):
+        index.search("pneumonia", filters={"colour": "red"})
+
+
+def test_changes_are_visible_to_the_next_search(index):
+    assert index.search("pneumonia", limit=1)[0].id == "p4"
+    index.remove("p4")
+    index.add("p1", "Knee radiograph", {"caption": "Knee radiograph"})
+    assert [hit.id for hit in index.search("pneumonia", limit=4)] == ["p3"]
+    assert len(index) == 3
+
+
+def test_save_and_load_round_trip(index, tmp_path):
+    path = str(tmp_path / "index.pkl")
+    index.save(path)
+    loaded = LexicalIndex.load(path)
+    assert len(loaded) == len(index)
+    for query in ("pneumonia", "chest ct nodule"):
+        expected = [(hit.id, hit.score, hit.payload) for hit in index.search(query, limit=4)]
+        assert [(hit.id, hit.score, hit.payload) for hit in loaded.search(query, limit=4)] == expected
+
+
+def test_ensure_rebuilds_when_the_collection_count_drifts(persisted):
+    client = QdrantClient(":memory:")
+    client.create_collection("collection", vectors_config={
+        "text": models.VectorParams(size=2, distance=models.Distance.COSINE)})
+    client.upsert("collection", points=[
+        models.PointStruct(id=number, vector={"text": [1.0, float(number)]},
+                           payload={"caption": caption, "split": "train", **facets})
+        for number, (caption, facets) in enumerate(CAPTIONS.values(), start=1)
+    ])
+    # The saved lexical index only knows one of the four points
+    get_lexical_index("collection").add(1, CAPTIONS["p1"][0])
+    save_lexical_index("collection")
+    lexical_index._indexes.clear()
+
+    index = ensure_lexical_index("collection", client)
+    assert len(index) == 4
+    assert [hit.id for hit in index.search("nodule")] == [2]
+    # The rebuilt index was saved, so the next process loads it without rebuilding
+    lexical_index._indexes.clear()
+    assert len(get_lexical_index("collection")) == 4
+    client.close()
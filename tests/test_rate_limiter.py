@@ -0,0 +1,86 @@
+## tests/test_rate_limiter.py
+
+import asyncio
+import threading
+import time
+
+from src.rate_limiter import HybridSemaphore, RequestLimiter, TokenBucket, backoff_delay, parse_retry_after
+
+
+def test_token_bucket_books_capacity_ahead():
+    bucket = TokenBucket(60)  # One token per second
+    assert bucket.reserve(60) == 0.0
+    assert 1.9 < bucket.reserve(2) <= 2.0
+
+
+def test_limiter_paces_by_tokens_per_minute():
+    limiter = RequestLimiter(tokens_per_minute=6000)  # 100 tokens per second
+    assert limiter.pace(6000) == 0.0
+    start_time = time.perf_counter()
+    limiter.pace(30)
+    assert time.perf_counter() - start_time >= 0.25
+
+
+def test_limiter_caps_concurrency_across_threads_and_coroutines():
+    limiter = RequestLimiter(max_concurrency=2)
+    lock = threading.Lock()
+    active = peak = 0
+
+    def enter():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+
+    def leave():
+        nonlocal active
+        with lock:
+            active -= 1
+
+    def thread_worker():
+        for _ in range(10):
+            with limiter.slot():
+                enter()
+                time.sleep(0.002)
+                leave()
+
+    async def coroutine_worker():
+        for _ in range(10):
+            async with limiter.aslot():
+                enter()
+                await asyncio.sleep(0.002)
+                leave()
+
+    async def main():
+        await asyncio.gather(coroutine_worker(), coroutine_worker(), asyncio.to_thread(thread_worker),
+                             asyncio.to_thread(thread_worker))
+
+    asyncio.run(main())
+    assert peak == 2
+
+
+def test_cancelled_waiter_does_not_leak_a_permit():
+    semaphore = HybridSemaphore(1)
+
+    async def main():
+        await semaphore.acquire_async()
+        waiter = asyncio.create_task(semaphore.acquire_async())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        semaphore.release()
+        await asyncio.wait_for(semaphore.acquire_async(), 1)
+
+    asyncio.run(main())
+
+
+def test_retry_after_wins_over_backoff():
+    assert backoff_delay(0, 0.5, 20, retry_after=3.0) == 3.0
+    assert 0 <= backoff_delay(3, 0.5, 20) <= 4.0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after": "2"}) == 2.0
+    assert parse_retry_after({"x-ratelimit-reset-requests": "1m3s"}) == 63.0
+    assert parse_retry_after({"x-ratelimit-reset-requests": "500ms"}) == 0.5
+    assert parse_retry_after({}) is None
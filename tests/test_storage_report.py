@@ -0,0 +1,33 @@
+## tests/test_storage_report.py
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+from config import Config
+from src.storage_profiles import STORAGE_PROFILES, VECTOR_NAMES, VECTOR_SIZE
+from src.storage_report import recall_memory_report
+
+
+def test_every_profile_is_measured_on_its_own_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "QDRANT_URL", None)
+    rng = np.random.default_rng(0)
+    client = QdrantClient(path=str(tmp_path))
+    client.create_collection("collection", vectors_config={
+        name: models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE) for name in VECTOR_NAMES})
+    client.upsert("collection", points=[
+        models.PointStruct(id=number, vector={name: rng.normal(size=VECTOR_SIZE).tolist() for name in VECTOR_NAMES},
+                           payload={"caption": f"Case {number}"})
+        for number in range(40)
+    ])
+
+    report = recall_memory_report(client, "collection", sample_size=5, limit=3, max_points=30)
+    assert (report["points"], report["copied_points"], report["sampled_queries"]) == (40, 30, 5)
+    assert set(report["profiles"]) == set(STORAGE_PROFILES)
+    for measured in report["profiles"].values():
+        # The local mode searches exactly, whatever the profile
+        assert measured["recall@3"] == {name: 1.0 for name in VECTOR_NAMES}
+        assert measured["measured_disk_mb"] > 0 and "estimated_memory_mb" in measured
+    # The source collection is left as it was
+    assert client.get_collections().collections[0].name == "collection"
+    assert client.count("collection").count == 40
+    client.close()